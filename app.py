@@ -1,13 +1,23 @@
 from flask import Flask, request, jsonify, render_template, Response, stream_with_context, session
 from flask_cors import CORS
-from zai import ZhipuAiClient
 import os
 import json
 import uuid
+import time
 import threading
-from datetime import datetime
 from vector_store import VectorStore
 from backup_manager import BackupManager
+from archive_queue import create_archive_queue
+from llm_client import get_client, connection_stats
+from translator import Translator, EmptyTranslationError
+from session_store import create_session_store, new_session_data
+from history_compactor import HistoryCompactor, format_dialogue
+from prefetch import MemoryPrefetcher
+from logger import get_logger, chunk_sample_every
+from sse import create_coalescer, event_frame, THINKING_END_FRAME
+import metrics
+from metrics import (FIRST_TOKEN_SECONDS, THINKING_SECONDS, TOKENS_PER_SECOND, STREAM_SECONDS, ACTIVE_STREAMS,
+                     SSE_FRAMES)
 import config
 
 app = Flask(__name__, template_folder='templates')
@@ -18,16 +28,111 @@ app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-secret-key-change-
 app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
 app.config['SESSION_COOKIE_HTTPONLY'] = True
 
-# 初始化向量库
-vector_store = VectorStore()
+# 向量库和备份管理器在后台线程中加载，加载完成前静态页面和会话接口照常服务
+# 这些对象都由 start() 创建：导入本模块没有副作用，embedding 子进程（spawn）重新导入主模块时不会再启动一套服务
+vector_store = None
+backup_manager = None
+archive_queue = None
+store_loaded = threading.Event()
+store_status = {'status': 'loading', 'error': None, 'started_at': time.time(), 'load_seconds': None}
 
-# 初始化备份管理器
-backup_manager = BackupManager(vector_store)
+def load_vector_store():
+    """后台加载embedding模型和向量索引，并预热一次检索"""
+    global vector_store, backup_manager, archive_queue
+    try:
+        store = VectorStore()
+        # 预热：第一次编码和检索会触发模型和索引的惰性初始化
+        store.search('你好', k=1, fields=('summary',))
+        # 归档队列先于 vector_store 就绪，归档请求总能看到它
+        archive_queue = create_archive_queue(store)
+        vector_store = store
+        backup_manager = BackupManager(store)
+        store_status['status'] = 'ready'
+        store_status['load_seconds'] = time.time() - store_status['started_at']
+        print(f"【应用】向量库加载完成，耗时 {store_status['load_seconds']:.1f} 秒")
+    except Exception as e:
+        store_status['status'] = 'error'
+        store_status['error'] = str(e)
+        print(f"【应用】向量库加载失败: {e}")
+        import traceback
+        traceback.print_exc()
+    finally:
+        store_loaded.set()
+
+def store_unavailable_response():
+    """向量库尚未就绪时的统一响应"""
+    if store_status['status'] == 'error':
+        error = f"记忆库加载失败: {store_status['error']}"
+    else:
+        error = '她还在醒来，请稍后再试'
+    response = jsonify({
+        'success': False,
+        'error': error
+    })
+    response.status_code = 503
+    response.headers['Retry-After'] = '5'
+    return response
+
+# 对话和归档流式输出的日志
+chat_log = get_logger('对话接口')
+archive_log = get_logger('归档接口')
+translate_log = get_logger('翻译接口')
+
+# 翻译器：内存和磁盘两级缓存
+translator = None
+
+# 会话存储：每个用户的对话历史和剩余次数，空闲过期并限制总量
+# 数据格式: {'history': [...], 'remaining_count': 10, 'created_at': '...'}
+session_store = None
+
+# 对话历史压缩：超出预算时较早的对话折叠进每个会话缓存的滚动摘要
+history_compactor = None
+
+# 记忆预取：用户输入时后台检索草稿，正式发送时检索通常已经完成
+memory_prefetcher = None
+
+_start_lock = threading.Lock()
+_started = False
+
+def prefetch_memories(text):
+    """预取：用与正式对话相同的参数检索，结果留在检索缓存中"""
+    vector_store.search(text, **memory_search_options())
+
+def start():
+    """
+    创建翻译器、会话存储、历史压缩和记忆预取，并在后台加载向量库（重复调用时什么也不做）
+    
+    由 python app.py 和 asgi.py 的 lifespan 启动时调用，处理请求之前必须先调用。
+    """
+    global translator, session_store, history_compactor, memory_prefetcher, _started
+    with _start_lock:
+        if _started:
+            return
+        _started = True
+        
+        translator = Translator()
+        session_store = create_session_store()
+        
+        history_config = getattr(config, 'HISTORY_CONFIG', {})
+        if history_config.get('enabled', True):
+            history_compactor = HistoryCompactor(session_store, history_config)
+        
+        prefetch_config = getattr(config, 'PREFETCH_CONFIG', {})
+        if prefetch_config.get('enabled', True):
+            memory_prefetcher = MemoryPrefetcher(
+                prefetch_memories,
+                workers=prefetch_config.get('workers', 1),
+                max_pending=prefetch_config.get('max_pending', 64),
+                min_chars=prefetch_config.get('min_chars', 2),
+                max_chars=prefetch_config.get('max_chars', 500),
+                max_busy=prefetch_config.get('max_busy', 2)
+            )
+        
+        threading.Thread(target=load_vector_store, name='vector-store-loader', daemon=True).start()
 
-# 会话管理器：存储每个用户的对话历史和状态
-# 格式: {session_id: {'history': [...], 'remaining_count': 10}}
-session_manager = {}
-session_lock = threading.Lock()
+def ensure_session(session_id):
+    """会话数据不存在时初始化"""
+    session_store.ensure(session_id)
 
 def get_or_create_session():
     """获取或创建会话"""
@@ -37,51 +142,44 @@ def get_or_create_session():
     session_id = session['session_id']
     
     # 如果会话不存在，初始化
-    with session_lock:
-        if session_id not in session_manager:
-            session_manager[session_id] = {
-                'history': [],
-                'remaining_count': 10,
-                'created_at': datetime.now().isoformat()
-            }
+    ensure_session(session_id)
     
     return session_id
 
-def get_session_data():
-    """获取当前会话数据"""
-    session_id = get_or_create_session()
-    with session_lock:
-        return session_manager.get(session_id, {
-            'history': [],
-            'remaining_count': 10
-        })
+def get_session_data(session_id=None):
+    """获取会话数据（副本），session_id 为None时使用当前请求的会话"""
+    session_id = session_id or get_or_create_session()
+    return session_store.get(session_id) or new_session_data()
 
-def update_session_data(history=None, remaining_count=None):
-    """更新会话数据"""
-    session_id = get_or_create_session()
-    with session_lock:
-        if session_id not in session_manager:
-            session_manager[session_id] = {
-                'history': [],
-                'remaining_count': 10,
-                'created_at': datetime.now().isoformat()
-            }
-        
+def update_session_data(history=None, remaining_count=None, session_id=None):
+    """更新会话数据，session_id 为None时使用当前请求的会话"""
+    session_id = session_id or get_or_create_session()
+    
+    def apply(data):
         if history is not None:
-            session_manager[session_id]['history'] = history
+            data['history'] = history
         if remaining_count is not None:
-            session_manager[session_id]['remaining_count'] = remaining_count
-
-def clear_session():
-    """清除会话数据"""
-    session_id = get_or_create_session()
-    with session_lock:
-        if session_id in session_manager:
-            session_manager[session_id] = {
-                'history': [],
-                'remaining_count': 10,
-                'created_at': datetime.now().isoformat()
-            }
+            data['remaining_count'] = remaining_count
+    session_store.update(session_id, apply)
+
+def consume_remaining_count(session_id=None):
+    """
+    剩余对话次数减一（读改写在存储内原子完成）
+    
+    Returns:
+        int: 减少后的剩余次数
+    """
+    session_id = session_id or get_or_create_session()
+    
+    def apply(data):
+        data['remaining_count'] -= 1
+        return data['remaining_count']
+    return session_store.update(session_id, apply)
+
+def clear_session(session_id=None):
+    """清除会话数据，session_id 为None时使用当前请求的会话"""
+    session_id = session_id or get_or_create_session()
+    session_store.reset(session_id)
 
 
 chat_prompt = """
@@ -130,6 +228,22 @@ def index():
     get_or_create_session()
     return render_template('index.html')
 
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """存活检查：进程能响应请求即可"""
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """就绪检查：模型和向量索引加载完成后才返回200"""
+    body = {
+        'status': store_status['status'],
+        'load_seconds': store_status['load_seconds']
+    }
+    if store_status['error']:
+        body['error'] = store_status['error']
+    return jsonify(body), 200 if store_status['status'] == 'ready' else 503
+
 @app.route('/api/session/init', methods=['GET'])
 def init_session():
     """初始化会话接口"""
@@ -147,59 +261,97 @@ def init_session():
             'error': f'服务器错误: {str(e)}'
         }), 500
 
+class RequestError(Exception):
+    """请求参数不合法，message 直接返回给前端"""
+    
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def parse_chat_request(data, session_id=None):
+    """
+    校验对话请求（同步和异步两种服务模式共用）
+    
+    Returns:
+        tuple: (user_message, conversation_history)
+    
+    Raises:
+        RequestError: 请求数据为空、消息为空或对话次数已用完
+    """
+    if not data:
+        raise RequestError('请求数据为空')
+    
+    user_message = data.get('message', '')
+    # 优先使用前端传来的history，如果没有则使用session中的
+    conversation_history = data.get('history', None)
+    if conversation_history is None:
+        conversation_history = get_session_data(session_id)['history']
+    
+    if not user_message:
+        raise RequestError('消息内容不能为空')
+    
+    # 检查剩余次数
+    if get_session_data(session_id)['remaining_count'] <= 0:
+        raise RequestError('对话次数已用完')
+    
+    return user_message, conversation_history
+
+def parse_archive_request(data, session_id=None):
+    """
+    校验归档请求（同步和异步两种服务模式共用）
+    
+    Returns:
+        list: 要归档的对话历史
+    
+    Raises:
+        RequestError: 对话历史为空
+    """
+    # 优先使用前端传来的history，如果没有则使用session中的
+    conversation_history = (data or {}).get('history', None)
+    if conversation_history is None:
+        conversation_history = get_session_data(session_id)['history']
+    
+    if not conversation_history:
+        raise RequestError('对话历史为空')
+    
+    return conversation_history
+
+def track_stream(endpoint, frames):
+    """记录SSE流的时长和正在输出的流数；客户端断开时生成器被关闭，同样会记录"""
+    active = ACTIVE_STREAMS.labels(endpoint)
+    active.inc()
+    started = time.perf_counter()
+    try:
+        yield from frames
+    finally:
+        active.dec()
+        STREAM_SECONDS.labels(endpoint).observe(time.perf_counter() - started)
+
 @app.route('/api/chat', methods=['POST'])
 def chat():
     """对话接口 - 支持流式输出"""
     try:
-        data = request.json
-        if not data:
-            return jsonify({
-                'success': False,
-                'error': '请求数据为空'
-            }), 400
-        
-        user_message = data.get('message', '')
-        # 优先使用前端传来的history，如果没有则使用session中的
-        conversation_history = data.get('history', None)
-        if conversation_history is None:
-            session_data = get_session_data()
-            conversation_history = session_data['history']
+        user_message, conversation_history = parse_chat_request(request.json)
         
-        if not user_message:
-            return jsonify({
-                'success': False,
-                'error': '消息内容不能为空'
-            }), 400
-        
-        # 检查剩余次数
-        session_data = get_session_data()
-        remaining_count = session_data['remaining_count']
-        if remaining_count <= 0:
-            return jsonify({
-                'success': False,
-                'error': '对话次数已用完'
-            }), 400
+        if vector_store is None:
+            return store_unavailable_response()
         
         # 返回流式响应
-        def stream_with_session_update():
-            for chunk in chat_model_stream(user_message, conversation_history):
-                yield chunk
-            # 流式输出完成后，更新session
-            # 添加用户消息和AI回复到历史
-            updated_history = conversation_history.copy()
-            updated_history.append({'role': 'user', 'content': user_message})
-            # AI回复会在流式输出中收集，这里先不添加，由前端管理
-        
         return Response(
-            stream_with_context(stream_with_session_update()),
+            stream_with_context(track_stream('chat', chat_model_stream(user_message, conversation_history))),
             mimetype='text/event-stream',
             headers={
                 'Cache-Control': 'no-cache',
                 'X-Accel-Buffering': 'no'
             }
         )
+    except RequestError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), e.status
     except Exception as e:
-        print(f"对话接口错误: {e}")
+        chat_log.error(f'对话接口错误: {e}', exc_info=True)
         return jsonify({
             'success': False,
             'error': f'服务器错误: {str(e)}'
@@ -209,18 +361,10 @@ def chat():
 def archive():
     """归档接口 - 支持流式输出总结"""
     try:
-        data = request.json
-        # 优先使用前端传来的history，如果没有则使用session中的
-        conversation_history = data.get('history', None)
-        if conversation_history is None:
-            session_data = get_session_data()
-            conversation_history = session_data['history']
+        conversation_history = parse_archive_request(request.json)
         
-        if not conversation_history:
-            return jsonify({
-                'success': False,
-                'error': '对话历史为空'
-            }), 400
+        if vector_store is None:
+            return store_unavailable_response()
         
         # 返回流式响应（总结）
         def stream_with_session_clear():
@@ -230,190 +374,386 @@ def archive():
             clear_session()
         
         return Response(
-            stream_with_context(stream_with_session_clear()),
+            stream_with_context(track_stream('archive', stream_with_session_clear())),
             mimetype='text/event-stream',
             headers={
                 'Cache-Control': 'no-cache',
                 'X-Accel-Buffering': 'no'
             }
         )
+    except RequestError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), e.status
     except Exception as e:
-        print(f"归档接口错误: {e}")
+        archive_log.error(f'归档接口错误: {e}', exc_info=True)
         return jsonify({
             'success': False,
             'error': f'服务器错误: {str(e)}'
         }), 500
 
-def archive_with_summary_stream(conversation_history):
-    """归档并流式输出总结"""
+class StreamState:
+    """
+    把上游的流式数据块转换成发给前端的SSE帧
+    
+    同步（Flask）和异步（ASGI）两种服务模式共用，保证两者发出的SSE协议完全一致。
+    内容增量经过 FrameCoalescer 合并，流结束（或中断）时要先调用 flush 写出缓存的内容。
+    """
+    
+    def __init__(self, tag, endpoint, thinking_message=None):
+        """
+        在向上游发出请求之前创建，首个数据块的等待时间从这里开始计算
+        
+        Args:
+            tag: 日志前缀，如 '对话接口'
+            endpoint: 指标的 endpoint 标签，如 'chat'
+            thinking_message: 开始思考时附带给前端的提示语，为None时不附带
+        """
+        self.tag = tag
+        self.endpoint = endpoint
+        self.thinking_message = thinking_message
+        self.chunk_count = 0
+        self.reasoning_chunks = 0
+        self.completion_tokens = None
+        self.started = time.perf_counter()
+        self.first_chunk_at = None
+        self.thinking_started = None
+        self.is_thinking = False
+        self.has_content = False
+        self._parts = []
+        self._writer = create_coalescer()
+        self.log = get_logger(tag)
+        # 逐块调试日志的采样间隔，DEBUG未开启时为0，每个数据块只判断这一个整数
+        self._sample_every = chunk_sample_every(self.log)
+    
+    @property
+    def content(self):
+        """已经输出的全部内容"""
+        return ''.join(self._parts)
+    
+    def feed(self, chunk):
+        """
+        处理一个数据块
+        
+        Returns:
+            list: 要发给前端的SSE帧
+        """
+        self.chunk_count += 1
+        frames = []
+        sampled = self._sample_every and (self.chunk_count - 1) % self._sample_every == 0
+        if self.first_chunk_at is None:
+            self.first_chunk_at = time.perf_counter()
+            FIRST_TOKEN_SECONDS.labels(self.endpoint).observe(self.first_chunk_at - self.started)
+        
+        # 上游在最后的数据块中返回用量
+        usage = getattr(chunk, 'usage', None)
+        if usage is not None and usage.completion_tokens:
+            self.completion_tokens = usage.completion_tokens
+        
+        # 更安全的检查：确保 chunk 有 choices 属性且不为空
+        if not hasattr(chunk, 'choices') or not chunk.choices:
+            if sampled:
+                self.log.debug('chunk 没有 choices 属性或 choices 为空', chunk=self.chunk_count)
+            return frames
+        
+        delta = chunk.choices[0].delta
+        
+        # 检查 delta 是否存在
+        if not delta:
+            if sampled:
+                self.log.debug('delta 不存在', chunk=self.chunk_count)
+            return frames
+        
+        # 检测思考状态 - 智谱AI的思考模式中，思考内容在 reasoning_content 字段中
+        # 当 delta.reasoning_content 存在时，说明正在思考
+        # 当 delta.content 存在时，说明思考结束，开始输出内容
+        has_reasoning_content = hasattr(delta, 'reasoning_content') and delta.reasoning_content
+        has_content_field = hasattr(delta, 'content') and delta.content
+        
+        # 如果检测到思考内容（reasoning_content）
+        if has_reasoning_content:
+            # 如果之前没有处于思考状态，现在开始思考
+            if not self.is_thinking:
+                self.is_thinking = True
+                self.thinking_started = time.perf_counter()
+                self.log.debug('开始思考', chunk=self.chunk_count)
+                # 向前端发送思考提示
+                event = {'type': 'thinking', 'status': 'start'}
+                if self.thinking_message:
+                    event['message'] = self.thinking_message
+                self._writer.event(event_frame(event), frames)
+            # 思考内容不发送给前端，只在后端调试日志中采样记录
+            self.reasoning_chunks += 1
+            if sampled:
+                self.log.debug('思考中', chunk=self.chunk_count, reasoning=delta.reasoning_content)
+        
+        # 检查是否有实际内容输出（content字段）
+        if has_content_field:
+            # 如果之前处于思考状态，现在开始输出内容，说明思考结束
+            if self.is_thinking:
+                self.is_thinking = False
+                THINKING_SECONDS.labels(self.endpoint).observe(time.perf_counter() - self.thinking_started)
+                self.log.debug('思考结束，开始输出', chunk=self.chunk_count, reasoning_chunks=self.reasoning_chunks)
+                # 向前端发送思考结束信号
+                self._writer.event(THINKING_END_FRAME, frames)
+            
+            self.has_content = True
+            self._parts.append(delta.content)
+            if sampled:
+                self.log.debug('收到内容', chunk=self.chunk_count, content=delta.content)
+            # 发送SSE格式的数据（与相邻的增量合并成一帧）
+            self._writer.content(delta.content, frames)
+        elif not has_reasoning_content and sampled:
+            # 既没有思考内容也没有实际内容，记录日志
+            self.log.debug('chunk 既没有 reasoning_content 也没有 content', chunk=self.chunk_count)
+        
+        return frames
+    
+    def flush(self):
+        """
+        写出合并窗口中缓存的内容
+        
+        Returns:
+            list: 要发给前端的SSE帧（没有缓存的内容时为空）
+        """
+        frames = []
+        self._writer.flush(frames)
+        return frames
+    
+    def flush_due_in(self):
+        """缓存的内容还要等多少秒写出，没有缓存时为None（异步模式据此定时调用 flush）"""
+        return self._writer.due_in()
+    
+    @property
+    def frames(self):
+        """已经写出的SSE帧数（不含结束时的完成/错误帧）"""
+        return self._writer.frames
+    
+    def record_metrics(self):
+        """流结束时记录生成速度（上游没有返回用量时按数据块数计）和每条回复写出的帧数"""
+        SSE_FRAMES.labels(self.endpoint).observe(self.frames)
+        if self.first_chunk_at is None:
+            return
+        elapsed = time.perf_counter() - self.first_chunk_at
+        if elapsed > 0:
+            TOKENS_PER_SECOND.labels(self.endpoint).observe((self.completion_tokens or self.chunk_count) / elapsed)
+
+def build_archive_messages(conversation_history):
+    """构建归档总结的消息列表"""
+    # 构建总结提示词
+    story = "\n".join([
+        f"{'讲故事的人' if item['role'] == 'user' else '你'}: {item['content']}"
+        for item in conversation_history
+    ])
+    
+    message = write_prompt.format(story=story)
+    
+    messages_to_send = [{"role": "user", "content": message}]
+    # 完整提示词只在调试级别记录，序列化在日志线程中进行
+    archive_log.debug('发送给大模型的消息', messages=messages_to_send)
+    return messages_to_send
+
+def archive_completion_options(messages):
+    """归档总结的大模型请求参数（不含 stream）"""
+    return {
+        'model': config.ZHIPUAI_CONFIG['model'],
+        'messages': messages,
+        'max_tokens': 4096,
+        'temperature': 0.7,
+        'thinking': {
+            "type": "enabled",  # 启用深度思考模式
+        },
+    }
+
+def save_archive(summary, conversation_history):
+    """
+    保存归档总结：启用归档队列时写入队列日志后立即返回，否则直接写入向量库
+    
+    Returns:
+        str: 归档ID（之后通过 /api/archive/status 确认是否已写入向量库）；直接写入时为None
+    """
+    if archive_queue is not None:
+        return archive_queue.submit(summary, conversation_history)
+    vector_store.add_conversation(summary, conversation_history)
+    return None
+
+def archive_done_frame(archive_id):
+    """归档保存后的完成信号：排队中时带上归档ID，已直接写入时 saved 为true"""
+    if archive_id is None:
+        event = {'type': 'done', 'saved': True}
+    else:
+        event = {'type': 'done', 'saved': False, 'status': 'pending', 'archive_id': archive_id}
+    return f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+def finish_archive_stream(state, conversation_history):
+    """
+    归档流正常结束：总结不是“拒绝”时保存（写入归档队列或直接写入向量库）
+    
+    写入会阻塞，异步模式下放到线程池执行。
+    
+    Returns:
+        list: 要发给前端的SSE帧
+    """
+    state.record_metrics()
+    archive_log.info('流式输出结束', chunks=state.chunk_count, reasoning_chunks=state.reasoning_chunks,
+                     has_content=state.has_content, frames=state.frames)
+    
+    # 如果没有收到任何内容，发送错误消息
+    if not state.has_content:
+        archive_log.warning('没有收到任何内容')
+        return [f"data: {json.dumps({'type': 'error', 'error': '抱歉，归档被干扰。。。'}, ensure_ascii=False)}\n\n"]
+    
+    # 检查总结内容是否为"拒绝"（去除空白字符）
+    full_summary = state.content
+    if full_summary.strip() == "拒绝":
+        # 如果是"拒绝"，不保存到向量库
+        archive_log.info("总结内容为'拒绝'，不保存到向量库")
+        return [f"data: {json.dumps({'type': 'done', 'saved': False}, ensure_ascii=False)}\n\n"]
+    
+    # 存入FAISS向量库（启用归档队列时，排队落盘后即发送完成信号）
     try:
-        # 初始化客户端
-        client = ZhipuAiClient(api_key=config.ZHIPUAI_CONFIG['api_key'])
+        archive_id = save_archive(full_summary, conversation_history)
+        archive_log.info('保存总结', chars=len(full_summary), archive_id=archive_id)
+        return [archive_done_frame(archive_id)]
+    except Exception as e:
+        archive_log.error(f'保存向量库错误: {e}', exc_info=True)
+        return [f"data: {json.dumps({'type': 'error', 'error': f'保存失败: {str(e)}'}, ensure_ascii=False)}\n\n"]
 
-        # 构建总结提示词
-        story = "\n".join([
-            f"{'讲故事的人' if item['role'] == 'user' else '你'}: {item['content']}"
-            for item in conversation_history
-        ])
+def abort_archive_stream(state, conversation_history, error):
+    """
+    归档流中途出错：已经有部分内容时尝试保存
+    
+    Returns:
+        list: 要发给前端的SSE帧
+    """
+    state.record_metrics()
+    archive_log.error(f'流式处理错误: {error}', exc_info=error)
+    full_summary = state.content
+    if not (state.has_content and full_summary):
+        return [f"data: {json.dumps({'type': 'error', 'error': f'流式处理错误: {str(error)}'}, ensure_ascii=False)}\n\n"]
+    
+    if full_summary.strip() == "拒绝":
+        return [f"data: {json.dumps({'type': 'error', 'error': '流式处理中断'}, ensure_ascii=False)}\n\n"]
+    
+    try:
+        save_archive(full_summary, conversation_history)
+        return [f"data: {json.dumps({'type': 'error', 'error': '流式处理中断，但已保存部分内容'}, ensure_ascii=False)}\n\n"]
+    except:
+        return [f"data: {json.dumps({'type': 'error', 'error': f'流式处理中断: {str(error)}'}, ensure_ascii=False)}\n\n"]
 
-        message = write_prompt.format(story=story)
+def archive_with_summary_stream(conversation_history):
+    """归档并流式输出总结"""
+    try:
+        # 共享的客户端（复用长连接）
+        client = get_client()
         
-        # 打印发送给大模型的消息
-        print("=" * 80)
-        print("【归档接口】发送给大模型的消息:")
-        messages_to_send = [{"role": "user", "content": message}]
-        print(json.dumps(messages_to_send, ensure_ascii=False, indent=2))
-        print("=" * 80)
+        # 收集总结内容
+        state = StreamState('归档接口', 'archive', thinking_message='这个故事...')
         
         # 调用API进行流式总结
         response = client.chat.completions.create(
-            model=config.ZHIPUAI_CONFIG['model'],
-            messages=messages_to_send,
             stream=True,  # 启用流式输出
-            max_tokens=4096,
-            temperature=0.7,
-            thinking={
-                "type": "enabled",  # 启用深度思考模式
-            },
+            **archive_completion_options(build_archive_messages(conversation_history))
         )
         
-        # 收集总结内容
-        full_summary = ""
-        has_content = False
-        chunk_count = 0
-        is_thinking = False
-        
         try:
             for chunk in response:
-                chunk_count += 1
-                
                 try:
-                    # 更安全的检查：确保 chunk 有 choices 属性且不为空
-                    if not hasattr(chunk, 'choices') or not chunk.choices:
-                        print(f"【归档接口】chunk 没有 choices 属性或 choices 为空")
-                        continue
-                    
-                    # 确保 choices[0] 存在
-                    if len(chunk.choices) == 0:
-                        print(f"【归档接口】chunk.choices 长度为 0")
-                        continue
-                    
-                    delta = chunk.choices[0].delta
-                    
-                    # 检查 delta 是否存在
-                    if not delta:
-                        print(f"【归档接口】delta 不存在")
-                        continue
-                    
-                    # 检测思考状态 - 智谱AI的思考模式中，思考内容在 reasoning_content 字段中
-                    # 当 delta.reasoning_content 存在时，说明正在思考
-                    # 当 delta.content 存在时，说明思考结束，开始输出内容
-                    has_reasoning_content = hasattr(delta, 'reasoning_content') and delta.reasoning_content
-                    has_content_field = hasattr(delta, 'content') and delta.content
-                    
-                    # 如果检测到思考内容（reasoning_content）
-                    if has_reasoning_content:
-                        # 如果之前没有处于思考状态，现在开始思考
-                        if not is_thinking:
-                            is_thinking = True
-                            print("【归档接口】开始思考")
-                            # 向前端发送思考提示
-                            yield f"data: {json.dumps({'type': 'thinking', 'status': 'start', 'message': '这个故事...'}, ensure_ascii=False)}\n\n"
-                        # 思考内容不发送给前端，只在后端记录
-                        print(f"【归档接口】思考中: {repr(delta.reasoning_content)}")
-                    
-                    # 检查是否有实际内容输出（content字段）
-                    if has_content_field:
-                        # 如果之前处于思考状态，现在开始输出内容，说明思考结束
-                        if is_thinking:
-                            is_thinking = False
-                            print("【归档接口】思考结束，开始输出")
-                            # 向前端发送思考结束信号
-                            yield f"data: {json.dumps({'type': 'thinking', 'status': 'end'}, ensure_ascii=False)}\n\n"
-                        
-                        has_content = True
-                        content = delta.content
-                        full_summary += content
-                        # 发送SSE格式的数据
-                        yield f"data: {json.dumps({'type': 'content', 'content': content}, ensure_ascii=False)}\n\n"
-                    elif not has_reasoning_content:
-                        # 既没有思考内容也没有实际内容，记录日志
-                        print(f"【归档接口】chunk 既没有 reasoning_content 也没有 content")
+                    yield from state.feed(chunk)
                 except Exception as e:
                     # 单个 chunk 处理失败，记录但继续处理
-                    print(f"【归档接口】处理流式数据块时出错: {e}")
-                    import traceback
-                    traceback.print_exc()
+                    archive_log.error(f'处理流式数据块时出错: {e}', exc_info=True)
                     continue
             
-            print(f"【归档接口】总共收到 {chunk_count} 个 chunk，has_content: {has_content}")
-            
-            # 如果没有收到任何内容，发送错误消息
-            if not has_content:
-                print("【归档接口】警告：没有收到任何内容！")
-                yield f"data: {json.dumps({'type': 'error', 'error': '抱歉，归档被干扰。。。'}, ensure_ascii=False)}\n\n"
-            else:
-                # 检查总结内容是否为"拒绝"（去除空白字符）
-                summary_stripped = full_summary.strip()
-                is_rejected = summary_stripped == "拒绝"
-                
-                if is_rejected:
-                    # 如果是"拒绝"，不保存到向量库
-                    print("【归档接口】总结内容为'拒绝'，不保存到向量库")
-                    yield f"data: {json.dumps({'type': 'done', 'saved': False}, ensure_ascii=False)}\n\n"
-                else:
-                    # 存入FAISS向量库
-                    try:
-                        print(f"【归档接口】保存总结到向量库，总结长度: {len(full_summary)}")
-                        vector_store.add_conversation(full_summary, conversation_history)
-                        # 发送完成信号，标记已保存
-                        print("【归档接口】发送完成信号")
-                        yield f"data: {json.dumps({'type': 'done', 'saved': True}, ensure_ascii=False)}\n\n"
-                    except Exception as e:
-                        print(f"【归档接口】保存向量库错误: {e}")
-                        import traceback
-                        traceback.print_exc()
-                        yield f"data: {json.dumps({'type': 'error', 'error': f'保存失败: {str(e)}'}, ensure_ascii=False)}\n\n"
+            yield from state.flush()
+            yield from finish_archive_stream(state, conversation_history)
         
         except Exception as e:
-            # 流式处理过程中的异常
-            print(f"【归档接口】流式处理错误: {e}")
-            import traceback
-            traceback.print_exc()
-            # 如果已经有部分内容，尝试保存
-            if has_content and full_summary:
-                summary_stripped = full_summary.strip()
-                is_rejected = summary_stripped == "拒绝"
-                if not is_rejected:
-                    try:
-                        vector_store.add_conversation(full_summary, conversation_history)
-                        yield f"data: {json.dumps({'type': 'error', 'error': '流式处理中断，但已保存部分内容'}, ensure_ascii=False)}\n\n"
-                    except:
-                        yield f"data: {json.dumps({'type': 'error', 'error': f'流式处理中断: {str(e)}'}, ensure_ascii=False)}\n\n"
-                else:
-                    yield f"data: {json.dumps({'type': 'error', 'error': '流式处理中断'}, ensure_ascii=False)}\n\n"
-            else:
-                yield f"data: {json.dumps({'type': 'error', 'error': f'流式处理错误: {str(e)}'}, ensure_ascii=False)}\n\n"
+            # 流式处理过程中的异常，先写出已经合并好的内容
+            yield from state.flush()
+            yield from abort_archive_stream(state, conversation_history, e)
         
     except Exception as e:
-        print(f"【归档接口】归档流式输出错误: {e}")
-        import traceback
-        traceback.print_exc()
+        archive_log.error(f'归档流式输出错误: {e}', exc_info=True)
         error_msg = f"抱歉，发生了错误：{str(e)}"
         yield f"data: {json.dumps({'type': 'error', 'error': error_msg}, ensure_ascii=False)}\n\n"
 
+# 同步处理时每个等待中的状态查询都占用一个处理请求的线程，限制同时等待的请求数
+# （异步服务模式下由 asgi.py 在事件循环中等待，不受此限制）
+archive_status_waiters = threading.BoundedSemaphore(
+    getattr(config, 'ARCHIVE_QUEUE_CONFIG', {}).get('max_status_waiters', 4))
+
+@app.route('/api/archive/status/<archive_id>', methods=['GET'])
+def get_archive_status(archive_id):
+    """
+    查询归档是否已写入向量库
+    
+    查询参数 wait（秒，最多10）：仍在排队时最多等待这么久再返回，减少轮询次数；
+    同时等待的请求达到 max_status_waiters 时不等待，立即返回当前状态
+    """
+    if archive_queue is None:
+        return jsonify({
+            'success': False,
+            'error': '归档队列未启用'
+        }), 404
+    
+    wait = min(request.args.get('wait', 0, type=float), 10)
+    if wait > 0 and archive_status_waiters.acquire(blocking=False):
+        try:
+            state = archive_queue.wait(archive_id, wait)
+        finally:
+            archive_status_waiters.release()
+    else:
+        state = archive_queue.status(archive_id)
+    if state is None:
+        return jsonify({
+            'success': False,
+            'error': '归档不存在'
+        }), 404
+    return jsonify({
+        'success': True,
+        'archive_id': archive_id,
+        'status': state['status'],
+        'saved': state['status'] == 'saved',
+        'error': state['error']
+    })
+
+@app.route('/api/archive/stats', methods=['GET'])
+def get_archive_stats():
+    """获取归档队列统计信息（未启用时 stats 为None）"""
+    return jsonify({
+        'success': True,
+        'stats': archive_queue.get_stats() if archive_queue is not None else None
+    })
+
 @app.route('/api/vector_count', methods=['GET'])
 def get_vector_count():
     """获取当前向量总数"""
+    if vector_store is None:
+        return store_unavailable_response()
     count = vector_store.get_count()
     return jsonify({
         'success': True,
         'count': count
     })
 
+@app.route('/api/memory/prefetch', methods=['POST'])
+def prefetch_memory():
+    """记忆预取接口：前端在用户输入时（防抖后）发送草稿，后台预热检索缓存，立即返回"""
+    if vector_store is None:
+        return store_unavailable_response()
+    data = request.get_json(silent=True) or {}
+    text = str(data.get('text', '')).strip()
+    queued = memory_prefetcher is not None and memory_prefetcher.submit(get_or_create_session(), text)
+    return jsonify({
+        'success': True,
+        'queued': queued
+    }), 202
+
 @app.route('/api/translate', methods=['POST'])
 def translate():
-    """翻译接口：将中文翻译为英文"""
+    """翻译接口：将中文翻译为英文（结果带缓存）"""
     try:
         data = request.json
         if not data:
@@ -429,71 +769,86 @@ def translate():
                 'error': '文本内容不能为空'
             }), 400
         
-        # 使用智谱AI进行翻译
-        client = ZhipuAiClient(api_key=config.ZHIPUAI_CONFIG['api_key'])
+        translated_text = translator.translate(text)
+        translate_log.debug('翻译成功', text=text, translated=translated_text)
         
-        translate_prompt = f"""请将以下中文文本翻译成英文。
-
-要求：
-1. 只输出英文翻译结果
-2. 不要添加任何解释、说明或其他内容
-3. 不要使用markdown格式
-4. 不要使用引号包裹
-5. 直接输出翻译后的英文文本
-
-中文文本：
-{text}
+        return jsonify({
+            'success': True,
+            'original': text,
+            'translated': translated_text
+        })
+    except EmptyTranslationError as e:
+        translate_log.warning('翻译结果为空', text=text)
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+    except Exception as e:
+        translate_log.error(f'翻译接口错误: {e}', exc_info=True)
+        return jsonify({
+            'success': False,
+            'error': f'翻译失败: {str(e)}'
+        }), 500
 
-英文翻译："""
-        
-        messages = [{"role": "user", "content": translate_prompt}]
-        
-        response = client.chat.completions.create(
-            model=config.ZHIPUAI_CONFIG['model'],
-            messages=messages,
-            stream=False,
-            max_tokens=500,
-            temperature=0.3,
-        )
+@app.route('/api/translate/batch', methods=['POST'])
+def translate_batch():
+    """批量翻译接口：未命中缓存的文本合并成一次大模型调用"""
+    try:
+        data = request.json
+        texts = data.get('texts') if data else None
+        if not isinstance(texts, list) or not texts:
+            return jsonify({
+                'success': False,
+                'error': 'texts 必须是非空的文本列表'
+            }), 400
         
-        # 获取翻译结果
-        translated_text = response.choices[0].message.content.strip()
-        
-        # 如果翻译结果为空，尝试清理可能的markdown格式或其他格式
-        if not translated_text:
-            # 尝试获取原始内容
-            raw_content = response.choices[0].message.content
-            print(f"翻译原始内容: {repr(raw_content)}")
-            # 移除可能的markdown代码块标记
-            translated_text = raw_content.replace('```', '').replace('```', '').strip()
-            # 移除可能的引号
-            translated_text = translated_text.strip('"').strip("'").strip()
-        
-        # 如果还是为空，返回错误
-        if not translated_text:
-            print(f"翻译结果为空，原始响应: {response.choices[0].message.content}")
+        texts = [str(text).strip() for text in texts]
+        if not all(texts):
             return jsonify({
                 'success': False,
-                'error': '翻译结果为空，请重试'
-            }), 500
+                'error': '文本内容不能为空'
+            }), 400
         
-        print(f"翻译成功: {text} -> {translated_text}")
+        max_texts = getattr(config, 'TRANSLATION_CONFIG', {}).get('max_batch_texts', 100)
+        if len(texts) > max_texts:
+            return jsonify({
+                'success': False,
+                'error': f'一次最多翻译 {max_texts} 条文本'
+            }), 400
         
+        translations = translator.translate_batch(texts)
         return jsonify({
             'success': True,
-            'original': text,
-            'translated': translated_text
+            'translations': [
+                {'original': text, 'translated': translated}
+                for text, translated in zip(texts, translations)
+            ]
         })
+    except EmptyTranslationError as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
     except Exception as e:
-        print(f"翻译接口错误: {e}")
+        translate_log.error(f'批量翻译接口错误: {e}', exc_info=True)
         return jsonify({
             'success': False,
             'error': f'翻译失败: {str(e)}'
         }), 500
 
+@app.route('/api/translate/stats', methods=['GET'])
+def get_translate_stats():
+    """获取翻译缓存统计信息"""
+    return jsonify({
+        'success': True,
+        'stats': translator.get_stats()
+    })
+
 @app.route('/api/backup/info', methods=['GET'])
 def get_backup_info():
     """获取备份信息"""
+    if backup_manager is None:
+        return store_unavailable_response()
     try:
         info = backup_manager.get_backup_info()
         return jsonify({
@@ -506,6 +861,153 @@ def get_backup_info():
             'error': f'获取备份信息失败: {str(e)}'
         }), 500
 
+@app.route('/api/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """获取检索缓存统计信息"""
+    if vector_store is None:
+        return store_unavailable_response()
+    stats = vector_store.get_cache_stats()
+    if memory_prefetcher is not None:
+        stats['prefetch'] = memory_prefetcher.get_stats()
+    return jsonify({
+        'success': True,
+        'stats': stats
+    })
+
+@app.route('/api/session/stats', methods=['GET'])
+def get_session_stats():
+    """获取会话存储和对话历史压缩的统计信息"""
+    stats = session_store.get_stats()
+    if history_compactor is not None:
+        stats['history_compaction'] = history_compactor.get_stats()
+    return jsonify({
+        'success': True,
+        'stats': stats
+    })
+
+@app.route('/api/llm/stats', methods=['GET'])
+def get_llm_stats():
+    """获取大模型客户端的连接统计信息"""
+    return jsonify({
+        'success': True,
+        'stats': connection_stats.stats()
+    })
+
+# 取值依赖运行时对象的仪表，输出 /metrics 时才取值
+metrics.gauge('sessions', '会话存储中的会话数',
+              function=lambda: len(session_store) if session_store is not None else None)
+metrics.gauge('archive_queue_pending', '排队等待写入向量库的归档数',
+              function=lambda: archive_queue.pending() if archive_queue is not None else None)
+metrics.gauge('vector_store_vectors', '向量库中的向量数（加载完成前不输出）',
+              function=lambda: vector_store.get_count() if vector_store is not None else None)
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus 指标接口"""
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+def memory_search_options():
+    """对话时检索记忆的参数：最相关且互不重复的记忆，总字数受预算限制"""
+    retrieval_config = getattr(config, 'RETRIEVAL_CONFIG', {})
+    return {
+        'k': retrieval_config.get('top_k', 5),
+        'fields': ('summary',),
+        'max_distance': retrieval_config.get('max_distance'),
+        'diversity': retrieval_config.get('diversity'),
+        'max_chars': retrieval_config.get('max_chars'),
+        'candidates': retrieval_config.get('candidates', 4)
+    }
+
+def search_memories(user_message):
+    """对话时检索记忆；检索期间预取让路"""
+    if memory_prefetcher is None:
+        return vector_store.search(user_message, **memory_search_options())
+    with memory_prefetcher.foreground():
+        return vector_store.search(user_message, **memory_search_options())
+
+def view_chat_history(conversation_history, session_id=None):
+    """
+    提示词中使用的对话历史：已经折叠进摘要的较早对话只发送摘要（不在这里调用大模型）
+    
+    Returns:
+        tuple: (之前对话的摘要，没有时为空字符串, 摘要之后的对话历史)
+    """
+    if history_compactor is None:
+        return '', conversation_history
+    return history_compactor.view(session_id or get_or_create_session(), conversation_history)
+
+def build_chat_messages(user_message, conversation_history, memory_results, history_summary=''):
+    """构建对话的消息列表：系统提示和带上对话内容（较早的对话为摘要）、记忆的用户消息"""
+    # 构建记忆文本
+    memory_texts = []
+    for result in memory_results:
+        memory_texts.append(result['summary'])
+    memory_str = "\n".join(memory_texts) if memory_texts else "暂无相关记忆"
+    
+    # 构建当前对话内容文本
+    conversation_text = format_dialogue(conversation_history) if conversation_history else "暂无对话内容"
+    if history_summary:
+        conversation_text = f"（之前的对话摘要）{history_summary}\n{conversation_text}"
+    
+    # 构建增强的用户消息，按照指定格式
+    enhanced_user_message = f"这次对话内容：{conversation_text}\n当前对方说：{user_message}\n记忆：{memory_str}"
+    
+    # 构建消息列表：只包含系统提示和增强的用户消息
+    messages = [
+        {
+            "role": "system",
+            "content": chat_prompt
+        },
+        {
+            "role": "user",
+            "content": enhanced_user_message
+        }
+    ]
+    
+    # 完整提示词只在调试级别记录，序列化在日志线程中进行
+    chat_log.debug('发送给大模型的消息', messages=messages)
+    return messages
+
+def chat_completion_options(messages):
+    """对话的大模型请求参数（不含 stream）"""
+    return {
+        'model': config.ZHIPUAI_CONFIG['model'],
+        'messages': messages,
+        'max_tokens': config.ZHIPUAI_CONFIG['max_tokens'],
+        'temperature': config.ZHIPUAI_CONFIG['temperature'],
+        'thinking': {
+            "type": "enabled",  # 启用思考模式
+        },
+    }
+
+def finish_chat_stream(state, conversation_history, session_id=None):
+    """
+    对话流结束：扣减剩余次数并发送完成信号；对话历史超出预算时在后台更新摘要
+    
+    Returns:
+        list: 要发给前端的SSE帧
+    """
+    state.record_metrics()
+    chat_log.info('流式输出结束', chunks=state.chunk_count, reasoning_chunks=state.reasoning_chunks,
+                  has_content=state.has_content, frames=state.frames)
+    
+    # 如果没有收到任何内容，发送错误消息
+    if not state.has_content:
+        chat_log.warning('没有收到任何内容')
+        return [f"data: {json.dumps({'type': 'error', 'error': '她暂时跑出去玩了'}, ensure_ascii=False)}\n\n"]
+    
+    # 更新session：减少剩余次数
+    session_id = session_id or get_or_create_session()
+    remaining_count = consume_remaining_count(session_id)
+    
+    # 下一轮的对话历史以本轮历史加上这次回复开头，提前在后台压缩
+    if history_compactor is not None:
+        history_compactor.schedule(session_id, [*conversation_history,
+                                                {'role': 'assistant', 'content': state.content}])
+    
+    # 发送完成信号，包含更新后的剩余次数
+    return [f"data: {json.dumps({'type': 'done', 'remaining_count': remaining_count}, ensure_ascii=False)}\n\n"]
+
 def chat_model_stream(user_message: str, conversation_history):
     """
     大模型对话函数 - 流式输出版本
@@ -517,132 +1019,50 @@ def chat_model_stream(user_message: str, conversation_history):
     Yields:
         str: SSE格式的数据流
     """
+    state = None
     try:
-        # 初始化客户端
-        client = ZhipuAiClient(api_key=config.ZHIPUAI_CONFIG['api_key'],)
-        
-        # 从向量库检索最相关的top5条记忆
-        memory_results = vector_store.search(user_message, k=5)
-        
-        # 构建记忆文本
-        memory_texts = []
-        for result in memory_results:
-            memory_texts.append(result['summary'])
-        memory_str = "\n".join(memory_texts) if memory_texts else "暂无相关记忆"
-        
-        # 构建当前对话内容文本
-        conversation_text = "\n".join([
-            f"{'讲故事的人' if item['role'] == 'user' else '你'}: {item['content']}"
-            for item in conversation_history
-        ]) if conversation_history else "暂无对话内容"
-        
-        # 构建增强的用户消息，按照指定格式
-        enhanced_user_message = f"这次对话内容：{conversation_text}\n当前对方说：{user_message}\n记忆：{memory_str}"
-        
-        # 构建消息列表：只包含系统提示和增强的用户消息
-        messages = [
-            {
-                "role": "system",
-                "content": chat_prompt
-            },
-            {
-                "role": "user",
-                "content": enhanced_user_message
-            }
-        ]
+        # 共享的客户端（复用长连接）
+        client = get_client()
         
-        # 打印发送给大模型的消息
-        print("=" * 80)
-        print("【对话接口】发送给大模型的消息:")
-        print(json.dumps(messages, ensure_ascii=False, indent=2))
-        print("=" * 80)
+        memory_results = search_memories(user_message)
+        history_summary, recent_history = view_chat_history(conversation_history)
+        messages = build_chat_messages(user_message, recent_history, memory_results, history_summary)
         
         # 调用API
+        state = StreamState('对话接口', 'chat')
         response = client.chat.completions.create(
-            model=config.ZHIPUAI_CONFIG['model'],
-            messages=messages,
             stream=True,  # 启用流式输出
-            max_tokens=config.ZHIPUAI_CONFIG['max_tokens'],
-            temperature=config.ZHIPUAI_CONFIG['temperature'],
-            thinking = {
-                "type": "enabled",  # 启用思考模式
-            },
+            **chat_completion_options(messages)
         )
         
         # 流式输出内容
-        has_content = False
-        chunk_count = 0
-        is_thinking = False
         for chunk in response:
-            chunk_count += 1
-            
-            # 打印chunk信息用于调试
-            if chunk_count <= 5:  # 只打印前5个chunk的详细信息
-                print(f"【对话接口】chunk {chunk_count}: {type(chunk)}, dir: {[x for x in dir(chunk) if not x.startswith('_')]}")
-            
-            if hasattr(chunk, 'choices') and chunk.choices:
-                choice = chunk.choices[0]
-                delta = choice.delta
-                
-                # 检测思考状态 - 智谱AI的思考模式中，思考内容在 reasoning_content 字段中
-                # 当 delta.reasoning_content 存在时，说明正在思考
-                # 当 delta.content 存在时，说明思考结束，开始输出内容
-                has_reasoning_content = hasattr(delta, 'reasoning_content') and delta.reasoning_content
-                has_content_field = hasattr(delta, 'content') and delta.content
-                
-                # 如果检测到思考内容（reasoning_content）
-                if has_reasoning_content:
-                    # 如果之前没有处于思考状态，现在开始思考
-                    if not is_thinking:
-                        is_thinking = True
-                        print("【对话接口】开始思考")
-                        yield f"data: {json.dumps({'type': 'thinking', 'status': 'start'}, ensure_ascii=False)}\n\n"
-                    # 思考内容不发送给前端，只在后端记录
-                    print(f"【对话接口】思考中: {repr(delta.reasoning_content)}")
-                
-                # 检查是否有实际内容输出（content字段）
-                if has_content_field:
-                    # 如果之前处于思考状态，现在开始输出内容，说明思考结束
-                    if is_thinking:
-                        is_thinking = False
-                        print("【对话接口】思考结束，开始输出")
-                        yield f"data: {json.dumps({'type': 'thinking', 'status': 'end'}, ensure_ascii=False)}\n\n"
-                    
-                    has_content = True
-                    print(f"【对话接口】收到内容: {repr(delta.content)}")
-                    # 发送SSE格式的数据
-                    yield f"data: {json.dumps({'type': 'content', 'content': delta.content}, ensure_ascii=False)}\n\n"
-            else:
-                if chunk_count <= 5:
-                    print(f"【对话接口】chunk 没有 choices 属性或 choices 为空")
-        
-        print(f"【对话接口】总共收到 {chunk_count} 个 chunk，has_content: {has_content}")
-        
-        # 如果没有收到任何内容，发送错误消息
-        if not has_content:
-            print("【对话接口】警告：没有收到任何内容！")
-            yield f"data: {json.dumps({'type': 'error', 'error': '她暂时跑出去玩了'}, ensure_ascii=False)}\n\n"
-        else:
-            # 更新session：减少剩余次数
-            session_data = get_session_data()
-            remaining_count = session_data['remaining_count'] - 1
-            update_session_data(remaining_count=remaining_count)
-            
-            # 发送完成信号，包含更新后的剩余次数
-            print("【对话接口】发送完成信号")
-            yield f"data: {json.dumps({'type': 'done', 'remaining_count': remaining_count}, ensure_ascii=False)}\n\n"
+            yield from state.feed(chunk)
+        
+        yield from state.flush()
+        yield from finish_chat_stream(state, conversation_history)
         
     except Exception as e:
-        print(f"【对话接口】对话API调用错误: {e}")
-        import traceback
-        traceback.print_exc()
+        chat_log.error(f'对话API调用错误: {e}', exc_info=True)
+        # 上游中途出错时，先写出合并窗口中已经收到的内容
+        if state is not None:
+            yield from state.flush()
         error_msg = f"抱歉，发生了错误：{str(e)}"
         yield f"data: {json.dumps({'type': 'error', 'error': error_msg}, ensure_ascii=False)}\n\n"
 
+def start_backup_when_ready():
+    """向量库加载完成后在后台启动自动备份，首次备份不阻塞服务启动"""
+    def run():
+        store_loaded.wait()
+        if backup_manager is not None:
+            backup_manager.start()
+    threading.Thread(target=run, name='backup-starter', daemon=True).start()
+
 
 if __name__ == '__main__':
+    start()
     # 启动自动备份服务
-    backup_manager.start()
+    start_backup_when_ready()
     
     try:
         app.run(
@@ -652,6 +1072,9 @@ if __name__ == '__main__':
         )
     except KeyboardInterrupt:
         print("\n【应用】正在关闭...")
-        backup_manager.stop()
+        if backup_manager is not None:
+            backup_manager.stop()
+        if archive_queue is not None:
+            archive_queue.stop()
         print("【应用】已关闭")
 
@@ -0,0 +1,294 @@
+"""
+归档提交队列
+归档总结先写入SQLite日志表（落盘后即返回），后台写入线程把积累的归档合并成一批：
+一次编码、一次写入向量库的WAL（一次fsync），然后逐条标记为已保存；检查点仍由向量库按 checkpoint_interval 在后台进行。
+进程重启后继续处理未完成的归档
+"""
+
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from logger import get_logger
+import config
+
+
+log = get_logger('归档队列')
+
+# 归档的状态：排队中 / 已写入向量库 / 多次重试后仍失败
+PENDING = 'pending'
+SAVED = 'saved'
+FAILED = 'failed'
+
+
+class ArchiveQueue:
+    """
+    持久化的归档提交队列
+    
+    submit 在日志表提交（synchronous=FULL）之后返回，此后即使进程崩溃，归档也会在重启后写入向量库。
+    写入向量库和标记为已保存不在同一个事务中：两步之间崩溃或标记失败时，这批归档会再提交一次，
+    向量库以归档ID为去重键跳过已经写入的归档，重试不会重复添加向量。
+    """
+    
+    def __init__(self, vector_store, db_path='archive_queue.db', max_batch=32, flush_delay=0.05,
+                 max_attempts=3, retention=86400):
+        """
+        Args:
+            vector_store: VectorStore实例
+            db_path: 日志表所在的SQLite文件
+            max_batch: 一批最多写入的归档数
+            flush_delay: 收到新归档后等待多少秒再写入，让同时到达的归档合并成一批
+            max_attempts: 写入失败时最多尝试的次数，超过后标记为失败
+            retention: 已保存和失败的记录保留多少秒（供状态查询），之后清理
+        """
+        self.vector_store = vector_store
+        self.path = db_path
+        self.max_batch = max_batch
+        self.flush_delay = flush_delay
+        self.max_attempts = max_attempts
+        self.retention = retention
+        self.batches = 0
+        self.saved = 0
+        self.failed = 0
+        self._local = threading.local()
+        self._condition = threading.Condition()
+        # 写完（或写入失败）的批数，等待者据此判断查询状态之后是否又有归档改变了状态
+        self._flushes = 0
+        # 每写完一批调用的回调（异步模式的状态查询用来唤醒事件循环中的等待者）
+        self._listeners = []
+        self._stopping = False
+        
+        conn = self._connect()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS archives (
+                id TEXT PRIMARY KEY,
+                summary TEXT NOT NULL,
+                conversation TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS archives_status ON archives (status, created_at)')
+        # 上次退出时没有写完的归档
+        self._pending = conn.execute('SELECT COUNT(*) FROM archives WHERE status = ?', (PENDING,)).fetchone()[0]
+        if self._pending:
+            log.info('恢复未写入的归档', count=self._pending)
+        
+        self._thread = threading.Thread(target=self._run, name='archive-writer', daemon=True)
+        self._thread.start()
+    
+    def _connect(self):
+        """每个线程使用自己的连接，WAL模式下读写互不阻塞"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            # 提交即落盘：submit 返回后归档不会因为断电丢失
+            conn.execute('PRAGMA synchronous=FULL')
+            self._local.conn = conn
+        return conn
+    
+    def submit(self, summary, conversation_history):
+        """
+        提交一条归档（写入日志表后立即返回）
+        
+        Returns:
+            str: 归档ID，用于查询保存状态
+        """
+        archive_id = uuid.uuid4().hex
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                'INSERT INTO archives (id, summary, conversation, status, created_at, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (archive_id, summary, json.dumps(conversation_history, ensure_ascii=False), PENDING, now, now)
+            )
+        with self._condition:
+            self._pending += 1
+            self._condition.notify_all()
+        return archive_id
+    
+    def status(self, archive_id):
+        """
+        查询归档状态
+        
+        Returns:
+            dict: {'status': 'pending' / 'saved' / 'failed', 'error': 失败原因}，不存在时返回None
+        """
+        row = self._connect().execute('SELECT status, error FROM archives WHERE id = ?', (archive_id,)).fetchone()
+        if row is None:
+            return None
+        return {'status': row[0], 'error': row[1]}
+    
+    def wait(self, archive_id, timeout):
+        """
+        等待归档写入完成（或失败）
+        
+        Returns:
+            dict: 同 status，超时时返回当时的状态
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._condition:
+                flushes = self._flushes
+            # 查询SQLite时不持有锁，不阻塞提交和写入线程
+            state = self.status(archive_id)
+            remaining = deadline - time.monotonic()
+            if state is None or state['status'] != PENDING or remaining <= 0:
+                return state
+            with self._condition:
+                # 查询之后已经写完了一批时立即重新查询，否则等到下一批写完
+                if self._flushes == flushes:
+                    self._condition.wait(remaining)
+    
+    def subscribe(self, callback):
+        """
+        每写完（或写入失败）一批时调用 callback()
+        
+        回调在写入线程中、持有队列的锁时调用，必须很快返回且不再调用队列的方法，
+        例如 loop.call_soon_threadsafe(event.set)。
+        
+        Returns:
+            function: 取消订阅的函数
+        """
+        with self._condition:
+            self._listeners = self._listeners + [callback]
+        
+        def unsubscribe():
+            with self._condition:
+                self._listeners = [listener for listener in self._listeners if listener is not callback]
+        return unsubscribe
+    
+    def _notify(self):
+        """一批归档的状态改变之后唤醒等待者（需持有 _condition）"""
+        self._flushes += 1
+        self._condition.notify_all()
+        for listener in self._listeners:
+            try:
+                listener()
+            except Exception as e:
+                log.warning(f'归档状态回调失败: {e}')
+    
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._stopping:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+            
+            # 稍等片刻，让同时完成的归档合并成一批
+            if not self._stopping:
+                time.sleep(self.flush_delay)
+            try:
+                self._flush()
+            except Exception as e:
+                log.error(f'写入归档失败: {e}', exc_info=True)
+                time.sleep(1)
+    
+    def _flush(self):
+        """把最早的一批待写入归档写入向量库并标记状态"""
+        conn = self._connect()
+        rows = conn.execute(
+            'SELECT id, summary, conversation, created_at FROM archives '
+            'WHERE status = ? ORDER BY created_at LIMIT ?',
+            (PENDING, self.max_batch)
+        ).fetchall()
+        if not rows:
+            with self._condition:
+                self._pending = 0
+            return
+        
+        ids = [row[0] for row in rows]
+        placeholders = ','.join('?' * len(ids))
+        try:
+            # 一次编码、一次写WAL，不在这里做检查点
+            # 以归档ID去重，上次已经写入向量库的归档不会再添加一次
+            self.vector_store.add_conversations([{
+                'summary': summary,
+                'conversation': json.loads(conversation),
+                'key': archive_id,
+            } for archive_id, summary, conversation, _ in rows])
+        except Exception as e:
+            now = time.time()
+            with conn:
+                conn.execute(f'UPDATE archives SET attempts = attempts + 1, error = ?, updated_at = ? '
+                             f'WHERE id IN ({placeholders})', [str(e), now, *ids])
+                failed = conn.execute(f'UPDATE archives SET status = ? WHERE id IN ({placeholders}) '
+                                      f'AND attempts >= ?', [FAILED, *ids, self.max_attempts]).rowcount
+            log.error(f'写入向量库失败: {e}', count=len(ids), failed=failed, exc_info=True)
+            with self._condition:
+                self.failed += failed
+                self._pending -= failed
+                self._notify()
+            # 失败后稍等再重试
+            time.sleep(1)
+            return
+        
+        now = time.time()
+        with conn:
+            conn.execute(f'UPDATE archives SET status = ?, error = NULL, updated_at = ? WHERE id IN ({placeholders})',
+                         [SAVED, now, *ids])
+            if self.retention:
+                conn.execute('DELETE FROM archives WHERE status != ? AND updated_at < ?',
+                             (PENDING, now - self.retention))
+        log.info('归档已写入向量库', count=len(ids), waited=round(now - rows[0][3], 3))
+        with self._condition:
+            self.batches += 1
+            self.saved += len(ids)
+            self._pending -= len(ids)
+            self._notify()
+    
+    def pending(self):
+        """排队中的归档数"""
+        with self._condition:
+            return self._pending
+    
+    def stop(self, timeout=30):
+        """写完排队中的归档后停止写入线程（最多等待 timeout 秒，剩余的在重启后继续写入）"""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+    
+    def get_stats(self):
+        """
+        获取统计信息
+        
+        Returns:
+            dict: 排队数、已写入批数、已保存和失败的归档数、平均每批条数
+        """
+        with self._condition:
+            return {
+                'pending': self._pending,
+                'batches': self.batches,
+                'saved': self.saved,
+                'failed': self.failed,
+                'avg_batch_size': round(self.saved / self.batches, 2) if self.batches else 0.0,
+            }
+
+
+def create_archive_queue(vector_store, queue_config=None):
+    """
+    根据配置创建归档队列
+    
+    Args:
+        queue_config: 队列配置，为None时读取 ARCHIVE_QUEUE_CONFIG
+    
+    Returns:
+        ArchiveQueue: 归档队列，配置为不启用时返回None（归档时直接写入向量库）
+    """
+    queue_config = queue_config or getattr(config, 'ARCHIVE_QUEUE_CONFIG', {})
+    if not queue_config.get('enabled', True):
+        return None
+    return ArchiveQueue(vector_store,
+                        db_path=queue_config.get('db_path', 'archive_queue.db'),
+                        max_batch=queue_config.get('max_batch', 32),
+                        flush_delay=queue_config.get('flush_delay', 0.05),
+                        max_attempts=queue_config.get('max_attempts', 3),
+                        retention=queue_config.get('retention', 86400))
@@ -0,0 +1,460 @@
+"""
+异步服务模式（ASGI）
+
+/api/chat 和 /api/archive 在事件循环中处理：等待上游流式响应和写出SSE都不占用线程，
+向量检索、写入和会话存储的读写放到线程池执行，一个进程可以同时保持上千条SSE流。
+/api/archive/status/<id> 的长轮询也在事件循环中等待，不占用运行 Flask 的线程。
+其他接口仍由 Flask 应用处理（通过 a2wsgi 在线程池中运行），会话和SSE协议与同步模式完全一致。
+
+启动：
+    uvicorn asgi:application --host 0.0.0.0 --port 8093
+或者：
+    python asgi.py
+"""
+
+import asyncio
+import json
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+# 异步服务模式的依赖在 requirements.txt 中是可选的，同步模式不需要安装；在加载应用之前检查
+ASYNC_REQUIREMENTS = "pip install 'uvicorn>=0.23.0' 'a2wsgi>=1.7.0'"
+try:
+    from a2wsgi import WSGIMiddleware
+except ImportError as e:
+    raise ImportError(f"异步服务模式需要安装 uvicorn 和 a2wsgi：{ASYNC_REQUIREMENTS}") from e
+
+from itsdangerous import BadSignature
+from werkzeug.http import dump_cookie, parse_cookie
+import app
+from archive_queue import PENDING
+from llm_client import stream_chat_completion
+from logger import get_logger
+from metrics import STREAM_SECONDS, ACTIVE_STREAMS
+import config
+
+
+log = get_logger('异步服务')
+
+SSE_HEADERS = [
+    (b'content-type', b'text/event-stream; charset=utf-8'),
+    (b'cache-control', b'no-cache'),
+    (b'x-accel-buffering', b'no'),
+]
+
+
+def load_session(scope):
+    """
+    从 Flask 的签名cookie中读取会话ID，与同步接口共用同一个会话
+    
+    会读写会话存储（sqlite后端时是磁盘I/O），需要在线程池中调用。
+    
+    Returns:
+        tuple: (session_id, 需要下发的 Set-Cookie 头；已有会话时为None)
+    """
+    flask_app = app.app
+    interface = flask_app.session_interface
+    serializer = interface.get_signing_serializer(flask_app)
+    headers = dict(scope['headers'])
+    cookies = parse_cookie(headers.get(b'cookie', b'').decode('latin-1'))
+    
+    data = {}
+    value = cookies.get(flask_app.config['SESSION_COOKIE_NAME'])
+    if value:
+        try:
+            data = serializer.loads(value, max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+        except BadSignature:
+            data = {}
+    
+    session_id = data.get('session_id')
+    set_cookie = None
+    if session_id is None:
+        # 与 Flask 的 session 一样签名，之后同步接口也能读到这个会话
+        session_id = str(uuid.uuid4())
+        data['session_id'] = session_id
+        set_cookie = dump_cookie(
+            flask_app.config['SESSION_COOKIE_NAME'],
+            serializer.dumps(data),
+            domain=interface.get_cookie_domain(flask_app),
+            path=interface.get_cookie_path(flask_app),
+            secure=interface.get_cookie_secure(flask_app),
+            httponly=interface.get_cookie_httponly(flask_app),
+            samesite=interface.get_cookie_samesite(flask_app),
+        )
+    
+    app.ensure_session(session_id)
+    return session_id, set_cookie
+
+
+def cors_headers(scope):
+    """跨域请求时回显 Origin（与 flask-cors 的 supports_credentials 行为一致）"""
+    origin = dict(scope['headers']).get(b'origin')
+    if not origin:
+        return []
+    return [(b'access-control-allow-origin', origin), (b'access-control-allow-credentials', b'true'),
+            (b'vary', b'Origin')]
+
+
+async def read_json(receive):
+    """读取完整的请求体并解析为JSON，请求体为空时返回None"""
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise ConnectionError('客户端已断开')
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return json.loads(body) if body else None
+
+
+async def send_json(send, status, payload, headers=()):
+    """发送JSON响应"""
+    body = app.app.json.dumps(payload).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode()),
+                    *headers],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_unavailable(send, headers=()):
+    """向量库尚未就绪时的统一响应，与同步模式的 store_unavailable_response 相同"""
+    if app.store_status['status'] == 'error':
+        error = f"记忆库加载失败: {app.store_status['error']}"
+    else:
+        error = '她还在醒来，请稍后再试'
+    await send_json(send, 503, {'success': False, 'error': error}, [(b'retry-after', b'5'), *headers])
+
+
+async def wait_for_disconnect(receive):
+    """等待客户端断开连接"""
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def stream_sse(send, receive, endpoint, frames, headers=()):
+    """
+    把异步生成的SSE帧逐条写给客户端
+    
+    客户端中途断开时取消生成器，上游请求随之关闭。流的时长和正在输出的流数记入指标。
+    """
+    active = ACTIVE_STREAMS.labels(endpoint)
+    active.inc()
+    started = time.perf_counter()
+    try:
+        await _stream_sse(send, receive, frames, headers)
+    finally:
+        active.dec()
+        STREAM_SECONDS.labels(endpoint).observe(time.perf_counter() - started)
+
+
+async def _stream_sse(send, receive, frames, headers):
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [*SSE_HEADERS, *headers]})
+    
+    async def pump():
+        try:
+            async for frame in frames:
+                await send({'type': 'http.response.body', 'body': frame.encode('utf-8'), 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            await frames.aclose()
+    
+    pump_task = asyncio.ensure_future(pump())
+    watch_task = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        await asyncio.wait({pump_task, watch_task}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in (pump_task, watch_task):
+            task.cancel()
+    error, _ = await asyncio.gather(pump_task, watch_task, return_exceptions=True)
+    if isinstance(error, Exception):
+        log.error(f'SSE输出错误: {error}', exc_info=error)
+
+
+async def feed_stream(state, chunks, feed=None):
+    """
+    把上游的数据块交给 state 转换成SSE帧
+    
+    合并窗口中有缓存的内容时，等待下一个数据块最多等到窗口结束：上游暂时没有新数据时也按时写出，
+    没有缓存时直接等待上游（不额外创建任务）。上游结束后写出剩余的内容。
+    
+    Args:
+        feed: 处理一个数据块、返回SSE帧的函数，默认为 state.feed
+    """
+    feed = feed or state.feed
+    iterator = chunks.__aiter__()
+    pending = None
+    try:
+        while True:
+            due = state.flush_due_in()
+            if pending is None and due is None:
+                try:
+                    chunk = await iterator.__anext__()
+                except StopAsyncIteration:
+                    break
+            else:
+                if pending is None:
+                    pending = asyncio.ensure_future(iterator.__anext__())
+                done, _ = await asyncio.wait({pending}, timeout=max(due, 0) if due is not None else None)
+                if not done:
+                    for frame in state.flush():
+                        yield frame
+                    continue
+                task, pending = pending, None
+                try:
+                    chunk = task.result()
+                except StopAsyncIteration:
+                    break
+            for frame in feed(chunk):
+                yield frame
+        for frame in state.flush():
+            yield frame
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+
+async def chat_model_stream_async(user_message, conversation_history, session_id):
+    """chat_model_stream 的异步版本，SSE协议相同（合并窗口到期即写出，内容帧的切分可能不同）"""
+    state = None
+    try:
+        loop = asyncio.get_running_loop()
+        # 向量检索会阻塞（编码+FAISS），放到线程池执行
+        memory_results = await loop.run_in_executor(None, app.search_memories, user_message)
+        # 会话存储的读写（sqlite后端时是磁盘I/O）同样放到线程池，不阻塞事件循环中的其他流
+        history_summary, recent_history = await loop.run_in_executor(
+            None, app.view_chat_history, conversation_history, session_id)
+        messages = app.build_chat_messages(user_message, recent_history, memory_results, history_summary)
+        
+        state = app.StreamState('对话接口', 'chat')
+        async for frame in feed_stream(state, stream_chat_completion(**app.chat_completion_options(messages))):
+            yield frame
+        
+        frames = await loop.run_in_executor(None, app.finish_chat_stream, state, conversation_history, session_id)
+        for frame in frames:
+            yield frame
+    
+    except Exception as e:
+        app.chat_log.error(f'对话API调用错误: {e}', exc_info=True)
+        # 上游中途出错时，先写出合并窗口中已经收到的内容
+        if state is not None:
+            for frame in state.flush():
+                yield frame
+        error_msg = f"抱歉，发生了错误：{str(e)}"
+        yield f"data: {json.dumps({'type': 'error', 'error': error_msg}, ensure_ascii=False)}\n\n"
+
+
+async def archive_with_summary_stream_async(conversation_history, session_id):
+    """archive_with_summary_stream 的异步版本，SSE协议相同；结束后清除会话"""
+    loop = asyncio.get_running_loop()
+    try:
+        messages = app.build_archive_messages(conversation_history)
+        state = app.StreamState('归档接口', 'archive', thinking_message='这个故事...')
+        
+        def feed(chunk):
+            try:
+                return state.feed(chunk)
+            except Exception as e:
+                # 单个 chunk 处理失败，记录但继续处理
+                app.archive_log.error(f'处理流式数据块时出错: {e}', exc_info=True)
+                return []
+        
+        try:
+            async for frame in feed_stream(state, stream_chat_completion(**app.archive_completion_options(messages)),
+                                           feed):
+                yield frame
+            
+            # 写入向量库会阻塞，放到线程池执行
+            frames = await loop.run_in_executor(
+                None, app.finish_archive_stream, state, conversation_history)
+        except Exception as e:
+            # 流式处理过程中的异常，先写出已经合并好的内容
+            frames = state.flush() + await loop.run_in_executor(
+                None, app.abort_archive_stream, state, conversation_history, e)
+        for frame in frames:
+            yield frame
+    
+    except Exception as e:
+        app.archive_log.error(f'归档流式输出错误: {e}', exc_info=True)
+        error_msg = f"抱歉，发生了错误：{str(e)}"
+        yield f"data: {json.dumps({'type': 'error', 'error': error_msg}, ensure_ascii=False)}\n\n"
+    
+    # 归档完成后，清除会话
+    await loop.run_in_executor(None, app.clear_session, session_id)
+
+
+async def handle_chat(scope, receive, send):
+    """对话接口 - 异步流式输出"""
+    loop = asyncio.get_running_loop()
+    headers = cors_headers(scope)
+    try:
+        session_id, set_cookie = await loop.run_in_executor(None, load_session, scope)
+        if set_cookie:
+            headers.append((b'set-cookie', set_cookie.encode('latin-1')))
+        data = await read_json(receive)
+        user_message, conversation_history = await loop.run_in_executor(
+            None, app.parse_chat_request, data, session_id)
+        
+        if app.vector_store is None:
+            return await send_unavailable(send, headers)
+    except app.RequestError as e:
+        return await send_json(send, e.status, {'success': False, 'error': str(e)}, headers)
+    except Exception as e:
+        app.chat_log.error(f'对话接口错误: {e}', exc_info=True)
+        return await send_json(send, 500, {'success': False, 'error': f'服务器错误: {str(e)}'}, headers)
+    
+    await stream_sse(send, receive, 'chat',
+                     chat_model_stream_async(user_message, conversation_history, session_id), headers)
+
+
+async def handle_archive(scope, receive, send):
+    """归档接口 - 异步流式输出总结"""
+    loop = asyncio.get_running_loop()
+    headers = cors_headers(scope)
+    try:
+        session_id, set_cookie = await loop.run_in_executor(None, load_session, scope)
+        if set_cookie:
+            headers.append((b'set-cookie', set_cookie.encode('latin-1')))
+        data = await read_json(receive)
+        conversation_history = await loop.run_in_executor(None, app.parse_archive_request, data, session_id)
+        
+        if app.vector_store is None:
+            return await send_unavailable(send, headers)
+    except app.RequestError as e:
+        return await send_json(send, e.status, {'success': False, 'error': str(e)}, headers)
+    except Exception as e:
+        app.archive_log.error(f'归档接口错误: {e}', exc_info=True)
+        return await send_json(send, 500, {'success': False, 'error': f'服务器错误: {str(e)}'}, headers)
+    
+    await stream_sse(send, receive, 'archive',
+                     archive_with_summary_stream_async(conversation_history, session_id), headers)
+
+
+async def wait_archive_status(archive_queue, archive_id, timeout):
+    """
+    ArchiveQueue.wait 的异步版本：等待期间不占用线程，每写完一批由写入线程唤醒后重新查询
+    
+    Returns:
+        dict: 同 ArchiveQueue.status，超时时返回当时的状态
+    """
+    loop = asyncio.get_running_loop()
+    changed = asyncio.Event()
+    unsubscribe = archive_queue.subscribe(lambda: loop.call_soon_threadsafe(changed.set))
+    try:
+        deadline = loop.time() + timeout
+        while True:
+            # 先清除再查询：查询期间写完的批次会重新设置事件，不会错过
+            changed.clear()
+            state = await loop.run_in_executor(None, archive_queue.status, archive_id)
+            remaining = deadline - loop.time()
+            if state is None or state['status'] != PENDING or remaining <= 0:
+                return state
+            try:
+                await asyncio.wait_for(changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        unsubscribe()
+
+
+async def handle_archive_status(scope, receive, send):
+    """查询归档是否已写入向量库 - 与同步模式的 get_archive_status 相同，长轮询不占用线程"""
+    headers = cors_headers(scope)
+    archive_queue = app.archive_queue
+    if archive_queue is None:
+        return await send_json(send, 404, {'success': False, 'error': '归档队列未启用'}, headers)
+    
+    archive_id = scope['path'][len(ARCHIVE_STATUS_PREFIX):]
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    try:
+        wait = min(float(query.get('wait', ['0'])[0]), 10)
+    except ValueError:
+        wait = 0
+    
+    try:
+        if wait > 0:
+            state = await wait_archive_status(archive_queue, archive_id, wait)
+        else:
+            state = await asyncio.get_running_loop().run_in_executor(None, archive_queue.status, archive_id)
+    except Exception as e:
+        app.archive_log.error(f'查询归档状态错误: {e}', exc_info=True)
+        return await send_json(send, 500, {'success': False, 'error': f'服务器错误: {str(e)}'}, headers)
+    
+    if state is None:
+        return await send_json(send, 404, {'success': False, 'error': '归档不存在'}, headers)
+    await send_json(send, 200, {
+        'success': True,
+        'archive_id': archive_id,
+        'status': state['status'],
+        'saved': state['status'] == 'saved',
+        'error': state['error']
+    }, headers)
+
+
+# 以异步方式处理的接口，其余请求交给 Flask
+ASYNC_ROUTES = {
+    ('POST', '/api/chat'): handle_chat,
+    ('POST', '/api/archive'): handle_archive,
+}
+
+# /api/archive/status/<archive_id>
+ARCHIVE_STATUS_PREFIX = '/api/archive/status/'
+
+
+def find_handler(scope):
+    """返回以异步方式处理该请求的函数，交给 Flask 处理时返回None"""
+    if scope['type'] != 'http':
+        return None
+    method, path = scope.get('method'), scope.get('path', '')
+    handler = ASYNC_ROUTES.get((method, path))
+    if handler is None and method == 'GET' and path.startswith(ARCHIVE_STATUS_PREFIX):
+        archive_id = path[len(ARCHIVE_STATUS_PREFIX):]
+        # 与 Flask 的 <archive_id> 一样不匹配空值和带斜杠的路径
+        if archive_id and '/' not in archive_id:
+            handler = handle_archive_status
+    return handler
+
+async_config = getattr(config, 'ASYNC_CONFIG', {})
+wsgi_application = WSGIMiddleware(app.app, workers=async_config.get('wsgi_workers', 10))
+
+
+async def application(scope, receive, send):
+    """ASGI入口"""
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                app.start()
+                # 向量检索、写入等阻塞操作使用的线程池
+                asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(
+                    max_workers=async_config.get('executor_threads', 16), thread_name_prefix='async-blocking'))
+                # 启动自动备份服务
+                app.start_backup_when_ready()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if app.backup_manager is not None:
+                    app.backup_manager.stop()
+                if app.archive_queue is not None:
+                    app.archive_queue.stop()
+                if app.vector_store is not None:
+                    app.vector_store.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    
+    handler = find_handler(scope)
+    if handler is None:
+        return await wsgi_application(scope, receive, send)
+    return await handler(scope, receive, send)
+
+
+if __name__ == '__main__':
+    try:
+        import uvicorn
+    except ImportError:
+        raise SystemExit(f"异步服务模式需要安装 uvicorn 和 a2wsgi：{ASYNC_REQUIREMENTS}")
+    uvicorn.run(application, host='0.0.0.0', port=config.OTHER_CONFIG['port'])
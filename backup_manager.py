@@ -4,9 +4,10 @@
 """
 
 import os
-import shutil
 import threading
+import time
 from datetime import datetime, timedelta
+from metrics import BACKUP_SECONDS, BACKUP_BYTES
 
 
 class BackupManager:
@@ -52,16 +53,19 @@ class BackupManager:
                 )
                 backup_metadata_path = os.path.join(
                     self.backup_dir, 
-                    f'vector_metadata_{timestamp}.pkl'
+                    f'vector_metadata_{timestamp}.db'
                 )
                 
-                # 复制文件
-                shutil.copy2(index_path, backup_index_path)
-                shutil.copy2(metadata_path, backup_metadata_path)
+                # 先做检查点再复制文件，期间暂停写入，保证索引和元数据一致；分片时每个分片一组文件
+                started = time.perf_counter()
+                written = self.vector_store.backup(backup_index_path, backup_metadata_path)
+                BACKUP_SECONDS.observe(time.perf_counter() - started)
+                BACKUP_BYTES.set(sum(os.path.getsize(path) for paths in written for path in paths))
                 
                 print(f"【备份管理器】备份完成: {timestamp}")
-                print(f"  - 索引文件: {backup_index_path}")
-                print(f"  - 元数据文件: {backup_metadata_path}")
+                for backup_index_path, backup_metadata_path in written:
+                    print(f"  - 索引文件: {backup_index_path}")
+                    print(f"  - 元数据文件: {backup_metadata_path}")
                 
                 return True
                 
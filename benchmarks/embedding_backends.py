@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+embedding推理后端基准测试
+比较各后端的单条延迟、批量吞吐和相对原始精度(torch fp32)的向量偏差
+
+用法:
+  python benchmarks/embedding_backends.py
+  python benchmarks/embedding_backends.py --backends torch torch-int8 onnx --texts summaries.txt
+  python benchmarks/embedding_backends.py --export-int8 avx2   # 先导出量化ONNX模型
+  python benchmarks/embedding_backends.py --output result.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from vector_store import load_embedding_model, EMBEDDING_BACKENDS
+
+# 没有指定文本时使用的示例，长短不一，接近真实的对话和记忆总结
+SAMPLE_TEXTS = [
+    "你好",
+    "今天天气真好",
+    "我给你讲一个关于星星的故事吧",
+    "从前有一座山，山里有一座庙，庙里有个老和尚在给小和尚讲故事。",
+    "她在海边捡到了一枚发光的贝壳，贝壳里藏着一段被遗忘的歌。",
+    "小狐狸说，驯服就是建立联系。你要对你驯服的东西负责。",
+    "开拓者们穿过了漫长的雪原，在列车上分享了各自家乡的食物和传说。",
+    "那天我们一起看了日落，谁都没有说话，只是安静地坐着，直到天完全黑下来。",
+    "记忆像是往昔的涟漪，一圈一圈地扩散开去，最后消失在水面上，但水底的石头还在。",
+    "桃子",
+    "谢谢你听我讲完这个故事",
+    "他把种子埋进土里，每天浇水，等待着它发芽的那一天。春天来的时候，土里冒出了一点点绿色。",
+    "有些人离开了，但他们讲过的故事还留在这里。",
+    "我想知道，你会记住我吗？",
+    "雨停之后，城市的街道上倒映着霓虹灯的光，像一条流淌的河。",
+    "晚安",
+]
+
+
+def load_texts(path, limit):
+    """从文件读取测试文本：每行一条，或JSONL中的 summary 字段"""
+    texts = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('{'):
+                try:
+                    line = json.loads(line).get('summary') or ''
+                except json.JSONDecodeError:
+                    pass
+            if line:
+                texts.append(line)
+            if len(texts) >= limit:
+                break
+    return texts
+
+
+def percentile_ms(values, q):
+    return float(np.percentile(values, q) * 1000)
+
+
+def benchmark_backend(backend, texts, reference, rounds, batch_size):
+    """
+    测试一个后端
+    
+    Returns:
+        tuple: (结果字典, 该后端的向量)
+    """
+    start = time.perf_counter()
+    model = load_embedding_model(backend)
+    load_seconds = time.perf_counter() - start
+    
+    # 预热
+    model.encode(texts[:batch_size], batch_size=batch_size)
+    
+    # 单条延迟（对话时每次检索都是单条编码）
+    latencies = []
+    for _ in range(rounds):
+        for text in texts:
+            start = time.perf_counter()
+            model.encode([text])
+            latencies.append(time.perf_counter() - start)
+    
+    # 批量吞吐（归档、批量导入）
+    start = time.perf_counter()
+    for _ in range(rounds):
+        embeddings = model.encode(texts, batch_size=batch_size)
+    throughput = len(texts) * rounds / (time.perf_counter() - start)
+    embeddings = np.asarray(embeddings, dtype='float32')
+    
+    label = backend
+    if backend == 'onnx' and config.EMBEDDING_CONFIG.get('onnx_file_name'):
+        label = f"onnx:{config.EMBEDDING_CONFIG['onnx_file_name']}"
+    result = {
+        'backend': label,
+        'load_seconds': load_seconds,
+        'latency_p50_ms': percentile_ms(latencies, 50),
+        'latency_p99_ms': percentile_ms(latencies, 99),
+        'throughput_per_second': throughput,
+    }
+    
+    if reference is not None:
+        # 与原始精度向量的余弦相似度
+        a = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+        b = reference / np.linalg.norm(reference, axis=1, keepdims=True)
+        cosine = np.sum(a * b, axis=1)
+        result['cosine_to_fp32_mean'] = float(cosine.mean())
+        result['cosine_to_fp32_min'] = float(cosine.min())
+        
+        # 在测试文本内部做最近邻检索，比较top5与原始精度的重合率
+        k = min(5, len(texts) - 1)
+        if k > 0:
+            def neighbors(x):
+                distances = ((x[:, None, :] - x[None, :, :]) ** 2).sum(axis=2)
+                np.fill_diagonal(distances, np.inf)
+                return np.argsort(distances, axis=1)[:, :k]
+            ours, theirs = neighbors(embeddings), neighbors(reference)
+            overlap = [len(set(o) & set(t)) / k for o, t in zip(ours, theirs)]
+            result[f'neighbor_recall_at_{k}'] = float(np.mean(overlap))
+    
+    return result, embeddings
+
+
+def export_int8(quantization):
+    """导出动态int8量化的ONNX模型到模型目录（仅本地模型）"""
+    from sentence_transformers import export_dynamic_quantized_onnx_model
+    
+    embedding_config = config.EMBEDDING_CONFIG
+    if embedding_config['model_type'] != 'local':
+        raise ValueError("只支持为本地模型导出量化ONNX文件")
+    
+    model = load_embedding_model('onnx')
+    model_path = embedding_config['local_model_path']
+    export_dynamic_quantized_onnx_model(model, quantization, model_path)
+    file_name = f"onnx/model_qint8_{quantization}.onnx"
+    print(f"✓ 已导出: {os.path.join(model_path, file_name)}")
+    print(f"  在 config.py 中设置 EMBEDDING_CONFIG['onnx_file_name'] = '{file_name}' 即可使用")
+    return file_name
+
+
+def main():
+    parser = argparse.ArgumentParser(description='embedding推理后端基准测试')
+    parser.add_argument('--backends', nargs='+', default=list(EMBEDDING_BACKENDS),
+                        choices=EMBEDDING_BACKENDS, help='要测试的后端，均与torch原始精度比较')
+    parser.add_argument('--texts', help='测试文本文件，每行一条或JSONL（summary字段）')
+    parser.add_argument('--limit', type=int, default=500, help='最多使用多少条文本')
+    parser.add_argument('--rounds', type=int, default=3, help='重复次数')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--export-int8', metavar='QUANTIZATION',
+                        help='先导出量化ONNX模型并测试，取值如 avx2 / avx512 / avx512_vnni / arm64')
+    parser.add_argument('--output', help='把结果写入JSON文件')
+    args = parser.parse_args()
+    
+    texts = load_texts(args.texts, args.limit) if args.texts else SAMPLE_TEXTS
+    print(f"测试文本: {len(texts)} 条，重复 {args.rounds} 轮")
+    
+    if args.export_int8:
+        config.EMBEDDING_CONFIG['onnx_file_name'] = export_int8(args.export_int8)
+    
+    # 原始精度作为基准
+    backends = ['torch'] + [b for b in args.backends if b != 'torch']
+    reference = None
+    results = []
+    for backend in backends:
+        try:
+            result, embeddings = benchmark_backend(backend, texts, reference, args.rounds, args.batch_size)
+        except Exception as e:
+            print(f"  {backend}: 跳过（{e}）")
+            continue
+        if backend == 'torch':
+            reference = embeddings
+        results.append(result)
+    
+    print()
+    print(f"{'后端':<12}{'加载(s)':>9}{'p50(ms)':>10}{'p99(ms)':>10}{'吞吐(条/s)':>12}{'余弦均值':>10}{'余弦最小':>10}")
+    for r in results:
+        print(f"{r['backend']:<12}{r['load_seconds']:>9.2f}{r['latency_p50_ms']:>10.2f}{r['latency_p99_ms']:>10.2f}"
+              f"{r['throughput_per_second']:>12.1f}{r.get('cosine_to_fp32_mean', 1.0):>10.4f}"
+              f"{r.get('cosine_to_fp32_min', 1.0):>10.4f}")
+    
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'texts': len(texts), 'rounds': args.rounds, 'results': results},
+                      f, ensure_ascii=False, indent=2)
+        print(f"\n结果已写入: {args.output}")
+
+
+if __name__ == '__main__':
+    main()
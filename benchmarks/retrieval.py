@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+"""
+向量检索基准测试
+用合成向量比较各索引类型在不同数据量下的召回率、延迟、吞吐、构建时间和内存
+
+每个 (数据量, 索引类型) 在独立的子进程中运行，内存统计互不影响。
+数据和查询是按配置维度生成的高斯混合向量（归一化），通过 VectorStore 的正常路径写入和检索：
+批量导入 + 迁移构建索引，search() 测延迟和吞吐，add_conversation() 测单条写入延迟（含WAL fsync）。
+召回率以精确的暴力检索为基准。
+
+用法:
+  python benchmarks/retrieval.py
+  python benchmarks/retrieval.py --sizes 10000 100000 1000000 --index-types flat ivf hnsw ivfpq
+  python benchmarks/retrieval.py --threads 1 4 8 --faiss nlist=4096 nprobe=32 --output result.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import argparse
+import threading
+import multiprocessing
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import faiss
+import config
+
+BLOCK_SIZE = 1024
+
+
+class SyntheticEncoder:
+    """
+    代替embedding模型：文本 'i' 对应第i条数据向量，'q<j>' 对应第j条查询向量
+    
+    数据按块生成，同一个种子和块号总是得到相同的向量，不需要把全部数据放在内存里。
+    """
+    
+    def __init__(self, dimension, queries, clusters=256, noise=0.5, seed=0):
+        self.dimension = dimension
+        self.clusters = clusters
+        self.noise = noise
+        self.seed = seed
+        self.centers = np.random.default_rng(seed).standard_normal((clusters, dimension)).astype('float32')
+        self.queries = self._generate(np.random.default_rng([seed, 1]), queries)
+        self._cached = (None, None)
+    
+    def _generate(self, rng, count):
+        centers = self.centers[rng.integers(0, self.clusters, count)]
+        vectors = centers + self.noise * rng.standard_normal((count, self.dimension), dtype='float32')
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    
+    def block(self, number):
+        """第 number 块数据向量（最近一块会被缓存）"""
+        cached_number, cached = self._cached
+        if cached_number != number:
+            cached = self._generate(np.random.default_rng([self.seed, 2, number]), BLOCK_SIZE)
+            self._cached = (number, cached)
+        return cached
+    
+    def encode(self, texts, **kwargs):
+        vectors = []
+        for text in texts:
+            if text.startswith('q'):
+                vectors.append(self.queries[int(text[1:])])
+            else:
+                i = int(text)
+                vectors.append(self.block(i // BLOCK_SIZE)[i % BLOCK_SIZE])
+        return np.array(vectors, dtype='float32')
+
+
+def exact_neighbors(encoder, size, k):
+    """逐块暴力检索，得到每条查询的真实 top-k（不需要一次性生成全部数据）"""
+    heap = faiss.ResultHeap(len(encoder.queries), k)
+    for start in range(0, size, BLOCK_SIZE):
+        block = encoder.block(start // BLOCK_SIZE)[:size - start]
+        index = faiss.IndexFlatL2(encoder.dimension)
+        index.add(block)
+        distances, ids = index.search(encoder.queries, k)
+        heap.add_result(distances, np.where(ids >= 0, ids + start, -1))
+    heap.finalize()
+    return heap.I
+
+
+def memory_mb():
+    """
+    Returns:
+        tuple: (当前常驻内存, 峰值常驻内存)，单位MB，无法获取时为None
+    """
+    current = peak = None
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    current = int(line.split()[1]) / 1024
+                elif line.startswith('VmHWM:'):
+                    peak = int(line.split()[1]) / 1024
+    except OSError:
+        try:
+            import resource
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        except ImportError:
+            pass
+    return current, peak
+
+
+def percentile_ms(values, q):
+    return float(np.percentile(values, q) * 1000)
+
+
+def measure_qps(store, queries, k, threads, duration):
+    """threads 个线程循环检索 duration 秒，返回每秒完成的检索数"""
+    done = [0] * threads
+    deadline = time.perf_counter() + duration
+    
+    def worker(n):
+        i = n
+        while time.perf_counter() < deadline:
+            store.search(f"q{i % queries}", k=k, fields=('summary',))
+            done[n] += 1
+            i += threads
+    
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return sum(done) / (time.perf_counter() - start)
+
+
+def run_case(case):
+    """在子进程中测试一组 (数据量, 索引类型)，返回结果字典"""
+    config.FAISS_CONFIG.update(case['faiss'])
+    work_dir = tempfile.mkdtemp(prefix='retrieval_bench_')
+    config.FAISS_CONFIG.update({
+        'index_type': case['index_type'],
+        'index_path': os.path.join(work_dir, 'vector_index.faiss'),
+        'metadata_path': os.path.join(work_dir, 'vector_metadata.db'),
+        'wal_path': None,
+        'shard_dir': os.path.join(work_dir, 'vector_shards'),
+        'checkpoint_interval': 10 ** 9,
+    })
+    config.EMBEDDING_CONFIG['vector_dimension'] = case['dimension']
+    # 合成向量不需要编码时间，微批量只会增加等待
+    config.EMBEDDING_CONFIG['micro_batching'] = False
+    # 只测检索本身，重复的查询不走缓存
+    config.CACHE_CONFIG = {'embedding_cache_size': 0, 'result_cache_size': 0}
+    
+    from vector_store import VectorStore, get_index_type
+    
+    size, k = case['size'], case['k']
+    encoder = SyntheticEncoder(case['dimension'], case['queries'], seed=case['seed'])
+    try:
+        store = VectorStore(model=encoder)
+        
+        # 构建：批量导入，需要训练的类型再迁移
+        start = time.perf_counter()
+        store.add_conversations_batch(({'summary': str(i)} for i in range(size)),
+                                      chunk_size=BLOCK_SIZE, persist=False)
+        if get_index_type(store.index) != case['index_type']:
+            store.migrate_index(case['index_type'])
+        store.save()
+        build_seconds = time.perf_counter() - start
+        rss_mb, peak_rss_mb = memory_mb()
+        
+        # 单线程延迟和召回率
+        latencies = []
+        found = []
+        for j in range(case['queries']):
+            start = time.perf_counter()
+            results = store.search(f"q{j}", k=k, fields=('summary',))
+            latencies.append(time.perf_counter() - start)
+            found.append([r['id'] for r in results])
+        truth = case['truth']
+        recall = np.mean([len(set(f) & set(t)) / k for f, t in zip(found, truth)])
+        
+        qps = {str(threads): measure_qps(store, case['queries'], k, threads, case['duration'])
+               for threads in case['threads']}
+        
+        # 单条写入（编码后的 add_conversation 路径，包含WAL fsync）
+        insert_latencies = []
+        for i in range(size, size + case['inserts']):
+            start = time.perf_counter()
+            store.add_conversation(str(i), [])
+            insert_latencies.append(time.perf_counter() - start)
+        
+        return {
+            'size': size,
+            'index_type': case['index_type'],
+            'build_seconds': build_seconds,
+            'index_bytes': os.path.getsize(store.index_path),
+            'rss_mb': rss_mb,
+            'peak_rss_mb': peak_rss_mb,
+            'latency_p50_ms': percentile_ms(latencies, 50),
+            'latency_p99_ms': percentile_ms(latencies, 99),
+            'qps': qps,
+            f'recall_at_{k}': float(recall),
+            'insert_p50_ms': percentile_ms(insert_latencies, 50) if insert_latencies else None,
+            'insert_p99_ms': percentile_ms(insert_latencies, 99) if insert_latencies else None,
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def parse_overrides(items):
+    """解析 --faiss key=value，value 按JSON解析，失败时作为字符串"""
+    overrides = {}
+    for item in items:
+        key, _, value = item.partition('=')
+        try:
+            overrides[key] = json.loads(value)
+        except json.JSONDecodeError:
+            overrides[key] = value
+    return overrides
+
+
+def main():
+    from vector_store import INDEX_TYPES
+    
+    parser = argparse.ArgumentParser(description='向量检索基准测试')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10000, 100000],
+                        help='数据量，可到 10000000（需要相应的内存和时间）')
+    parser.add_argument('--index-types', nargs='+', default=list(INDEX_TYPES), choices=INDEX_TYPES)
+    parser.add_argument('--dimension', type=int, default=config.EMBEDDING_CONFIG.get('vector_dimension') or 768,
+                        help='向量维度，默认使用配置中的 vector_dimension')
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--queries', type=int, default=200, help='测延迟和召回率的查询数')
+    parser.add_argument('--threads', nargs='+', type=int, default=[1, 2, 4, 8], help='测吞吐的线程数')
+    parser.add_argument('--duration', type=float, default=3.0, help='每个线程数测吞吐的秒数')
+    parser.add_argument('--inserts', type=int, default=200, help='测单条写入延迟的条数')
+    parser.add_argument('--faiss', nargs='*', default=[], metavar='KEY=VALUE',
+                        help='覆盖 FAISS_CONFIG 中的参数，如 nlist=4096 nprobe=32 ef_search=128')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='把结果写入JSON文件')
+    args = parser.parse_args()
+    
+    overrides = parse_overrides(args.faiss)
+    print(f"维度: {args.dimension}，查询: {args.queries} 条，k={args.k}，线程数: {args.threads}")
+    
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for size in args.sizes:
+        encoder = SyntheticEncoder(args.dimension, args.queries, seed=args.seed)
+        start = time.perf_counter()
+        truth = exact_neighbors(encoder, size, args.k).tolist()
+        print(f"\n数据量 {size}：精确检索基准耗时 {time.perf_counter() - start:.1f} 秒")
+        
+        for index_type in args.index_types:
+            case = {
+                'size': size,
+                'index_type': index_type,
+                'dimension': args.dimension,
+                'k': args.k,
+                'queries': args.queries,
+                'threads': args.threads,
+                'duration': args.duration,
+                'inserts': args.inserts,
+                'faiss': overrides,
+                'seed': args.seed,
+                'truth': truth,
+            }
+            try:
+                with context.Pool(1) as pool:
+                    result = pool.apply(run_case, (case,))
+            except Exception as e:
+                print(f"  {index_type}: 跳过（{e}）")
+                continue
+            results.append(result)
+            print(f"  {index_type}: 构建 {result['build_seconds']:.1f}s，"
+                  f"recall@{args.k} {result[f'recall_at_{args.k}']:.3f}，"
+                  f"p50 {result['latency_p50_ms']:.2f}ms，p99 {result['latency_p99_ms']:.2f}ms")
+    
+    print()
+    print(f"{'数据量':>10}{'索引':>8}{'构建(s)':>9}{'内存(MB)':>10}{'recall':>8}{'p50(ms)':>9}{'p99(ms)':>9}"
+          f"{'写入p50(ms)':>12}  QPS（线程数）")
+    for r in results:
+        qps = '  '.join(f"{threads}:{value:.0f}" for threads, value in r['qps'].items())
+        insert_p50 = r['insert_p50_ms'] if r['insert_p50_ms'] is not None else float('nan')
+        print(f"{r['size']:>10}{r['index_type']:>8}{r['build_seconds']:>9.1f}{r['rss_mb'] or 0:>10.0f}"
+              f"{r[f'recall_at_{args.k}']:>8.3f}{r['latency_p50_ms']:>9.2f}{r['latency_p99_ms']:>9.2f}"
+              f"{insert_p50:>12.2f}  {qps}")
+    
+    if args.output:
+        report = {
+            'environment': {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'faiss': getattr(faiss, '__version__', None),
+                'numpy': np.__version__,
+            },
+            'parameters': {
+                'dimension': args.dimension,
+                'k': args.k,
+                'queries': args.queries,
+                'threads': args.threads,
+                'duration': args.duration,
+                'inserts': args.inserts,
+                'seed': args.seed,
+                'faiss': dict(config.FAISS_CONFIG, **overrides),
+            },
+            'results': results,
+        }
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已写入: {args.output}")
+
+
+if __name__ == '__main__':
+    main()
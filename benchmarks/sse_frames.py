@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+SSE帧合并基准测试
+比较逐增量成帧（旧的写法：每个增量序列化整个事件字典）和不同合并窗口下，每条回复的帧数、字节数、
+生成并写出SSE帧的CPU时间，以及合并给每段内容带来的额外延迟
+
+上游的输出是合成的：每个增量1~3个汉字，间隔服从指数分布（--gap-ms 为平均间隔），同一个种子总是得到相同的流。
+时间用模拟时钟推进，不真的等待；帧通过本机TCP连接（TCP_NODELAY，与 uvicorn 相同）写出，
+每次写出一帧，写出次数即为数据包数的上限。CPU时间只统计写出线程。
+额外延迟按两种服务模式分别计算：同步模式缓存的内容在下一个增量到达时写出，异步模式在窗口结束时定时写出。
+
+用法:
+  python benchmarks/sse_frames.py
+  python benchmarks/sse_frames.py --windows-ms 0 10 20 30 50 --gap-ms 15 --deltas 600 --streams 500
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sse import FrameCoalescer
+
+CHARACTERS = '从前有一个小女孩她每天都会去河边看日落那里的风很温柔水面上闪着金色的光'
+
+
+class SimulatedClock:
+    def __init__(self):
+        self.now = 0.0
+    
+    def __call__(self):
+        return self.now
+
+
+def synthetic_stream(deltas, gap_ms, seed):
+    """
+    Returns:
+        list: [(到达时间（秒）, 内容), ...]
+    """
+    rng = random.Random(seed)
+    now = 0.0
+    stream = []
+    for _ in range(deltas):
+        stream.append((now, ''.join(rng.choice(CHARACTERS) for _ in range(rng.randint(1, 3)))))
+        now += rng.expovariate(1000 / gap_ms)
+    return stream
+
+
+def legacy_frame(text):
+    """合并之前的写法"""
+    return f"data: {json.dumps({'type': 'content', 'content': text}, ensure_ascii=False)}\n\n"
+
+
+def run_stream(stream, window, max_bytes, timer, sock):
+    """
+    按到达时间把增量交给合并器并写出帧
+    
+    Args:
+        window: 合并窗口（秒），为None时按旧的写法逐增量成帧
+        timer: 为True时按异步模式计算：缓存的内容在窗口结束时写出
+    
+    Returns:
+        tuple: (帧数, 字节数, 每段内容的额外延迟列表)
+    """
+    frames_written = 0
+    bytes_written = 0
+    delays = []
+    
+    def write(frames, at):
+        nonlocal frames_written, bytes_written
+        for frame in frames:
+            data = frame.encode('utf-8')
+            sock.sendall(data)
+            frames_written += 1
+            bytes_written += len(data)
+        # 缓存中的增量都在这一刻写出
+        delays.extend(at - arrived for arrived in waiting)
+        waiting.clear()
+    
+    waiting = []
+    if window is None:
+        for arrived, text in stream:
+            waiting.append(arrived)
+            write([legacy_frame(text)], arrived)
+        return frames_written, bytes_written, delays
+    
+    clock = SimulatedClock()
+    coalescer = FrameCoalescer(window=window, max_bytes=max_bytes, clock=clock)
+    for arrived, text in stream:
+        due = coalescer.due_in() if timer else None
+        if due is not None and clock.now + due <= arrived:
+            # 异步模式：窗口结束时定时写出
+            clock.now += max(due, 0)
+            frames = []
+            coalescer.flush(frames)
+            write(frames, clock.now)
+        clock.now = arrived
+        waiting.append(arrived)
+        frames = []
+        coalescer.content(text, frames)
+        if frames:
+            write(frames, arrived)
+    # 流结束
+    frames = []
+    coalescer.flush(frames)
+    write(frames, clock.now)
+    return frames_written, bytes_written, delays
+
+
+def connect():
+    """本机TCP连接，另一端的线程读出并丢弃数据"""
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    sender = socket.create_connection(server.getsockname())
+    sender.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    receiver, _ = server.accept()
+    server.close()
+    
+    def drain():
+        while receiver.recv(65536):
+            pass
+        receiver.close()
+    
+    thread = threading.Thread(target=drain, daemon=True)
+    thread.start()
+    return sender, thread
+
+
+def measure(streams, window, max_bytes, timer):
+    sender, drainer = connect()
+    frames = total_bytes = 0
+    delays = []
+    try:
+        start = time.thread_time()
+        for stream in streams:
+            f, b, d = run_stream(stream, window, max_bytes, timer, sender)
+            frames += f
+            total_bytes += b
+            delays.extend(d)
+        cpu = time.thread_time() - start
+    finally:
+        sender.close()
+        drainer.join()
+    delays.sort()
+    return {
+        'window_ms': None if window is None else window * 1000,
+        'mode': 'async' if timer else 'sync',
+        'frames_per_response': frames / len(streams),
+        'bytes_per_response': total_bytes / len(streams),
+        'cpu_ms_per_stream': cpu * 1000 / len(streams),
+        'delay_p50_ms': delays[len(delays) // 2] * 1000,
+        'delay_p99_ms': delays[int(len(delays) * 0.99)] * 1000,
+        'delay_max_ms': delays[-1] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SSE帧合并基准测试')
+    parser.add_argument('--windows-ms', nargs='+', type=float, default=[0, 10, 20, 30, 50],
+                        help='比较的合并窗口（毫秒）')
+    parser.add_argument('--max-bytes', type=int, default=1024, help='缓存内容达到多少字节时立即写出')
+    parser.add_argument('--deltas', type=int, default=400, help='每条回复的增量数')
+    parser.add_argument('--gap-ms', type=float, default=10, help='增量之间的平均间隔（毫秒）')
+    parser.add_argument('--streams', type=int, default=200, help='每种配置重复的回复数')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='把结果写入JSON文件')
+    args = parser.parse_args()
+    
+    streams = [synthetic_stream(args.deltas, args.gap_ms, f"{args.seed}-{n}") for n in range(args.streams)]
+    print(f"每条回复 {args.deltas} 个增量，平均间隔 {args.gap_ms} 毫秒，{args.streams} 条回复")
+    
+    results = [measure(streams, None, args.max_bytes, timer=False)]
+    for window_ms in args.windows_ms:
+        for timer in (False, True):
+            results.append(measure(streams, window_ms / 1000, args.max_bytes, timer))
+    
+    print()
+    print(f"{'窗口(ms)':>10}{'模式':>7}{'帧数/回复':>11}{'字节/回复':>11}{'CPU(ms)/流':>12}"
+          f"{'延迟p50(ms)':>13}{'p99(ms)':>9}{'max(ms)':>9}")
+    for r in results:
+        window = '逐增量(旧)' if r['window_ms'] is None else f"{r['window_ms']:g}"
+        print(f"{window:>10}{r['mode']:>7}{r['frames_per_response']:>11.1f}{r['bytes_per_response']:>11.0f}"
+              f"{r['cpu_ms_per_stream']:>12.3f}{r['delay_p50_ms']:>13.1f}{r['delay_p99_ms']:>9.1f}"
+              f"{r['delay_max_ms']:>9.1f}")
+    
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'args': vars(args), 'results': results}, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已写入: {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""
+缓存模块
+提供线程安全、带容量和过期时间限制的LRU缓存，以及合并并发相同请求的 SingleFlight
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    def __init__(self, maxsize=1024, ttl=None):
+        """
+        初始化缓存
+        
+        Args:
+            maxsize: 最多缓存的条目数，为0时不缓存
+            ttl: 条目的过期时间（秒），为None时不过期
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key, default=None):
+        """
+        读取缓存，命中时把条目移到最近使用的位置
+        
+        Returns:
+            缓存的值，未命中或已过期时返回default
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires_at = item
+                if expires_at is None or expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+    
+    def put(self, key, value):
+        """写入缓存，超出容量时淘汰最久未使用的条目"""
+        if self.maxsize <= 0:
+            return
+        
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+    
+    def clear(self):
+        """清空缓存（计数器保留）"""
+        with self._lock:
+            self._data.clear()
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def get_stats(self):
+        """
+        获取缓存统计信息
+        
+        Returns:
+            dict: 条目数、命中/未命中/淘汰次数和命中率
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / total if total else 0.0
+            }
+
+
+class SingleFlight:
+    """
+    合并并发的相同请求
+    
+    同一个键同时只有一个调用方（leader）真正执行，其余调用方等待并共享它的结果或异常。
+    """
+    
+    class Call:
+        """一次进行中的调用"""
+        
+        def __init__(self):
+            self.value = None
+            self.error = None
+            self._done = threading.Event()
+        
+        def result(self, timeout=None):
+            """等待leader完成，返回结果或抛出leader的异常"""
+            if not self._done.wait(timeout):
+                raise TimeoutError("等待合并的请求超时")
+            if self.error is not None:
+                raise self.error
+            return self.value
+    
+    def __init__(self):
+        self.coalesced = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+    
+    def claim(self, key):
+        """
+        登记一次调用
+        
+        Returns:
+            tuple: (Call, 是否为leader)；leader 执行完后必须调用 resolve
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+                return call, False
+            call = self._calls[key] = self.Call()
+            return call, True
+    
+    def resolve(self, key, value=None, error=None):
+        """leader 发布结果（或异常），唤醒所有等待的调用方"""
+        with self._lock:
+            call = self._calls.pop(key)
+        call.value = value
+        call.error = error
+        call._done.set()
+    
+    def do(self, key, fn):
+        """
+        执行 fn()，同一个键正在执行时等待并共享那一次的结果
+        
+        Returns:
+            fn 的返回值
+        """
+        call, leader = self.claim(key)
+        if not leader:
+            return call.result()
+        try:
+            value = fn()
+        except Exception as e:
+            self.resolve(key, error=e)
+            raise
+        self.resolve(key, value)
+        return value
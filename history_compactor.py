@@ -0,0 +1,191 @@
+"""
+对话历史压缩模块
+对话历史超过 token 预算时，把较早的对话折叠进每个会话缓存的滚动摘要：
+摘要只在后台生成一次并保存在会话中，之后每轮只发送摘要和最近几轮原文，提示词长度基本不再增长
+"""
+
+import hashlib
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from llm_client import get_client
+from logger import get_logger
+import config
+
+
+log = get_logger('历史压缩')
+
+SUMMARY_PROMPT = """下面是一段对话之前的摘要，以及摘要之后新发生的对话。请把它们合并成一段新的摘要。
+
+要求：
+1. 保留讲故事的人讲述的人物、事件、情感和关键细节，以及你的回应
+2. 按时间顺序，用第三人称简洁叙述，不超过{max_chars}字
+3. 只输出摘要本身，不要添加任何解释或标题
+
+之前的摘要：
+{summary}
+
+新的对话：
+{dialogue}
+
+新的摘要："""
+
+
+def format_dialogue(items):
+    """把对话历史格式化为提示词中的对话文本"""
+    return "\n".join(
+        f"{'讲故事的人' if item['role'] == 'user' else '你'}: {item['content']}"
+        for item in items
+    )
+
+
+def estimate_tokens(text):
+    """粗略估算 token 数：中日韩字符每个约1个，其余字符约4个一个"""
+    wide = sum(1 for char in text if ord(char) >= 0x2E80)
+    return wide + (len(text) - wide + 3) // 4
+
+
+def history_digest(items):
+    """对话历史前缀的指纹，用来确认缓存的摘要对应的是同一段对话"""
+    return hashlib.sha1(json.dumps(items, ensure_ascii=False, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class HistoryCompactor:
+    """
+    对话历史的滚动摘要
+    
+    会话数据中保存 history_summary = {'text': 摘要, 'covered': 已折叠的条数, 'digest': 这些条目的指纹}。
+    view 在构建提示词时使用已有的摘要（不调用大模型）；
+    schedule 在一轮对话结束后在后台检查预算，超出时把最近 keep_recent 条之前的对话折叠进摘要。
+    """
+    
+    def __init__(self, session_store, history_config=None):
+        """
+        Args:
+            session_store: 会话存储，摘要保存在会话数据中
+            history_config: 压缩配置，为None时读取 HISTORY_CONFIG
+        """
+        history_config = history_config or getattr(config, 'HISTORY_CONFIG', {})
+        self.session_store = session_store
+        self.token_budget = history_config.get('token_budget', 1200)
+        self.keep_recent = history_config.get('keep_recent', 6)
+        self.summary_max_chars = history_config.get('summary_max_chars', 300)
+        self.compactions = 0
+        self.errors = 0
+        self._running = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=history_config.get('workers', 2),
+                                            thread_name_prefix='history-compactor')
+    
+    def _cached_summary(self, session_id, history):
+        """
+        读取与这段对话历史一致的摘要
+        
+        Returns:
+            tuple: (摘要文本, 已折叠的条数)；没有摘要或历史已经变化时为 ('', 0)
+        """
+        data = self.session_store.get(session_id) or {}
+        summary = data.get('history_summary')
+        if not summary or summary['covered'] > len(history):
+            return '', 0
+        if history_digest(history[:summary['covered']]) != summary['digest']:
+            return '', 0
+        return summary['text'], summary['covered']
+    
+    def view(self, session_id, history):
+        """
+        构建提示词用的对话历史
+        
+        Returns:
+            tuple: (之前对话的摘要，没有时为空字符串, 摘要之后的对话历史)
+        """
+        if not history:
+            return '', history
+        text, covered = self._cached_summary(session_id, history)
+        return text, history[covered:]
+    
+    def schedule(self, session_id, history):
+        """一轮对话结束后调用：在后台检查预算并在需要时更新摘要（同一会话同时只有一个任务）"""
+        if not history:
+            return
+        with self._lock:
+            if session_id in self._running:
+                return
+            self._running.add(session_id)
+        self._executor.submit(self._compact_safely, session_id, list(history))
+    
+    def _compact_safely(self, session_id, history):
+        try:
+            self.compact(session_id, history)
+        except Exception as e:
+            with self._lock:
+                self.errors += 1
+            log.error(f'压缩对话历史失败: {e}', session_id=session_id, exc_info=True)
+        finally:
+            with self._lock:
+                self._running.discard(session_id)
+    
+    def compact(self, session_id, history):
+        """
+        摘要之后的对话超出预算时，把除最近 keep_recent 条以外的对话折叠进摘要
+        
+        Returns:
+            bool: 是否更新了摘要
+        """
+        text, covered = self._cached_summary(session_id, history)
+        remaining = history[covered:]
+        if estimate_tokens(format_dialogue(remaining)) <= self.token_budget:
+            return False
+        fold = remaining[:len(remaining) - self.keep_recent] if self.keep_recent else remaining
+        if not fold:
+            return False
+        
+        new_text = self._summarize(text, fold)
+        new_covered = covered + len(fold)
+        summary = {'text': new_text, 'covered': new_covered, 'digest': history_digest(history[:new_covered])}
+        
+        def apply(data):
+            # 并发时只保留覆盖更多对话的摘要；已有的摘要属于另一段对话（会话被重置后）时直接替换
+            current = data.get('history_summary')
+            if (current is None or current['covered'] < new_covered or current['covered'] > len(history)
+                    or history_digest(history[:current['covered']]) != current['digest']):
+                data['history_summary'] = summary
+        self.session_store.update(session_id, apply)
+        
+        with self._lock:
+            self.compactions += 1
+        log.info('对话历史已压缩', session_id=session_id, folded=len(fold), covered=new_covered,
+                 summary_chars=len(new_text))
+        return True
+    
+    def _summarize(self, summary, items):
+        """调用大模型合并旧摘要和新对话（非流式，关闭思考以缩短耗时）"""
+        prompt = SUMMARY_PROMPT.format(max_chars=self.summary_max_chars, summary=summary or '暂无',
+                                       dialogue=format_dialogue(items))
+        response = get_client().chat.completions.create(
+            model=config.ZHIPUAI_CONFIG['model'],
+            messages=[{"role": "user", "content": prompt}],
+            stream=False,
+            max_tokens=self.summary_max_chars * 2,
+            temperature=0.3,
+            thinking={"type": "disabled"},
+        )
+        text = (response.choices[0].message.content or '').strip()
+        if not text:
+            raise ValueError('摘要结果为空')
+        return text
+    
+    def get_stats(self):
+        """
+        获取统计信息
+        
+        Returns:
+            dict: 预算、压缩次数、失败次数和正在进行的任务数
+        """
+        with self._lock:
+            return {
+                'token_budget': self.token_budget,
+                'compactions': self.compactions,
+                'errors': self.errors,
+                'running': len(self._running),
+            }
@@ -6,10 +6,13 @@
 
 import os
 import sys
+import json
+import time
+import shutil
 import faiss
-import pickle
 import config
-from vector_store import VectorStore
+from vector_store import (VectorStore, MetadataStore, create_empty_index, get_index_type, INDEX_TYPES,
+                          add_ids, list_shards, shard_paths)
 
 
 def init_database(force=False):
@@ -19,6 +22,9 @@ def init_database(force=False):
     Args:
         force: 如果为True，即使文件已存在也会覆盖
     """
+    if config.FAISS_CONFIG.get('shard_by'):
+        return init_sharded_database(force)
+    
     index_path = config.FAISS_CONFIG['index_path']
     metadata_path = config.FAISS_CONFIG['metadata_path']
     
@@ -47,30 +53,32 @@ def init_database(force=False):
         
         # 创建新的FAISS索引
         print("2. 创建FAISS索引...")
-        index = faiss.IndexFlatL2(dimension)
-        print(f"   ✓ 索引创建成功")
+        index = add_ids(create_empty_index(dimension))
+        print(f"   ✓ 索引创建成功，类型: {get_index_type(index)}")
         
-        # 创建空的元数据列表
+        # 创建空的元数据记录文件
         print("3. 创建元数据文件...")
-        metadata = []
-        print(f"   ✓ 元数据初始化成功")
+        for path in (metadata_path, f"{metadata_path}-wal", f"{metadata_path}-shm"):
+            if os.path.exists(path):
+                os.remove(path)
+        MetadataStore(metadata_path).close()
+        print(f"   ✓ 元数据已保存到: {metadata_path}")
         
-        # 保存索引和元数据
+        # 保存索引
         print("4. 保存到磁盘...")
         faiss.write_index(index, index_path)
         print(f"   ✓ 索引已保存到: {index_path}")
         
-        with open(metadata_path, 'wb') as f:
-            pickle.dump(metadata, f)
-        print(f"   ✓ 元数据已保存到: {metadata_path}")
+        # 清空旧的WAL，避免下次启动时把旧记录重放进新库
+        vector_store.wal.truncate()
+        print(f"   ✓ WAL已清空: {vector_store.wal_path}")
         
         # 验证初始化结果
         print("\n5. 验证初始化结果...")
         if os.path.exists(index_path) and os.path.exists(metadata_path):
             # 重新加载验证
             loaded_index = faiss.read_index(index_path)
-            with open(metadata_path, 'rb') as f:
-                loaded_metadata = pickle.load(f)
+            loaded_metadata = MetadataStore(metadata_path)
             
             print(f"   ✓ 索引向量数量: {loaded_index.ntotal}")
             print(f"   ✓ 元数据条目数: {len(loaded_metadata)}")
@@ -92,8 +100,274 @@ def init_database(force=False):
         return False
 
 
+def init_sharded_database(force=False):
+    """
+    初始化按时间分片的向量数据库：删除分片目录和未分片的旧文件，创建当前周期的空分片
+    
+    Args:
+        force: 如果为True，即使文件已存在也会覆盖
+    """
+    faiss_config = config.FAISS_CONFIG
+    shard_dir = faiss_config.get('shard_dir', 'vector_shards')
+    index_path = faiss_config['index_path']
+    metadata_path = faiss_config['metadata_path']
+    wal_path = faiss_config.get('wal_path') or f"{index_path}.wal"
+    
+    shards = list_shards(shard_dir)
+    # 未分片的旧文件会在首次启用分片时被移入分片，初始化时一并删除
+    legacy_files = [path for path in (index_path, wal_path, metadata_path,
+                                      f"{metadata_path}-wal", f"{metadata_path}-shm")
+                    if os.path.exists(path)]
+    
+    if (shards or legacy_files) and not force:
+        print(f"警告：数据库文件已存在！")
+        print(f"  - 分片目录: {shard_dir}（{len(shards)} 个分片）")
+        for path in legacy_files:
+            print(f"  - 未分片文件: {path}")
+        
+        response = input("\n是否要覆盖现有数据库？(yes/no): ").strip().lower()
+        if response not in ['yes', 'y']:
+            print("操作已取消。")
+            return False
+    
+    try:
+        print("\n正在初始化向量数据库...")
+        
+        print("1. 删除旧数据...")
+        if os.path.exists(shard_dir):
+            shutil.rmtree(shard_dir)
+        for path in legacy_files:
+            os.remove(path)
+        print(f"   ✓ 已删除 {len(shards)} 个分片和 {len(legacy_files)} 个未分片文件")
+        
+        print("2. 加载embedding模型并创建分片...")
+        vector_store = VectorStore()
+        vector_store.save()
+        print(f"   ✓ 向量维度: {vector_store.dimension}")
+        print(f"   ✓ 当前分片: {vector_store.shards[-1].key}，索引已保存到: {vector_store.index_path}")
+        
+        print("\n✅ 数据库初始化成功！")
+        return True
+    except FileNotFoundError as e:
+        print(f"\n❌ 错误：找不到模型文件")
+        print(f"   请检查 config.py 中的模型路径配置")
+        print(f"   错误详情: {e}")
+        return False
+    except Exception as e:
+        print(f"\n❌ 初始化失败：{e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def migrate_database(index_type=None):
+    """
+    把现有索引迁移到指定类型（默认读取 config.FAISS_CONFIG['index_type']）
+    
+    Args:
+        index_type: 目标索引类型
+    """
+    index_type = index_type or config.FAISS_CONFIG.get('index_type', 'flat')
+    if index_type not in INDEX_TYPES:
+        print(f"\n❌ 不支持的索引类型: {index_type}，可选: {', '.join(INDEX_TYPES)}")
+        return False
+    
+    try:
+        print(f"\n正在迁移索引到 {index_type}...")
+        vector_store = VectorStore()
+        print(f"   当前类型: {get_index_type(vector_store.index)}，向量数量: {vector_store.get_count()}")
+        
+        start = time.time()
+        vector_store.migrate_index(index_type)
+        print(f"   ✓ 迁移完成，耗时 {time.time() - start:.1f} 秒")
+        if vector_store.shard_by:
+            print(f"   ✓ {len(vector_store.shards)} 个分片已保存到: {vector_store.shard_dir}")
+        else:
+            print(f"   ✓ 索引已保存到: {vector_store.index_path}")
+        
+        if config.FAISS_CONFIG.get('index_type', 'flat') != index_type:
+            print(f"\n提示：请把 config.py 中的 FAISS_CONFIG['index_type'] 改为 '{index_type}'")
+        return True
+    except Exception as e:
+        print(f"\n❌ 迁移失败：{e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def _read_import_progress(progress_path, store_count):
+    """
+    读取导入进度，返回已经持久化的输入行数
+    
+    检查点和写进度文件之间崩溃时，进度文件里是 pending 状态，
+    根据当前向量数判断那一段是否已经保存，避免重复导入。
+    """
+    if not os.path.exists(progress_path):
+        return 0, False
+    with open(progress_path, 'r', encoding='utf-8') as f:
+        progress = json.load(f)
+    
+    pending = progress.get('pending')
+    if pending and store_count == pending['store_count']:
+        return pending['lines_done'], False
+    return progress.get('lines_done', 0), progress.get('completed', False)
+
+
+def _write_import_progress(progress_path, progress):
+    tmp_path = f"{progress_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(progress, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, progress_path)
+
+
+def import_conversations(path, batch_size=1024, checkpoint_every=10000, restart=False):
+    """
+    从JSONL文件批量导入对话总结
+    
+    每行一个JSON对象：{"summary": "...", "conversation": [...], "timestamp": "..."}，
+    只有 summary 是必需的。每导入 checkpoint_every 行做一次检查点并记录进度到 path + '.progress'，
+    中途失败后重新运行同一命令会从上次检查点继续。
+    
+    Args:
+        path: JSONL文件路径
+        batch_size: 每批编码的条数
+        checkpoint_every: 每多少行做一次检查点
+        restart: 忽略已有进度，从头导入
+    """
+    if not os.path.exists(path):
+        print(f"\n❌ 文件不存在: {path}")
+        return False
+    
+    progress_path = f"{path}.progress"
+    if restart and os.path.exists(progress_path):
+        os.remove(progress_path)
+    
+    try:
+        print(f"\n正在从 {path} 导入...")
+        vector_store = VectorStore()
+        lines_done, completed = _read_import_progress(progress_path, vector_store.get_count())
+        if completed:
+            print(f"   该文件已经导入完成（{lines_done} 行），如需重新导入请加 --restart")
+            return True
+        if lines_done:
+            print(f"   从第 {lines_done + 1} 行继续导入")
+        
+        start = time.time()
+        imported = 0
+        skipped = 0
+        
+        def read_items(f, line_offset):
+            """逐行读取，跳过无效行"""
+            nonlocal skipped
+            for line_no, line in enumerate(f, start=line_offset + 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    item = json.loads(line)
+                except json.JSONDecodeError as e:
+                    print(f"   ⚠ 第 {line_no} 行不是有效的JSON，已跳过: {e}")
+                    skipped += 1
+                    continue
+                if not isinstance(item, dict) or not item.get('summary'):
+                    print(f"   ⚠ 第 {line_no} 行缺少 summary，已跳过")
+                    skipped += 1
+                    continue
+                yield item
+        
+        def report(added):
+            elapsed = time.time() - start
+            rate = (imported + added) / elapsed if elapsed > 0 else 0
+            print(f"   已导入 {imported + added} 条，{rate:.0f} 条/秒")
+        
+        with open(path, 'r', encoding='utf-8') as f:
+            for _ in range(lines_done):
+                f.readline()
+            
+            while True:
+                # 每段读取 checkpoint_every 行，整段添加后做一次检查点
+                segment = [f.readline() for _ in range(checkpoint_every)]
+                segment = [line for line in segment if line]
+                if not segment:
+                    break
+                
+                added = vector_store.add_conversations_batch(
+                    read_items(segment, lines_done), chunk_size=batch_size,
+                    persist=False, progress=report
+                )
+                
+                # 先记下“这一段保存后向量数应为多少”，再做检查点，最后确认进度
+                previous = {'lines_done': lines_done}
+                _write_import_progress(progress_path, dict(previous, pending={
+                    'lines_done': lines_done + len(segment),
+                    'store_count': vector_store.get_count()
+                }))
+                vector_store.save()
+                lines_done += len(segment)
+                imported += added
+                _write_import_progress(progress_path, {'lines_done': lines_done})
+        
+        _write_import_progress(progress_path, {'lines_done': lines_done, 'completed': True})
+        print(f"   ✓ 导入完成：新增 {imported} 条，跳过 {skipped} 行，耗时 {time.time() - start:.1f} 秒")
+        print(f"   ✓ 当前向量总数: {vector_store.get_count()}")
+        return True
+    except Exception as e:
+        print(f"\n❌ 导入失败：{e}")
+        print(f"   已保存的进度记录在 {progress_path}，重新运行同一命令即可继续")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
+def _get_int_option(name, default):
+    """读取形如 --name N 的整数参数"""
+    if name in sys.argv:
+        position = sys.argv.index(name)
+        if position + 1 < len(sys.argv):
+            return int(sys.argv[position + 1])
+    return default
+
+
+def show_shard_info():
+    """显示按时间分片的数据库信息"""
+    shard_dir = config.FAISS_CONFIG.get('shard_dir', 'vector_shards')
+    shards = list_shards(shard_dir)
+    
+    print("\n当前数据库状态：")
+    print(f"  分片目录: {shard_dir}（按 {config.FAISS_CONFIG['shard_by']} 分片）")
+    
+    if not shards:
+        print("\n  还没有分片，需要初始化（已有的未分片数据会在首次启动时移入分片）")
+        return
+    
+    total = 0
+    print(f"\n  {'分片':<12}{'索引类型':<10}{'向量数':>10}{'已删除':>8}  状态")
+    for key in shards:
+        index_path, metadata_path, wal_path = shard_paths(shard_dir, key)
+        try:
+            index = faiss.read_index(index_path)
+            deleted = len(MetadataStore(metadata_path).tombstones())
+            count = index.ntotal - deleted
+            total += count
+            # 只有可写分片（和封存未完成的分片）保留WAL
+            state = f"可写，WAL {os.path.getsize(wal_path)} 字节" if os.path.exists(wal_path) else "已封存"
+            print(f"  {key:<12}{get_index_type(index):<10}{count:>10}{deleted:>8}  {state}")
+        except Exception as e:
+            print(f"  {key:<12}读取出错: {e}")
+    print(f"\n  分片数: {len(shards)}，向量总数: {total}")
+    
+    latest = MetadataStore(shard_paths(shard_dir, shards[-1])[1]).latest()
+    if latest:
+        print(f"  最新条目时间: {latest.get('timestamp', 'N/A')}")
+
+
 def show_database_info():
     """显示当前数据库信息"""
+    if config.FAISS_CONFIG.get('shard_by'):
+        return show_shard_info()
+    
     index_path = config.FAISS_CONFIG['index_path']
     metadata_path = config.FAISS_CONFIG['metadata_path']
     
@@ -104,14 +378,20 @@ def show_database_info():
     if os.path.exists(index_path) and os.path.exists(metadata_path):
         try:
             index = faiss.read_index(index_path)
-            with open(metadata_path, 'rb') as f:
-                metadata = pickle.load(f)
+            metadata = MetadataStore(metadata_path)
             
-            print(f"\n  索引向量数量: {index.ntotal}")
+            print(f"\n  索引类型: {get_index_type(index)}")
+            print(f"  索引向量数量: {index.ntotal}")
             print(f"  元数据条目数: {len(metadata)}")
+            print(f"  已删除待压缩: {len(metadata.tombstones())}")
+            
+            wal_path = config.FAISS_CONFIG.get('wal_path') or f"{index_path}.wal"
+            if os.path.exists(wal_path):
+                print(f"  WAL大小: {os.path.getsize(wal_path)} 字节（启动时重放）")
             
-            if len(metadata) > 0:
-                print(f"\n  最新条目时间: {metadata[-1].get('timestamp', 'N/A')}")
+            latest = metadata.latest()
+            if latest:
+                print(f"\n  最新条目时间: {latest.get('timestamp', 'N/A')}")
         except Exception as e:
             print(f"  读取数据库时出错: {e}")
     else:
@@ -130,26 +410,45 @@ def main():
     # 解析命令行参数
     force = '--force' in sys.argv or '-f' in sys.argv
     
-    if len(sys.argv) > 1 and sys.argv[1] not in ['--force', '-f', '--info', '-i']:
+    if len(sys.argv) > 1 and sys.argv[1] not in ['--force', '-f', '--info', '-i', '--migrate', '-m', 'import'] \
+            or sys.argv[1:2] == ['import'] and len(sys.argv) < 3:
         print(f"\n用法:")
-        print(f"  python init_db.py          # 交互式初始化")
-        print(f"  python init_db.py --force   # 强制覆盖现有数据库")
-        print(f"  python init_db.py --info    # 仅显示数据库信息")
+        print(f"  python init_db.py                 # 交互式初始化")
+        print(f"  python init_db.py --force         # 强制覆盖现有数据库")
+        print(f"  python init_db.py --info          # 仅显示数据库信息")
+        print(f"  python init_db.py --migrate [类型] # 迁移索引类型（flat/ivf/hnsw/ivfpq）")
+        print(f"  python init_db.py import 文件.jsonl [--batch-size 1024] [--checkpoint-every 10000] [--restart]")
+        print(f"                                    # 批量导入对话总结，失败后重新运行可续传")
         return
     
     if '--info' in sys.argv or '-i' in sys.argv:
         return
     
-    # 执行初始化
-    success = init_database(force=force)
+    if sys.argv[1:2] in (['--migrate'], ['-m']):
+        # 执行索引迁移
+        success = migrate_database(sys.argv[2] if len(sys.argv) > 2 else None)
+        action = "迁移"
+    elif sys.argv[1:2] == ['import']:
+        # 执行批量导入
+        success = import_conversations(
+            sys.argv[2],
+            batch_size=_get_int_option('--batch-size', 1024),
+            checkpoint_every=_get_int_option('--checkpoint-every', 10000),
+            restart='--restart' in sys.argv
+        )
+        action = "导入"
+    else:
+        # 执行初始化
+        success = init_database(force=force)
+        action = "初始化"
     
     if success:
         print("\n" + "=" * 60)
-        print("初始化完成！现在可以启动应用了。")
+        print(f"{action}完成！现在可以启动应用了。")
         print("=" * 60)
     else:
         print("\n" + "=" * 60)
-        print("初始化失败，请检查错误信息。")
+        print(f"{action}失败，请检查错误信息。")
         print("=" * 60)
         sys.exit(1)
 
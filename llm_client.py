@@ -0,0 +1,198 @@
+"""
+大模型客户端模块
+进程内共享一个 ZhipuAiClient，底层的 httpx 连接池保持长连接，
+请求不再各自建立TCP/TLS连接；同时统计连接级指标
+"""
+
+import json
+import threading
+import time
+import httpx
+from zai import ZhipuAiClient
+from zai.core import construct_type
+from zai.types.chat.chat_completion_chunk import ChatCompletionChunk
+import config
+
+
+class ConnectionStats:
+    """
+    连接级统计
+    
+    通过 httpcore 的 trace 回调记录新建的TCP连接、TLS握手和建连耗时，
+    复用已有连接的请求数 = 请求数 - 新建连接数 - 建连失败数。
+    """
+    
+    def __init__(self):
+        self.requests = 0
+        self.connections = 0
+        self.tls_handshakes = 0
+        self.connect_failures = 0
+        self.connect_seconds = 0.0
+        self._lock = threading.Lock()
+    
+    def on_request(self, request):
+        """httpx 请求钩子：计数并给请求挂上 trace 回调"""
+        started = self._count_request()
+        
+        def trace(event_name, info):
+            self._record(started, event_name)
+        request.extensions['trace'] = trace
+    
+    async def on_request_async(self, request):
+        """httpx.AsyncClient 的请求钩子，异步接口要求 trace 回调也是协程函数"""
+        started = self._count_request()
+        
+        async def trace(event_name, info):
+            self._record(started, event_name)
+        request.extensions['trace'] = trace
+    
+    def _count_request(self):
+        """请求计数，返回记录本请求各建连步骤开始时间的字典"""
+        with self._lock:
+            self.requests += 1
+        return {}
+    
+    def _record(self, started, event_name):
+        """处理 httpcore 的事件，事件名形如 connection.connect_tcp.started / complete / failed"""
+        step, _, phase = event_name.rpartition('.')
+        if step not in ('connection.connect_tcp', 'connection.start_tls'):
+            return
+        
+        now = time.perf_counter()
+        if phase == 'started':
+            started[step] = now
+            return
+        
+        elapsed = now - started.pop(step, now)
+        with self._lock:
+            if phase == 'failed':
+                self.connect_failures += 1
+            elif phase == 'complete':
+                if step == 'connection.connect_tcp':
+                    self.connections += 1
+                else:
+                    self.tls_handshakes += 1
+            self.connect_seconds += elapsed
+    
+    def stats(self):
+        """
+        获取统计信息
+        
+        Returns:
+            dict: 请求数、新建连接数、复用连接的请求数、TLS握手数、建连失败数和平均建连耗时
+        """
+        with self._lock:
+            attempts = self.connections + self.connect_failures
+            return {
+                'requests': self.requests,
+                'connections': self.connections,
+                'reused_requests': max(self.requests - attempts, 0),
+                'tls_handshakes': self.tls_handshakes,
+                'connect_failures': self.connect_failures,
+                'avg_connect_ms': round(self.connect_seconds / attempts * 1000, 2) if attempts else 0.0,
+            }
+
+
+connection_stats = ConnectionStats()
+_client = None
+_async_client = None
+_client_lock = threading.Lock()
+
+
+def _pool_options():
+    """同步和异步客户端共用的连接池上限和超时配置"""
+    zhipuai_config = config.ZHIPUAI_CONFIG
+    pool_size = zhipuai_config.get('pool_size', 20)
+    return {
+        'limits': httpx.Limits(max_connections=pool_size,
+                               max_keepalive_connections=pool_size,
+                               keepalive_expiry=zhipuai_config.get('keepalive_expiry', 60)),
+        # 流式输出时 read 是两个数据块之间的最长间隔
+        'timeout': httpx.Timeout(zhipuai_config.get('read_timeout', 120),
+                                 connect=zhipuai_config.get('connect_timeout', 5)),
+    }
+
+
+def create_client():
+    """
+    根据 ZHIPUAI_CONFIG 创建带连接池的客户端
+    
+    Returns:
+        ZhipuAiClient: 使用自定义 httpx.Client 的客户端
+    """
+    zhipuai_config = config.ZHIPUAI_CONFIG
+    http_client = httpx.Client(event_hooks={'request': [connection_stats.on_request]}, **_pool_options())
+    return ZhipuAiClient(api_key=zhipuai_config['api_key'],
+                         base_url=zhipuai_config.get('base_url'),
+                         http_client=http_client)
+
+
+def get_client():
+    """
+    获取进程内共享的客户端（首次调用时创建，线程安全）
+    
+    Returns:
+        ZhipuAiClient: 共享的客户端
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = create_client()
+    return _client
+
+
+def close_client():
+    """关闭共享的客户端和它的连接池，下次 get_client 时重新创建"""
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
+
+
+def get_async_http_client():
+    """
+    获取异步服务模式使用的 httpx.AsyncClient（首次调用时创建）
+    
+    需要在同一个事件循环中使用。
+    """
+    global _async_client
+    if _async_client is None:
+        _async_client = httpx.AsyncClient(event_hooks={'request': [connection_stats.on_request_async]},
+                                          **_pool_options())
+    return _async_client
+
+
+async def stream_chat_completion(**params):
+    """
+    异步调用流式对话补全接口
+    
+    zai SDK 只提供同步客户端，这里沿用它的接口地址和认证头，用 httpx.AsyncClient 发请求并解析SSE，
+    等待上游数据时不占用线程。
+    
+    Args:
+        **params: 与 client.chat.completions.create 相同的请求参数（model、messages、thinking 等）
+    
+    Yields:
+        ChatCompletionChunk: 与 SDK 流式返回相同类型的数据块
+    """
+    client = get_client()
+    url = f"{str(client.base_url).rstrip('/')}/chat/completions"
+    headers = {**client.auth_headers, 'Accept': 'text/event-stream'}
+    async with get_async_http_client().stream('POST', url, json={**params, 'stream': True},
+                                              headers=headers) as response:
+        if response.status_code != 200:
+            body = (await response.aread()).decode('utf-8', errors='replace')
+            raise RuntimeError(f"大模型接口返回 {response.status_code}: {body[:200]}")
+        
+        async for line in response.aiter_lines():
+            if not line.startswith('data:'):
+                continue
+            data = line[len('data:'):].strip()
+            if data.startswith('[DONE]'):
+                break
+            payload = json.loads(data)
+            if payload.get('error'):
+                raise RuntimeError(f"大模型接口错误: {payload['error']}")
+            yield construct_type(type_=ChatCompletionChunk, value=payload)
@@ -0,0 +1,168 @@
+"""
+日志模块
+分级的结构化日志：调用方只把记录放进队列，由后台线程格式化并写出，请求线程不做标准输出I/O；
+级别未开启时在调用处直接返回，逐个数据块的调试日志还可以按间隔采样
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+from datetime import datetime
+import config
+
+
+# 所有模块日志的父记录器，级别和输出在这里统一配置
+ROOT_NAME = 'app'
+
+# logging.LogRecord 的标准参数，其余关键字参数都作为结构化字段
+_LOG_KWARGS = ('exc_info', 'stack_info', 'stacklevel', 'extra')
+
+_setup_lock = threading.Lock()
+_handler = None
+_listener = None
+_chunk_sample_every = 20
+
+
+class StructuredLogger(logging.LoggerAdapter):
+    """
+    带结构化字段的记录器
+    
+    用法: log.info('保存总结', chars=120, session_id=sid)，关键字参数作为字段输出。
+    级别未开启时 LoggerAdapter 在处理参数之前就返回。
+    """
+    
+    def process(self, msg, kwargs):
+        fields = {key: kwargs.pop(key) for key in list(kwargs) if key not in _LOG_KWARGS}
+        if fields:
+            kwargs['extra'] = {**kwargs.get('extra', {}), 'fields': fields}
+        return msg, kwargs
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """入队的日志处理器：队列满时丢弃记录并计数，不阻塞请求线程"""
+    
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+    
+    def prepare(self, record):
+        # 消息和字段的格式化留给后台线程；只有异常堆栈需要在这里先格式化（之后栈帧会变化）
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+    
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class TextFormatter(logging.Formatter):
+    """文本格式：时间 级别 【模块】消息 字段=值 ..."""
+    
+    def format(self, record):
+        line = f"{self.formatTime(record)} {record.levelname:<7} 【{module_name(record)}】{record.getMessage()}"
+        fields = getattr(record, 'fields', None)
+        if fields:
+            line += ' ' + ' '.join(f"{key}={format_value(value)}" for key, value in fields.items())
+        if record.exc_text:
+            line += '\n' + record.exc_text
+        return line
+
+
+class JSONFormatter(logging.Formatter):
+    """JSON格式：每条日志一行，便于日志系统采集"""
+    
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'module': module_name(record),
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def module_name(record):
+    """记录器名去掉公共前缀，如 app.对话接口 -> 对话接口"""
+    return record.name.partition('.')[2] or record.name
+
+
+def format_value(value):
+    """文本格式中字段值的表示：字符串加引号，容器转成JSON"""
+    if isinstance(value, str):
+        return repr(value)
+    if isinstance(value, (dict, list, tuple)):
+        return json.dumps(value, ensure_ascii=False, default=str)
+    return str(value)
+
+
+def setup_logging(log_config=None):
+    """
+    根据配置初始化日志（只执行一次，get_logger 首次调用时自动执行）
+    
+    Args:
+        log_config: 日志配置，为None时读取 LOG_CONFIG
+    """
+    global _handler, _listener, _chunk_sample_every
+    with _setup_lock:
+        if _handler is not None:
+            return
+        log_config = log_config or getattr(config, 'LOG_CONFIG', {})
+        _chunk_sample_every = log_config.get('chunk_sample_every', 20)
+        
+        output = logging.StreamHandler(sys.stdout)
+        output.setFormatter(JSONFormatter() if log_config.get('format') == 'json' else TextFormatter())
+        _handler = DroppingQueueHandler(queue.Queue(log_config.get('queue_size', 10000)))
+        _listener = logging.handlers.QueueListener(_handler.queue, output)
+        _listener.start()
+        # 退出前写完队列中剩余的日志
+        atexit.register(_listener.stop)
+        
+        root = logging.getLogger(ROOT_NAME)
+        root.setLevel(log_config.get('level', 'INFO'))
+        root.addHandler(_handler)
+        root.propagate = False
+
+
+def get_logger(name):
+    """
+    获取模块的记录器
+    
+    Args:
+        name: 模块名，如 '对话接口'，输出时作为【】中的前缀
+    """
+    setup_logging()
+    return StructuredLogger(logging.getLogger(f"{ROOT_NAME}.{name}"), {})
+
+
+def chunk_sample_every(log):
+    """
+    逐个数据块调试日志的采样间隔：DEBUG未开启时返回0（调用方据此跳过全部逐块日志）
+    
+    每条流开始时取一次，之后每个数据块只需判断一次整数。
+    """
+    return _chunk_sample_every if log.isEnabledFor(logging.DEBUG) else 0
+
+
+def get_stats():
+    """
+    获取统计信息
+    
+    Returns:
+        dict: 当前级别、队列中待写出的日志数和因队列满丢弃的日志数
+    """
+    return {
+        'level': logging.getLevelName(logging.getLogger(ROOT_NAME).getEffectiveLevel()),
+        'queued': _handler.queue.qsize() if _handler is not None else 0,
+        'dropped': _handler.dropped if _handler is not None else 0,
+    }
@@ -0,0 +1,292 @@
+"""
+指标模块
+进程内的计数器、仪表和直方图，/metrics 接口按 Prometheus 文本格式输出；
+热路径上记录一次只是一次二分查找和几次加法（持有一个不竞争的锁），约一微秒
+"""
+
+import bisect
+import threading
+import time
+from abc import ABC, abstractmethod
+from logger import get_logger
+
+
+log = get_logger('指标')
+
+# 耗时直方图的默认桶（秒）：覆盖从缓存命中（亚毫秒）到大模型长回复（分钟）
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def format_labels(labelnames, labelvalues, extra=()):
+    """生成 {name="value",...}，没有标签时返回空字符串"""
+    pairs = [*zip(labelnames, labelvalues), *extra]
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(ABC):
+    """指标基类：按标签值区分的多个子指标，子类必须实现 _new_child（否则创建实例时就会失败）"""
+    
+    type_name = None
+    
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self._new_child()
+            self._children[()] = self._default
+    
+    @abstractmethod
+    def _new_child(self):
+        """创建一个子指标"""
+    
+    def labels(self, *labelvalues):
+        """
+        获取某组标签值的子指标（第一次使用时创建）
+        
+        热路径上可以先取出子指标保存起来，避免每次查字典。
+        """
+        child = self._children.get(labelvalues)
+        if child is None:
+            if len(labelvalues) != len(self.labelnames):
+                raise ValueError(f"指标 {self.name} 需要标签 {self.labelnames}")
+            with self._lock:
+                child = self._children.setdefault(labelvalues, self._new_child())
+        return child
+    
+    def samples(self):
+        """
+        Yields:
+            tuple: (样本名后缀, 标签字符串, 值)
+        """
+        for labelvalues, child in list(self._children.items()):
+            yield from child.samples(self.labelnames, labelvalues)
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {format_value(value)}")
+        return '\n'.join(lines)
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+    
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+    
+    def samples(self, labelnames, labelvalues):
+        yield '_total', format_labels(labelnames, labelvalues), self.value
+
+
+class Counter(Metric):
+    """只增不减的计数器"""
+    
+    type_name = 'counter'
+    
+    def _new_child(self):
+        return _CounterChild()
+    
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+
+class _GaugeChild:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+    
+    def set(self, value):
+        self.value = value
+    
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+    
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+    
+    def samples(self, labelnames, labelvalues):
+        yield '', format_labels(labelnames, labelvalues), self.value
+
+
+class Gauge(Metric):
+    """
+    可增可减的仪表
+    
+    指定 function 时在每次输出时调用它取值（如会话数、索引大小），平时没有任何开销。
+    """
+    
+    type_name = 'gauge'
+    
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        self.function = function
+        super().__init__(name, documentation, labelnames)
+    
+    def _new_child(self):
+        return _GaugeChild()
+    
+    def set(self, value):
+        self._default.set(value)
+    
+    def inc(self, amount=1):
+        self._default.inc(amount)
+    
+    def dec(self, amount=1):
+        self._default.dec(amount)
+    
+    def samples(self):
+        if self.function is None:
+            yield from super().samples()
+            return
+        value = self.function()
+        if value is not None:
+            yield '', '', value
+
+
+class _Timer:
+    """with 块的耗时记入直方图"""
+    
+    __slots__ = ('child', 'started')
+    
+    def __init__(self, child):
+        self.child = child
+    
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.child.observe(time.perf_counter() - self.started)
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # 每个桶单独计数，输出时再累加成 Prometheus 要求的累计值；最后一个是 +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+    
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+    
+    def time(self):
+        """
+        计时上下文管理器
+        
+        用法: with histogram.time(): ...
+        """
+        return _Timer(self)
+    
+    def samples(self, labelnames, labelvalues):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = 0
+        for bound, count in zip((*self.buckets, float('inf')), counts):
+            cumulative += count
+            yield '_bucket', format_labels(labelnames, labelvalues, [('le', format_value(bound))]), cumulative
+        yield '_sum', format_labels(labelnames, labelvalues), total
+        yield '_count', format_labels(labelnames, labelvalues), cumulative
+
+
+class Histogram(Metric):
+    """直方图：按桶统计观测值的分布，以及总和与次数"""
+    
+    type_name = 'histogram'
+    
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+    
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+    
+    def observe(self, value):
+        self._default.observe(value)
+    
+    def time(self):
+        return self._default.time()
+
+
+class Registry:
+    """指标注册表，按注册顺序输出"""
+    
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+    
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"指标已存在: {metric.name}")
+            self._metrics[metric.name] = metric
+        return metric
+    
+    def render(self):
+        """
+        输出 Prometheus 文本格式（text/plain; version=0.0.4）
+        
+        取值失败的指标只跳过它自己。
+        """
+        blocks = []
+        for metric in list(self._metrics.values()):
+            try:
+                blocks.append(metric.render())
+            except Exception as e:
+                log.error(f'输出指标 {metric.name} 失败: {e}')
+        return '\n'.join(blocks) + '\n'
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=(), function=None):
+    return REGISTRY.register(Gauge(name, documentation, labelnames, function))
+
+
+def histogram(name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+# 各模块共用的指标；取值依赖运行时对象的仪表（会话数、索引大小）在 app.py 中注册
+SEARCH_SECONDS = histogram('memory_search_seconds', '记忆检索耗时（含缓存命中）')
+ENCODE_SECONDS = histogram('embedding_encode_seconds', 'embedding 编码一批文本的耗时')
+ADD_SECONDS = histogram('vector_store_add_seconds', 'add_conversation / add_conversations 耗时（编码+写入，一批记一次）')
+SAVE_SECONDS = histogram('vector_store_save_seconds', '向量库检查点（保存索引和元数据，含后台检查点）耗时')
+BACKUP_SECONDS = histogram('backup_seconds', '一次备份的耗时')
+BACKUP_BYTES = gauge('backup_size_bytes', '最近一次备份的文件总大小')
+FIRST_TOKEN_SECONDS = histogram('llm_time_to_first_token_seconds', '发出请求到收到上游第一个数据块的耗时',
+                                ('endpoint',))
+THINKING_SECONDS = histogram('llm_thinking_seconds', '思考（reasoning）阶段的时长', ('endpoint',))
+TOKENS_PER_SECOND = histogram('llm_tokens_per_second', '输出阶段每秒的token数（上游未返回用量时按数据块计）',
+                              ('endpoint',), buckets=(1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300))
+STREAM_SECONDS = histogram('sse_stream_seconds', 'SSE流从开始到结束（含客户端断开）的时长', ('endpoint',))
+ACTIVE_STREAMS = gauge('sse_active_streams', '正在输出的SSE流数', ('endpoint',))
+SSE_FRAMES = histogram('sse_frames_per_response', '每条回复写出的SSE帧数（相邻的内容增量合并后）', ('endpoint',),
+                       buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000))
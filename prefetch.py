@@ -0,0 +1,124 @@
+"""
+记忆预取模块
+用户输入时在后台用草稿文本执行一次记忆检索，预热查询向量缓存和检索结果缓存，
+正式发送消息时检索通常已经完成（或者正在进行，直接等待那一次的结果）
+"""
+
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from logger import get_logger
+
+
+log = get_logger('记忆预取')
+
+
+class MemoryPrefetcher:
+    """
+    后台记忆预取
+    
+    为了不和正式请求抢资源：
+    - 只用少量独立的线程执行预取；
+    - 每个会话只保留最新的一份草稿，还没开始的旧草稿直接被替换；
+    - 排队的会话数有上限，满了丢弃新的草稿；
+    - 正在进行的正式检索达到 max_busy 时跳过预取。
+    """
+    
+    def __init__(self, search, workers=1, max_pending=64, min_chars=2, max_chars=500, max_busy=2):
+        """
+        Args:
+            search: 检索函数，接收草稿文本，结果只用于预热缓存
+            workers: 预取线程数
+            max_pending: 排队等待预取的会话数上限
+            min_chars: 草稿短于这个长度时不预取
+            max_chars: 草稿长于这个长度时不预取
+            max_busy: 正在进行的正式检索达到这个数量时跳过预取
+        """
+        self.search = search
+        self.max_pending = max_pending
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.max_busy = max_busy
+        self.submitted = 0
+        self.replaced = 0
+        self.dropped = 0
+        self.skipped = 0
+        self.completed = 0
+        self.errors = 0
+        self._busy = 0
+        # session_id -> 最新的草稿，按提交顺序处理
+        self._pending = OrderedDict()
+        self._condition = threading.Condition()
+        for i in range(workers):
+            threading.Thread(target=self._run, name=f'memory-prefetch-{i}', daemon=True).start()
+    
+    def submit(self, session_id, text):
+        """
+        提交一份草稿（立即返回）
+        
+        Returns:
+            bool: 是否进入了预取队列
+        """
+        if not self.min_chars <= len(text) <= self.max_chars:
+            return False
+        
+        with self._condition:
+            if session_id in self._pending:
+                self._pending[session_id] = text
+                self.replaced += 1
+                return True
+            if len(self._pending) >= self.max_pending:
+                self.dropped += 1
+                return False
+            self._pending[session_id] = text
+            self.submitted += 1
+            self._condition.notify()
+            return True
+    
+    @contextmanager
+    def foreground(self):
+        """标记一次正式检索，期间预取会让路"""
+        with self._condition:
+            self._busy += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._busy -= 1
+    
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                _, text = self._pending.popitem(last=False)
+                if self._busy >= self.max_busy:
+                    self.skipped += 1
+                    continue
+            
+            try:
+                self.search(text)
+                with self._condition:
+                    self.completed += 1
+            except Exception as e:
+                with self._condition:
+                    self.errors += 1
+                log.warning(f'预取失败: {e}')
+    
+    def get_stats(self):
+        """
+        获取统计信息
+        
+        Returns:
+            dict: 排队数、提交/替换/丢弃/跳过/完成/失败次数
+        """
+        with self._condition:
+            return {
+                'pending': len(self._pending),
+                'submitted': self.submitted,
+                'replaced': self.replaced,
+                'dropped': self.dropped,
+                'skipped': self.skipped,
+                'completed': self.completed,
+                'errors': self.errors,
+            }
@@ -0,0 +1,356 @@
+"""
+会话存储模块
+保存每个用户的对话历史和剩余次数，带空闲过期、LRU淘汰和内存上限；
+通过 SessionStore 接口可以换成磁盘或多进程共享的存储
+"""
+
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime
+import config
+
+
+def new_session_data():
+    """新会话的初始数据"""
+    return {
+        'history': [],
+        'remaining_count': 10,
+        'created_at': datetime.now().isoformat()
+    }
+
+
+def estimate_size(data):
+    """粗略估算一个会话占用的内存字节数（对话内容和历史摘要按每个字符4字节计）"""
+    size = 256
+    for item in data.get('history') or ():
+        size += 128 + 4 * len(str(item.get('content', '')))
+    summary = data.get('history_summary')
+    if summary:
+        size += 128 + 4 * len(summary['text'])
+    return size
+
+
+class SessionStore(ABC):
+    """
+    会话存储接口
+    
+    get 返回的是数据副本，修改会话必须通过 ensure / update / reset。
+    所有方法都是抽象方法，缺少任何一个的子类在启动时创建实例就会失败，而不是在处理请求时才出错。
+    """
+    
+    @abstractmethod
+    def get(self, session_id):
+        """
+        读取会话
+        
+        Returns:
+            dict: 会话数据的副本，不存在或已过期时返回None
+        """
+    
+    @abstractmethod
+    def ensure(self, session_id):
+        """会话不存在时创建，存在时刷新最近访问时间"""
+    
+    @abstractmethod
+    def update(self, session_id, fn):
+        """
+        原子地修改会话（不存在时先创建）
+        
+        Args:
+            fn: 接收会话数据字典并就地修改的函数
+        
+        Returns:
+            fn 的返回值
+        """
+    
+    @abstractmethod
+    def reset(self, session_id):
+        """会话存在时重置为初始状态"""
+    
+    @abstractmethod
+    def __len__(self):
+        """会话数"""
+    
+    @abstractmethod
+    def get_stats(self):
+        """
+        获取统计信息
+        
+        Returns:
+            dict: 会话数、上限和淘汰/过期次数
+        """
+
+
+class _Stripe:
+    """内存会话存储的一个分段：按最近访问排序的会话和独立的锁"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        # session_id -> (数据, 最近访问时间, 估算字节数)
+        self.sessions = OrderedDict()
+        self.bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+
+
+class MemorySessionStore(SessionStore):
+    """
+    进程内的会话存储
+    
+    会话按ID哈希分到多个分段，每个分段有自己的锁，不同用户的请求不会争抢同一把锁。
+    每个分段按最近访问排序：超过 idle_ttl 没有访问的会话和超出条数/内存上限时最久未访问的会话被淘汰。
+    """
+    
+    def __init__(self, max_sessions=10000, idle_ttl=86400, max_memory_mb=256, stripes=16):
+        """
+        Args:
+            max_sessions: 最多保存的会话数，为None时不限制
+            idle_ttl: 会话空闲多少秒后过期，为None时不过期
+            max_memory_mb: 会话数据估算内存上限（MB），为None时不限制
+            stripes: 锁分段数量
+        """
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.max_bytes = max_memory_mb * 1024 * 1024 if max_memory_mb else None
+        self._stripes = [_Stripe() for _ in range(stripes)]
+        # 上限平均分到每个分段
+        self._stripe_sessions = -(-max_sessions // stripes) if max_sessions else None
+        self._stripe_bytes = self.max_bytes // stripes if self.max_bytes else None
+    
+    def _stripe(self, session_id):
+        return self._stripes[zlib.crc32(session_id.encode('utf-8')) % len(self._stripes)]
+    
+    def _expire(self, stripe, now):
+        """淘汰分段中已经过期的会话（最久未访问的在最前面），需要持有分段的锁"""
+        if not self.idle_ttl:
+            return
+        while stripe.sessions:
+            _, accessed, size = next(iter(stripe.sessions.values()))
+            if now - accessed < self.idle_ttl:
+                break
+            stripe.sessions.popitem(last=False)
+            stripe.bytes -= size
+            stripe.expirations += 1
+    
+    def _evict(self, stripe, keep):
+        """超出条数或内存上限时淘汰最久未访问的会话（不淘汰 keep），需要持有分段的锁"""
+        while len(stripe.sessions) > 1 and (
+                (self._stripe_sessions and len(stripe.sessions) > self._stripe_sessions)
+                or (self._stripe_bytes and stripe.bytes > self._stripe_bytes)):
+            session_id = next(iter(stripe.sessions))
+            if session_id == keep:
+                break
+            _, _, size = stripe.sessions.pop(session_id)
+            stripe.bytes -= size
+            stripe.evictions += 1
+    
+    def _touch(self, stripe, session_id, now, create):
+        """取出会话并移到最近访问的位置，需要持有分段的锁"""
+        self._expire(stripe, now)
+        item = stripe.sessions.get(session_id)
+        if item is None:
+            if not create:
+                return None
+            data = new_session_data()
+            size = estimate_size(data)
+            stripe.bytes += size
+            item = (data, now, size)
+        else:
+            item = (item[0], now, item[2])
+        stripe.sessions[session_id] = item
+        stripe.sessions.move_to_end(session_id)
+        return item[0]
+    
+    def get(self, session_id):
+        stripe = self._stripe(session_id)
+        with stripe.lock:
+            data = self._touch(stripe, session_id, time.monotonic(), create=False)
+            return dict(data) if data is not None else None
+    
+    def ensure(self, session_id):
+        stripe = self._stripe(session_id)
+        with stripe.lock:
+            self._touch(stripe, session_id, time.monotonic(), create=True)
+            self._evict(stripe, session_id)
+    
+    def update(self, session_id, fn):
+        stripe = self._stripe(session_id)
+        with stripe.lock:
+            now = time.monotonic()
+            data = self._touch(stripe, session_id, now, create=True)
+            result = fn(data)
+            size = estimate_size(data)
+            stripe.bytes += size - stripe.sessions[session_id][2]
+            stripe.sessions[session_id] = (data, now, size)
+            self._evict(stripe, session_id)
+            return result
+    
+    def reset(self, session_id):
+        stripe = self._stripe(session_id)
+        with stripe.lock:
+            item = stripe.sessions.get(session_id)
+            if item is not None:
+                data = new_session_data()
+                size = estimate_size(data)
+                stripe.bytes += size - item[2]
+                stripe.sessions[session_id] = (data, time.monotonic(), size)
+                stripe.sessions.move_to_end(session_id)
+    
+    def __len__(self):
+        return sum(len(stripe.sessions) for stripe in self._stripes)
+    
+    def get_stats(self):
+        return {
+            'backend': 'memory',
+            'size': len(self),
+            'max_sessions': self.max_sessions,
+            'bytes': sum(stripe.bytes for stripe in self._stripes),
+            'max_bytes': self.max_bytes,
+            'evictions': sum(stripe.evictions for stripe in self._stripes),
+            'expirations': sum(stripe.expirations for stripe in self._stripes),
+        }
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    基于SQLite的会话存储
+    
+    重启后会话仍然保留，同一台机器上的多个服务进程可以共享会话。
+    会话数据以JSON保存；写入新会话时顺带清理过期会话，超出条数上限时删除最久未访问的会话。
+    """
+    
+    def __init__(self, path, max_sessions=10000, idle_ttl=86400):
+        self.path = path
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.evictions = 0
+        self.expirations = 0
+        self._local = threading.local()
+        self._connect().execute('''
+            CREATE TABLE IF NOT EXISTS sessions (
+                id TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                accessed REAL NOT NULL
+            )
+        ''')
+        self._connect().execute('CREATE INDEX IF NOT EXISTS sessions_accessed ON sessions (accessed)')
+    
+    def _connect(self):
+        """每个线程使用自己的连接，WAL模式下读写互不阻塞"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=10)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+    
+    def _load(self, conn, session_id, now):
+        row = conn.execute('SELECT data, accessed FROM sessions WHERE id = ?', (session_id,)).fetchone()
+        if row is None:
+            return None
+        if self.idle_ttl and now - row[1] >= self.idle_ttl:
+            conn.execute('DELETE FROM sessions WHERE id = ?', (session_id,))
+            self.expirations += 1
+            return None
+        return json.loads(row[0])
+    
+    def _save(self, conn, session_id, data, now):
+        conn.execute('INSERT OR REPLACE INTO sessions (id, data, accessed) VALUES (?, ?, ?)',
+                     (session_id, json.dumps(data, ensure_ascii=False), now))
+    
+    def _cleanup(self, conn, now):
+        """清理过期会话，超出条数上限时删除最久未访问的会话"""
+        if self.idle_ttl:
+            self.expirations += conn.execute('DELETE FROM sessions WHERE accessed <= ?',
+                                             (now - self.idle_ttl,)).rowcount
+        if self.max_sessions:
+            self.evictions += conn.execute('''
+                DELETE FROM sessions WHERE id IN (
+                    SELECT id FROM sessions ORDER BY accessed DESC LIMIT -1 OFFSET ?
+                )
+            ''', (self.max_sessions,)).rowcount
+    
+    def get(self, session_id):
+        conn = self._connect()
+        now = time.time()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            data = self._load(conn, session_id, now)
+            if data is not None:
+                conn.execute('UPDATE sessions SET accessed = ? WHERE id = ?', (now, session_id))
+            return data
+    
+    def ensure(self, session_id):
+        self.update(session_id, lambda data: None)
+    
+    def update(self, session_id, fn):
+        conn = self._connect()
+        now = time.time()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            data = self._load(conn, session_id, now)
+            created = data is None
+            if created:
+                data = new_session_data()
+            result = fn(data)
+            self._save(conn, session_id, data, now)
+            if created:
+                self._cleanup(conn, now)
+            return result
+    
+    def reset(self, session_id):
+        conn = self._connect()
+        with conn:
+            conn.execute('UPDATE sessions SET data = ?, accessed = ? WHERE id = ?',
+                         (json.dumps(new_session_data()), time.time(), session_id))
+    
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+    
+    def get_stats(self):
+        return {
+            'backend': 'sqlite',
+            'size': len(self),
+            'max_sessions': self.max_sessions,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+
+def create_session_store(session_config=None):
+    """
+    根据配置创建会话存储
+    
+    Args:
+        session_config: 会话配置，为None时读取 SESSION_CONFIG
+            backend 为 'memory'、'sqlite'，或 'module:ClassName' 形式的自定义 SessionStore 子类
+    
+    Returns:
+        SessionStore: 会话存储
+    """
+    session_config = session_config or getattr(config, 'SESSION_CONFIG', {})
+    backend = session_config.get('backend', 'memory')
+    max_sessions = session_config.get('max_sessions', 10000)
+    idle_ttl = session_config.get('idle_ttl', 86400)
+    
+    if backend == 'memory':
+        return MemorySessionStore(max_sessions, idle_ttl,
+                                  max_memory_mb=session_config.get('max_memory_mb', 256),
+                                  stripes=session_config.get('lock_stripes', 16))
+    if backend == 'sqlite':
+        return SQLiteSessionStore(session_config.get('db_path', 'sessions.db'), max_sessions, idle_ttl)
+    
+    module_name, _, class_name = backend.partition(':')
+    if not class_name:
+        raise ValueError(f"不支持的会话存储: {backend}，可选: memory、sqlite 或 module:ClassName")
+    import importlib
+    store_class = getattr(importlib.import_module(module_name), class_name)
+    if not (isinstance(store_class, type) and issubclass(store_class, SessionStore)):
+        raise TypeError(f"自定义会话存储 {backend} 必须是 SessionStore 的子类")
+    return store_class(session_config)
@@ -0,0 +1,107 @@
+"""
+SSE帧模块
+内容帧用预先生成的模板拼接（只序列化内容字符串，不再每个增量都序列化整个事件字典），
+相邻的内容增量在一个很短的时间窗口内合并成一帧：第一段内容立即发出，之后每个窗口最多写出一次
+"""
+
+import json
+import time
+import config
+
+
+# 内容帧模板：CONTENT_PREFIX + json.dumps(内容) + FRAME_SUFFIX
+# 与 json.dumps({'type': 'content', 'content': 内容}, ensure_ascii=False) 生成的帧逐字节相同
+CONTENT_PREFIX = 'data: {"type": "content", "content": '
+FRAME_SUFFIX = '}\n\n'
+
+
+def event_frame(event):
+    """任意事件的SSE帧"""
+    return f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+
+def content_frame(text):
+    """内容事件的SSE帧"""
+    return CONTENT_PREFIX + json.dumps(text, ensure_ascii=False) + FRAME_SUFFIX
+
+
+THINKING_END_FRAME = event_frame({'type': 'thinking', 'status': 'end'})
+
+
+class FrameCoalescer:
+    """
+    合并相邻的内容增量
+    
+    距上次写出已超过 window 秒时，新的内容立即写出（所以第一段内容没有任何延迟）；
+    否则先缓存，直到下一个增量到达时窗口已过、缓存超过 max_bytes 字节、要发出其他事件或流结束时一起写出。
+    上游长时间没有新数据时，同步模式下缓存的内容要等到下一个数据块或流结束才写出，
+    异步模式由调用方按 due_in 定时调用 flush。window 为0时每个增量单独成帧。
+    """
+    
+    def __init__(self, window=0.03, max_bytes=1024, clock=time.perf_counter):
+        """
+        Args:
+            window: 合并窗口（秒）
+            max_bytes: 缓存的内容达到这么多字节（UTF-8）时立即写出
+            clock: 计时函数，基准测试中可以替换
+        """
+        self.window = window
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.deltas = 0
+        self.frames = 0
+        self._parts = []
+        self._size = 0
+        self._last_write = None
+    
+    def content(self, text, frames):
+        """加入一段内容，需要写出时把合并后的帧追加到 frames"""
+        self.deltas += 1
+        self._parts.append(text)
+        self._size += len(text.encode('utf-8'))
+        now = self.clock()
+        if (self._last_write is None or now - self._last_write >= self.window
+                or self._size >= self.max_bytes):
+            self._write(frames, now)
+    
+    def event(self, frame, frames):
+        """发出其他事件（思考、完成、错误）之前先写出缓存的内容，保证顺序不变"""
+        self.flush(frames)
+        frames.append(frame)
+        self.frames += 1
+    
+    def flush(self, frames):
+        """写出缓存的内容（没有时什么也不做）"""
+        if self._parts:
+            self._write(frames, self.clock())
+    
+    def due_in(self):
+        """
+        缓存的内容还要等多少秒写出
+        
+        Returns:
+            float: 秒数（可能为0或负数，表示已经到期）；没有缓存的内容时为None
+        """
+        if not self._parts:
+            return None
+        return self._last_write + self.window - self.clock()
+    
+    def _write(self, frames, now):
+        text = self._parts[0] if len(self._parts) == 1 else ''.join(self._parts)
+        frames.append(content_frame(text))
+        self.frames += 1
+        self._parts = []
+        self._size = 0
+        self._last_write = now
+
+
+def create_coalescer(sse_config=None):
+    """
+    根据配置创建内容帧合并器
+    
+    Args:
+        sse_config: SSE配置，为None时读取 SSE_CONFIG
+    """
+    sse_config = sse_config or getattr(config, 'SSE_CONFIG', {})
+    return FrameCoalescer(window=sse_config.get('coalesce_ms', 30) / 1000,
+                          max_bytes=sse_config.get('coalesce_max_bytes', 1024))
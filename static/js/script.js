@@ -130,6 +130,35 @@ async function loadVectorCount() {
     }
 }
 
+// 等待排队中的归档写入向量库，返回是否已保存
+async function waitForArchiveSaved(archiveId) {
+    // 服务端每次最多等待5秒，共等待约20秒（书页会停留13秒）
+    // 服务端等待的请求已满时会立即返回，这时间隔1秒再查询
+    const deadline = Date.now() + 20000;
+    while (Date.now() < deadline) {
+        const started = Date.now();
+        try {
+            const response = await fetch(`${API_BASE}/archive/status/${archiveId}?wait=5`, {
+                credentials: 'include'
+            });
+            const data = await response.json();
+            if (!data.success || data.status === 'failed') {
+                return false;
+            }
+            if (data.saved) {
+                return true;
+            }
+        } catch (error) {
+            console.error('查询归档状态失败:', error);
+            return false;
+        }
+        if (Date.now() - started < 1000) {
+            await new Promise(resolve => setTimeout(resolve, 1000));
+        }
+    }
+    return false;
+}
+
 // 格式化时间（仅时分）
 function formatTime(date) {
     const hours = String(date.getHours()).padStart(2, '0');
@@ -200,6 +229,7 @@ async function sendMessage() {
     conversationHistory.push({ role: 'user', content: message });
     
     // 清空输入框
+    clearTimeout(prefetchTimer);
     messageInput.value = '';
     messageInput.disabled = true;
     sendButton.disabled = true;
@@ -267,6 +297,7 @@ async function sendMessage() {
         // 读取流式数据
         const reader = response.body.getReader();
         const decoder = new TextDecoder();
+        let pendingLine = ''; // 上次读取末尾不完整的一行（合并后的帧较长，可能被拆在两次读取中）
         let receivedChunks = 0;
         const startTime = Date.now();
         const estimatedDuration = 10000; // 预估10秒完成
@@ -290,8 +321,9 @@ async function sendMessage() {
             updateProgress(currentProgress);
             
             // 解码数据
-            const chunk = decoder.decode(value, { stream: true });
+            const chunk = pendingLine + decoder.decode(value, { stream: true });
             const lines = chunk.split('\n');
+            pendingLine = lines.pop();
             
             for (const line of lines) {
                 if (line.startsWith('data: ')) {
@@ -507,9 +539,11 @@ async function archiveConversation() {
         // 读取流式数据
         const reader = response.body.getReader();
         const decoder = new TextDecoder();
+        let pendingLine = ''; // 上次读取末尾不完整的一行（合并后的帧较长，可能被拆在两次读取中）
         let summaryText = '';
         let hasError = false;
         let isSaved = false; // 记录是否保存到向量库
+        let archiveId = null; // 归档排队中时的ID，之后确认是否已保存
         let receivedChunks = 0;
         
         // 归档时进度从100%降到0%
@@ -535,8 +569,9 @@ async function archiveConversation() {
             updateProgress(currentProgress);
             
             // 解码数据
-            const chunk = decoder.decode(value, { stream: true });
+            const chunk = pendingLine + decoder.decode(value, { stream: true });
             const lines = chunk.split('\n');
+            pendingLine = lines.pop();
             
             for (const line of lines) {
                 if (line.startsWith('data: ')) {
@@ -574,7 +609,8 @@ async function archiveConversation() {
                             // 流式输出完成，记录保存状态
                             // 只有当 saved 明确为 true 时才标记为已保存
                             isSaved = data.saved === true;
-                            console.log('归档完成，保存状态:', isSaved);
+                            archiveId = data.archive_id || null;
+                            console.log('归档完成，保存状态:', isSaved, archiveId ? `（排队中: ${archiveId}）` : '');
                             updateProgress(0);
                         }
                     } catch (e) {
@@ -584,6 +620,11 @@ async function archiveConversation() {
             }
         }
         
+        // 归档排队中时，等待写入向量库后再更新页码
+        if (!hasError && !isSaved && archiveId) {
+            isSaved = await waitForArchiveSaved(archiveId);
+        }
+        
         // 如果成功接收到总结
         if (!hasError && summaryText) {
             // 重新加载向量总数并显示页码（只有在保存成功时才更新）
@@ -770,6 +811,29 @@ messageInput.addEventListener('keypress', (e) => {
     }
 });
 
+// 输入时预取记忆：停止输入一小段时间后把草稿发给后端提前检索，发送时检索通常已经完成
+const PREFETCH_DELAY_MS = 400;
+let prefetchTimer = null;
+let lastPrefetchText = '';
+
+messageInput.addEventListener('input', () => {
+    clearTimeout(prefetchTimer);
+    prefetchTimer = setTimeout(() => {
+        const text = messageInput.value.trim();
+        if (text.length < 2 || text === lastPrefetchText || remainingCount <= 0 || isArchiving) return;
+        lastPrefetchText = text;
+        // 预取失败不影响对话，忽略错误
+        fetch(`${API_BASE}/memory/prefetch`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            credentials: 'include',
+            body: JSON.stringify({ text })
+        }).catch(() => {});
+    }, PREFETCH_DELAY_MS);
+});
+
 // ==================== 留言板功能 ====================
 
 // 留言数据存储（必须在函数使用前定义）
@@ -0,0 +1,24 @@
+"""
+测试公共设置
+把项目根目录加入 sys.path；没有 config.py 时使用 config.py.example 中的默认配置
+
+运行: python -m unittest discover tests
+"""
+
+import importlib.machinery
+import importlib.util
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+try:
+    import config
+except ImportError:
+    loader = importlib.machinery.SourceFileLoader('config', os.path.join(ROOT, 'config.py.example'))
+    spec = importlib.util.spec_from_loader('config', loader)
+    config = importlib.util.module_from_spec(spec)
+    loader.exec_module(config)
+    sys.modules['config'] = config
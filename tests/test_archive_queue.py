@@ -0,0 +1,116 @@
+"""
+归档队列的测试
+写入向量库之后、标记为已保存之前中断时，重试不会重复添加向量；写WAL失败时不留下任何记录；多个等待者同时等待时都能及时返回
+"""
+
+import copy
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+import config
+import vector_store
+from archive_queue import ArchiveQueue, PENDING, SAVED
+from vector_store import VectorStore
+from tests.test_vector_store_concurrency import StubEncoder, DIMENSION
+
+
+class ArchiveQueueTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='archive_queue_test_')
+        self.saved_config = {name: copy.deepcopy(getattr(config, name, None))
+                             for name in ('FAISS_CONFIG', 'EMBEDDING_CONFIG', 'CACHE_CONFIG')}
+        config.FAISS_CONFIG = {
+            **config.FAISS_CONFIG,
+            'index_type': 'flat',
+            'index_path': f'{self.work_dir}/vector_index.faiss',
+            'metadata_path': f'{self.work_dir}/vector_metadata.db',
+            'wal_path': None,
+            'shard_by': None,
+            'mmap_index': False,
+            'checkpoint_interval': 4,
+        }
+        config.EMBEDDING_CONFIG = {**config.EMBEDDING_CONFIG, 'vector_dimension': DIMENSION,
+                                   'micro_batching': False}
+        config.CACHE_CONFIG = {'embedding_cache_size': 0, 'result_cache_size': 0}
+        self.store = VectorStore(model=StubEncoder())
+        self.queues = []
+    
+    def tearDown(self):
+        for queue in self.queues:
+            queue.stop()
+        self.store.close()
+        for name, value in self.saved_config.items():
+            setattr(config, name, value)
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+    
+    def open_queue(self):
+        queue = ArchiveQueue(self.store, db_path=f'{self.work_dir}/archive_queue.db', flush_delay=0.01)
+        self.queues.append(queue)
+        return queue
+    
+    def submit(self, queue, count):
+        return [queue.submit(f'总结{i}', [{'role': 'user', 'content': f'对话{i}'}]) for i in range(count)]
+    
+    def test_retry_after_interrupted_flush(self):
+        queue = self.open_queue()
+        archive_ids = self.submit(queue, 5)
+        for archive_id in archive_ids:
+            self.assertEqual(queue.wait(archive_id, 10)['status'], SAVED)
+        queue.stop()
+        self.assertEqual(self.store.get_count(), 5)
+        
+        # 相当于写入向量库之后、标记为已保存之前进程退出
+        conn = queue._connect()
+        with conn:
+            conn.execute('UPDATE archives SET status = ?', (PENDING,))
+        
+        queue = self.open_queue()
+        for archive_id in archive_ids:
+            self.assertEqual(queue.wait(archive_id, 10)['status'], SAVED)
+        self.assertEqual(self.store.get_count(), 5)
+        
+        # 去重键在检查点之后同样有效
+        self.store.save()
+        items = [{'summary': '总结0', 'key': archive_ids[0]}, {'summary': '新的总结', 'key': 'new'}]
+        self.assertEqual(self.store.add_conversations(items), 1)
+        self.assertEqual(self.store.get_count(), 6)
+    
+    def test_concurrent_waiters(self):
+        queue = self.open_queue()
+        results = {}
+        
+        def wait(archive_id):
+            results[archive_id] = queue.wait(archive_id, 10)['status']
+        
+        threads = []
+        for archive_id in self.submit(queue, 40):
+            thread = threading.Thread(target=wait, args=(archive_id,))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(set(results.values()), {SAVED})
+        self.assertEqual(self.store.get_count(), 40)
+    
+    def test_failed_wal_write_is_rolled_back(self):
+        shard = self.store.shards[-1]
+        items = [{'summary': f'总结{i}', 'key': f'archive-{i}'} for i in range(3)]
+        wal_size = shard.wal.size()
+        
+        with mock.patch.object(vector_store.os, 'fsync', side_effect=OSError('磁盘已满')):
+            with self.assertRaises(OSError):
+                self.store.add_conversations(items)
+        self.assertEqual(shard.wal.size(), wal_size)
+        self.assertEqual(self.store.get_count(), 0)
+        
+        # 重试写入完整的一批
+        self.assertEqual(self.store.add_conversations(items), 3)
+        self.assertEqual(self.store.add_conversations(items), 0)
+        self.assertEqual(len(shard.wal.replay()), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
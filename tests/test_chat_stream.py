@@ -0,0 +1,78 @@
+"""
+对话流的测试
+上游在输出了几段内容之后出错时，合并窗口中已经收到的内容要先写出，再发送错误帧（同步和异步两种模式）
+"""
+
+import asyncio
+import json
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+import config
+import app
+
+try:
+    import asgi
+except ImportError:
+    asgi = None
+
+DELTAS = ['从前', '有一个', '小女孩', '每天', '去河边']
+
+
+def content_chunk(text):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text, reasoning_content=None))])
+
+
+def failing_chunks():
+    for text in DELTAS:
+        yield content_chunk(text)
+    raise ConnectionError('上游连接中断')
+
+
+async def failing_chunks_async(**kwargs):
+    for text in DELTAS:
+        yield content_chunk(text)
+    raise ConnectionError('上游连接中断')
+
+
+def parse_frames(frames):
+    return [json.loads(frame[len('data: '):]) for frame in ''.join(frames).split('\n\n') if frame]
+
+
+class ChatStreamErrorTest(unittest.TestCase):
+    
+    def setUp(self):
+        # 合并窗口足够长，出错时后面几段内容一定还在缓存中
+        patcher = mock.patch.dict(config.__dict__,
+                                  {'SSE_CONFIG': {'coalesce_ms': 10000, 'coalesce_max_bytes': 1024}})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(app, 'search_memories', return_value=[])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    def check_events(self, events):
+        content = ''.join(event['content'] for event in events if event['type'] == 'content')
+        self.assertEqual(content, ''.join(DELTAS))
+        self.assertEqual(events[-1]['type'], 'error')
+        self.assertIn('上游连接中断', events[-1]['error'])
+    
+    def test_sync_stream_flushes_before_error(self):
+        client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(
+            create=lambda **kwargs: failing_chunks())))
+        with mock.patch.object(app, 'get_client', return_value=client):
+            frames = list(app.chat_model_stream('你好', []))
+        self.check_events(parse_frames(frames))
+    
+    @unittest.skipIf(asgi is None, '需要安装 uvicorn 和 a2wsgi')
+    def test_async_stream_flushes_before_error(self):
+        async def collect():
+            return [frame async for frame in asgi.chat_model_stream_async('你好', [], 'session')]
+        
+        with mock.patch.object(asgi, 'stream_chat_completion', failing_chunks_async):
+            frames = asyncio.run(collect())
+        self.check_events(parse_frames(frames))
+
+
+if __name__ == '__main__':
+    unittest.main()
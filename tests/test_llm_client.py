@@ -0,0 +1,106 @@
+"""
+共享大模型客户端的测试
+对本机的模拟接口连续发请求，确认复用同一个长连接，ConnectionStats 的统计与服务端看到的连接数一致
+"""
+
+import copy
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import config
+import llm_client
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """模拟对话补全接口：HTTP/1.1 长连接，按请求中的 stream 返回JSON或SSE"""
+    
+    protocol_version = 'HTTP/1.1'
+    
+    def log_message(self, *args):
+        pass
+    
+    def do_POST(self):
+        self.server.connections.add(self.client_address)
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if body.get('stream'):
+            chunks = [{'id': '1', 'created': 1, 'model': body['model'],
+                       'choices': [{'index': 0, 'delta': {'content': text}}]} for text in ('你', '好')]
+            payload = ''.join(f"data: {json.dumps(chunk)}\n\n" for chunk in chunks) + "data: [DONE]\n\n"
+            content_type = 'text/event-stream'
+        else:
+            payload = json.dumps({
+                'id': '1', 'created': 1, 'model': body['model'],
+                'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': '你好'}}],
+                'usage': {'prompt_tokens': 1, 'completion_tokens': 2, 'total_tokens': 3},
+            })
+            content_type = 'application/json'
+        data = payload.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class SharedClientTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.daemon_threads = True
+        self.server.connections = set()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        
+        self.saved_config = copy.deepcopy(config.ZHIPUAI_CONFIG)
+        config.ZHIPUAI_CONFIG = {
+            **config.ZHIPUAI_CONFIG,
+            'api_key': 'test.secret',
+            'base_url': f"http://127.0.0.1:{self.server.server_address[1]}/v4",
+            'pool_size': 4,
+        }
+        llm_client.close_client()
+        self.before = llm_client.connection_stats.stats()
+    
+    def tearDown(self):
+        llm_client.close_client()
+        config.ZHIPUAI_CONFIG = self.saved_config
+        self.server.shutdown()
+        self.server.server_close()
+    
+    def stats_delta(self):
+        after = llm_client.connection_stats.stats()
+        return {key: after[key] - self.before[key] for key in ('requests', 'connections', 'reused_requests')}
+    
+    def complete(self, stream=False):
+        client = llm_client.get_client()
+        response = client.chat.completions.create(model='stub', messages=[{'role': 'user', 'content': 'hi'}],
+                                                  stream=stream)
+        if stream:
+            return ''.join(chunk.choices[0].delta.content or '' for chunk in response)
+        return response.choices[0].message.content
+    
+    def test_consecutive_requests_reuse_connection(self):
+        for _ in range(3):
+            self.assertEqual(self.complete(), '你好')
+        self.assertIs(llm_client.get_client(), llm_client.get_client())
+        self.assertEqual(self.stats_delta(), {'requests': 3, 'connections': 1, 'reused_requests': 2})
+        self.assertEqual(len(self.server.connections), 1)
+    
+    def test_stream_returns_connection_to_pool(self):
+        """流式响应读完之后连接回到连接池，下一个请求继续使用它"""
+        self.assertEqual(self.complete(stream=True), '你好')
+        self.assertEqual(self.complete(), '你好')
+        self.assertEqual(self.complete(stream=True), '你好')
+        self.assertEqual(self.stats_delta(), {'requests': 3, 'connections': 1, 'reused_requests': 2})
+        self.assertEqual(len(self.server.connections), 1)
+    
+    def test_close_client_opens_new_connection(self):
+        self.complete()
+        llm_client.close_client()
+        self.complete()
+        self.assertEqual(self.stats_delta(), {'requests': 2, 'connections': 2, 'reused_requests': 0})
+        self.assertEqual(len(self.server.connections), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+"""
+向量库并发约定的测试
+检索与写入同时进行（写入期间会触发后台检查点）时，检索只能看到完整发布的记录，
+结束后向量数、元数据和重新打开后恢复的数据一致
+"""
+
+import copy
+import hashlib
+import shutil
+import tempfile
+import threading
+import unittest
+import numpy as np
+import config
+from vector_store import VectorStore
+
+DIMENSION = 16
+
+
+class StubEncoder:
+    """代替embedding模型：同一段文本总是得到同一个向量"""
+    
+    def encode(self, texts, **kwargs):
+        return np.array([self.vector(text) for text in texts], dtype='float32')
+    
+    @staticmethod
+    def vector(text):
+        seed = int.from_bytes(hashlib.sha1(text.encode('utf-8')).digest()[:8], 'little')
+        return np.random.default_rng(seed).random(DIMENSION, dtype='float32')
+
+
+class VectorStoreConcurrencyTest(unittest.TestCase):
+    
+    WRITERS = 4
+    RECORDS_PER_WRITER = 60
+    READERS = 4
+    
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='vector_store_test_')
+        self.saved_config = {name: copy.deepcopy(getattr(config, name, None))
+                             for name in ('FAISS_CONFIG', 'EMBEDDING_CONFIG', 'CACHE_CONFIG')}
+        config.FAISS_CONFIG = {
+            **config.FAISS_CONFIG,
+            'index_type': 'flat',
+            'index_path': f'{self.work_dir}/vector_index.faiss',
+            'metadata_path': f'{self.work_dir}/vector_metadata.db',
+            'wal_path': None,
+            'shard_by': None,
+            'mmap_index': False,
+            # 写入过程中多次触发后台检查点
+            'checkpoint_interval': 25,
+        }
+        config.EMBEDDING_CONFIG = {**config.EMBEDDING_CONFIG, 'vector_dimension': DIMENSION,
+                                   'micro_batching': False}
+        # 每次检索都真正查询索引和元数据
+        config.CACHE_CONFIG = {'embedding_cache_size': 0, 'result_cache_size': 0}
+        self.stores = []
+    
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+        for name, value in self.saved_config.items():
+            setattr(config, name, value)
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+    
+    def open_store(self):
+        store = VectorStore(model=StubEncoder())
+        self.stores.append(store)
+        return store
+    
+    def wait_for_checkpoints(self, store):
+        for shard in store.shards:
+            with shard._checkpoint_lock:
+                pass
+    
+    def check_result(self, result):
+        """检索到的记录必须已经完整发布：元数据存在，并且与向量对应同一段总结"""
+        self.assertIsNotNone(result['summary'], f"检索到只有向量没有元数据的记录: {result}")
+        self.assertEqual(result['conversation'], [{'role': 'user', 'content': result['summary']}])
+    
+    def run_concurrently(self, store, mmap_index=False):
+        errors = []
+        writing = threading.Event()
+        writing.set()
+        
+        def writer(n):
+            try:
+                for i in range(self.RECORDS_PER_WRITER):
+                    summary = f"writer-{n}-{i}"
+                    store.add_conversation(summary, [{'role': 'user', 'content': summary}])
+            except Exception as e:
+                errors.append(e)
+        
+        def reader(n):
+            searches = 0
+            try:
+                while writing.is_set() or searches < 20:
+                    query = f"writer-{searches % self.WRITERS}-{searches % self.RECORDS_PER_WRITER}"
+                    for result in store.search(query, k=3):
+                        self.check_result(result)
+                        # 向量和总结一一对应：总结的向量到查询向量的距离就是返回的距离
+                        expected = float(np.sum((StubEncoder.vector(result['summary'])
+                                                 - StubEncoder.vector(query)) ** 2))
+                        self.assertAlmostEqual(result['distance'], expected, places=3)
+                    searches += 1
+            except Exception as e:
+                errors.append(e)
+        
+        writers = [threading.Thread(target=writer, args=(n,)) for n in range(self.WRITERS)]
+        readers = [threading.Thread(target=reader, args=(n,)) for n in range(self.READERS)]
+        for thread in readers + writers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        writing.clear()
+        for thread in readers:
+            thread.join()
+        if errors:
+            raise errors[0]
+    
+    def check_consistent(self, store):
+        total = self.WRITERS * self.RECORDS_PER_WRITER
+        self.assertEqual(store.get_count(), total)
+        shard = store.shards[-1]
+        self.assertEqual(len(shard.metadata), total)
+        records = shard.metadata.fetch(list(range(total)), ('summary', 'conversation'))
+        summaries = {record['summary'] for record in records}
+        self.assertEqual(summaries, {f"writer-{n}-{i}" for n in range(self.WRITERS)
+                                     for i in range(self.RECORDS_PER_WRITER)})
+        # 每个ID的向量与它的总结一致
+        for vector_id, record in zip(range(total), records):
+            np.testing.assert_allclose(shard.index.reconstruct(vector_id), StubEncoder.vector(record['summary']),
+                                       rtol=1e-6)
+    
+    def test_concurrent_search_and_add(self):
+        store = self.open_store()
+        self.run_concurrently(store)
+        self.wait_for_checkpoints(store)
+        self.check_consistent(store)
+    
+    def test_recovered_after_reopen(self):
+        """后台检查点和WAL共同保存了全部写入，不调用 save() 直接重新打开也不丢、不重复"""
+        store = self.open_store()
+        self.run_concurrently(store)
+        store.close()
+        self.check_consistent(self.open_store())
+    
+    def test_mmap_index(self):
+        """内存映射模式下新向量写入增量索引，后台检查点后重新映射"""
+        config.FAISS_CONFIG['mmap_index'] = True
+        store = self.open_store()
+        self.run_concurrently(store)
+        self.wait_for_checkpoints(store)
+        self.assertEqual(store.get_count(), self.WRITERS * self.RECORDS_PER_WRITER)
+        store.save()
+        self.check_consistent(store)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,274 @@
+"""
+翻译模块
+把中文翻译成英文：内存LRU缓存 + SQLite持久缓存（重启后保留），
+并发的相同未命中请求合并成一次上游调用，批量翻译时多条文本合并成一次调用
+"""
+
+import json
+import sqlite3
+import threading
+import time
+import unicodedata
+from cache import LRUCache, SingleFlight
+from llm_client import get_client
+from logger import get_logger
+import config
+
+
+log = get_logger('翻译')
+
+TRANSLATE_PROMPT = """请将以下中文文本翻译成英文。
+
+要求：
+1. 只输出英文翻译结果
+2. 不要添加任何解释、说明或其他内容
+3. 不要使用markdown格式
+4. 不要使用引号包裹
+5. 直接输出翻译后的英文文本
+
+中文文本：
+{text}
+
+英文翻译："""
+
+BATCH_TRANSLATE_PROMPT = """请将下面JSON数组中的每一条中文文本分别翻译成英文。
+
+要求：
+1. 只输出一个JSON字符串数组，元素个数和顺序与输入完全一致
+2. 每个元素只包含对应文本的英文翻译，不要添加任何解释、说明或其他内容
+3. 不要使用markdown格式
+
+中文文本：
+{texts}
+
+英文翻译（JSON数组）："""
+
+
+class EmptyTranslationError(Exception):
+    """大模型返回的翻译结果为空"""
+
+
+def normalize_text(text):
+    """规范化待翻译文本作为缓存键：统一全角半角、合并空白"""
+    return ' '.join(unicodedata.normalize('NFKC', text).split())
+
+
+def clean_translation(content):
+    """
+    清理大模型返回的翻译结果
+    
+    Raises:
+        EmptyTranslationError: 清理后结果为空
+    """
+    translated_text = (content or '').strip()
+    
+    # 如果翻译结果为空，尝试清理可能的markdown格式或其他格式
+    if not translated_text:
+        log.debug('翻译结果为空，清理原始内容', content=repr(content))
+        # 移除可能的markdown代码块标记
+        translated_text = (content or '').replace('```', '').strip()
+        # 移除可能的引号
+        translated_text = translated_text.strip('"').strip("'").strip()
+    
+    if not translated_text:
+        raise EmptyTranslationError('翻译结果为空，请重试')
+    return translated_text
+
+
+class TranslationStore:
+    """SQLite持久翻译缓存，以 (模型, 规范化原文) 为主键"""
+    
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connect().execute('''
+            CREATE TABLE IF NOT EXISTS translations (
+                model TEXT NOT NULL,
+                source TEXT NOT NULL,
+                translated TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (model, source)
+            )
+        ''')
+    
+    def _connect(self):
+        """每个线程使用自己的连接，WAL模式下读写互不阻塞"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+    
+    def get_many(self, model, sources):
+        """
+        批量读取已缓存的翻译
+        
+        Returns:
+            dict: 原文 -> 译文，只包含命中的条目
+        """
+        if not sources:
+            return {}
+        placeholders = ','.join('?' * len(sources))
+        rows = self._connect().execute(
+            f'SELECT source, translated FROM translations WHERE model = ? AND source IN ({placeholders})',
+            [model, *sources]
+        ).fetchall()
+        return dict(rows)
+    
+    def put_many(self, model, items):
+        """写入一批 (原文, 译文)"""
+        conn = self._connect()
+        now = time.time()
+        with conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO translations (model, source, translated, created_at) VALUES (?, ?, ?, ?)',
+                [(model, source, translated, now) for source, translated in items]
+            )
+    
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM translations').fetchone()[0]
+
+
+class Translator:
+    """
+    带缓存的翻译器
+    
+    查找顺序：内存LRU -> SQLite -> 大模型。同一段文本同时有多个未命中的请求时，
+    只有一个请求调用大模型，其余请求等待并共享结果；单条和批量翻译之间也会合并。
+    """
+    
+    def __init__(self, translation_config=None):
+        """
+        Args:
+            translation_config: 翻译配置，为None时读取 TRANSLATION_CONFIG
+        """
+        translation_config = translation_config or getattr(config, 'TRANSLATION_CONFIG', {})
+        self.batch_size = translation_config.get('batch_size', 20)
+        self.upstream_calls = 0
+        self._lock = threading.Lock()
+        self.cache = LRUCache(translation_config.get('cache_size', 4096), translation_config.get('cache_ttl'))
+        db_path = translation_config.get('db_path', 'translation_cache.db')
+        self.store = TranslationStore(db_path) if db_path else None
+        self._flights = SingleFlight()
+    
+    @property
+    def model(self):
+        return config.ZHIPUAI_CONFIG['model']
+    
+    def translate(self, text):
+        """
+        翻译一段文本
+        
+        Returns:
+            str: 英文译文
+        
+        Raises:
+            EmptyTranslationError: 大模型返回的结果为空
+        """
+        return self.translate_batch([text])[0]
+    
+    def translate_batch(self, texts):
+        """
+        翻译多段文本，未命中缓存的文本合并成尽量少的大模型调用
+        
+        Returns:
+            list: 与 texts 一一对应的英文译文
+        """
+        model = self.model
+        sources = [normalize_text(text) for text in texts]
+        results = {}
+        
+        # 内存缓存 -> 持久缓存
+        missing = []
+        for source in dict.fromkeys(sources):
+            translated = self.cache.get((model, source))
+            if translated is None:
+                missing.append(source)
+            else:
+                results[source] = translated
+        if missing and self.store is not None:
+            for source, translated in self.store.get_many(model, missing).items():
+                self.cache.put((model, source), translated)
+                results[source] = translated
+            missing = [source for source in missing if source not in results]
+        
+        # 别的请求正在翻译的文本直接等待，其余的由本请求调用大模型
+        leading, waiting = [], []
+        for source in missing:
+            call, leader = self._flights.claim((model, source))
+            (leading if leader else waiting).append((source, call))
+        
+        if leading:
+            self._translate_leading(model, [source for source, _ in leading], results)
+        for source, call in waiting:
+            results[source] = call.result()
+        
+        return [results[source] for source in sources]
+    
+    def _translate_leading(self, model, sources, results):
+        """调用大模型翻译本请求负责的文本，写入缓存并唤醒等待的请求"""
+        pending = set(sources)
+        try:
+            for start in range(0, len(sources), self.batch_size):
+                chunk = sources[start:start + self.batch_size]
+                translations = self._request_batch(chunk) if len(chunk) > 1 else [self._request_one(chunk[0])]
+                if self.store is not None:
+                    self.store.put_many(model, zip(chunk, translations))
+                for source, translated in zip(chunk, translations):
+                    self.cache.put((model, source), translated)
+                    results[source] = translated
+                    pending.discard(source)
+                    self._flights.resolve((model, source), translated)
+        except Exception as e:
+            for source in pending:
+                self._flights.resolve((model, source), error=e)
+            raise
+    
+    def _complete(self, prompt, max_tokens):
+        """调用大模型（非流式），返回回复内容"""
+        with self._lock:
+            self.upstream_calls += 1
+        response = get_client().chat.completions.create(
+            model=self.model,
+            messages=[{"role": "user", "content": prompt}],
+            stream=False,
+            max_tokens=max_tokens,
+            temperature=0.3,
+        )
+        return response.choices[0].message.content
+    
+    def _request_one(self, source):
+        """翻译一段文本"""
+        return clean_translation(self._complete(TRANSLATE_PROMPT.format(text=source), 500))
+    
+    def _request_batch(self, sources):
+        """一次调用翻译多段文本；返回的不是等长的JSON数组时逐条重试"""
+        content = self._complete(
+            BATCH_TRANSLATE_PROMPT.format(texts=json.dumps(sources, ensure_ascii=False)),
+            min(500 * len(sources), 4096)
+        )
+        try:
+            translations = json.loads((content or '').strip().strip('`').removeprefix('json').strip())
+            if (isinstance(translations, list) and len(translations) == len(sources)
+                    and all(isinstance(item, str) for item in translations)):
+                return [clean_translation(item) for item in translations]
+        except (ValueError, EmptyTranslationError):
+            pass
+        log.warning('批量翻译结果无法解析，逐条翻译', count=len(sources))
+        return [self._request_one(source) for source in sources]
+    
+    def get_stats(self):
+        """
+        获取统计信息
+        
+        Returns:
+            dict: 内存缓存统计、持久缓存条数、大模型调用次数和被合并的请求数
+        """
+        return {
+            'memory': self.cache.get_stats(),
+            'persistent_size': len(self.store) if self.store is not None else 0,
+            'upstream_calls': self.upstream_calls,
+            'coalesced': self._flights.coalesced,
+        }
@@ -2,18 +2,1615 @@ import faiss
 import numpy as np
 import pickle
 import os
+import json
+import multiprocessing
+import queue
+import shutil
+import time
+import sqlite3
+import struct
+import threading
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+from multiprocessing import shared_memory
 from sentence_transformers import SentenceTransformer
+from cache import LRUCache, SingleFlight
+from metrics import SEARCH_SECONDS, ENCODE_SECONDS, ADD_SECONDS, SAVE_SECONDS
 import config
 
+# WAL记录头：payload长度（4字节，小端）
+_WAL_HEADER = struct.Struct('<I')
+
+
+class WriteAheadLog:
+    """
+    只追加的预写日志
+    
+    每条记录为 [长度][pickle(向量ID, 向量, 元数据)]，追加后立即fsync。
+    启动时重放，检查点完成后截断。ID递增，用于跳过已经合并进基础文件的记录。
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self._file = open(self.path, 'ab')
+    
+    def append(self, vector_id, embedding, metadata):
+        """追加一条记录并落盘"""
+        self.append_many([(vector_id, embedding, metadata)])
+    
+    def append_many(self, records):
+        """
+        追加一批记录，一次写入、一次fsync
+        
+        Args:
+            records: [(vector_id, embedding, metadata), ...]
+        
+        写入失败时截断回追加之前的长度，日志中不会留下这批记录的一部分。
+        """
+        data = []
+        for record in records:
+            payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+            data.append(_WAL_HEADER.pack(len(payload)) + payload)
+        position = self.size()
+        try:
+            self._file.write(b''.join(data))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        except Exception:
+            self._file.truncate(position)
+            raise
+    
+    def replay(self):
+        """
+        读取日志中的全部完整记录
+        
+        Returns:
+            list: [(vector_id, embedding, metadata), ...]，末尾写了一半的记录会被丢弃
+        """
+        records = []
+        valid_size = 0
+        with open(self.path, 'rb') as f:
+            while True:
+                header = f.read(_WAL_HEADER.size)
+                if len(header) < _WAL_HEADER.size:
+                    break
+                (length,) = _WAL_HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length:
+                    break
+                try:
+                    records.append(pickle.loads(payload))
+                except Exception:
+                    break
+                valid_size = f.tell()
+        
+        # 截掉损坏的尾部，保证后续追加的记录可以被正确读取
+        if valid_size < os.path.getsize(self.path):
+            print(f"【向量库】WAL尾部记录不完整，已截断到 {valid_size} 字节")
+            self._file.truncate(valid_size)
+        return records
+    
+    def size(self):
+        """当前日志的字节数，检查点开始时记下，完成后只截断到这个位置"""
+        self._file.flush()
+        return os.fstat(self._file.fileno()).st_size
+    
+    def truncate(self, position=None):
+        """
+        截断日志（检查点完成后调用）
+        
+        Args:
+            position: 只删除这个位置之前的记录，之后追加的记录保留；为None时清空
+        """
+        if position is None or position >= self.size():
+            self._file.truncate(0)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            return
+        
+        # 把剩余的记录写入新文件再原子替换，替换前崩溃时旧日志完整，重放时按ID跳过已合并的记录
+        with open(self.path, 'rb') as f:
+            f.seek(position)
+            remaining = f.read()
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(remaining)
+            f.flush()
+            os.fsync(f.fileno())
+        self._file.close()
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, 'ab')
+    
+    def close(self):
+        self._file.close()
+
+
+# 旧版记录文件（按记录pickle）的魔数，转换时用于识别格式
+_RECORD_MAGIC = b'AWWREC1\n'
+_SQLITE_MAGIC = b'SQLite format 3\x00'
+
+# 元数据字段，summary 与体积较大的 conversation 分表存储
+METADATA_FIELDS = ('summary', 'conversation', 'timestamp')
+
+
+def _read_legacy_metadata(path):
+    """读取旧版元数据文件（整体pickle列表或按记录pickle的文件）"""
+    with open(path, 'rb') as f:
+        if f.read(len(_RECORD_MAGIC)) != _RECORD_MAGIC:
+            f.seek(0)
+            return pickle.load(f)
+        
+        records = []
+        while True:
+            header = f.read(_WAL_HEADER.size)
+            if len(header) < _WAL_HEADER.size:
+                break
+            (length,) = _WAL_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                break
+            records.append(pickle.loads(payload))
+        return records
+
+
+class MetadataStore:
+    """
+    基于SQLite的元数据存储，以向量ID为主键
+    
+    summary 和 timestamp 存在 records 表，完整对话存在 conversations 表，
+    检索时只读取命中的行和调用方需要的字段。新记录先放在内存中，flush() 时一次性写入。
+    已删除但还没有从索引中清除的ID记在 tombstones 表，压缩索引后再和对应的记录一起删除。
+    
+    记录可以带一个去重键 'key'（如归档ID），existing_keys 用它判断同一条内容是否已经写入过。
+    (已写入的下一个ID, 已写入条数, 未写入记录) 保存在一个元组中整体替换，读者拿到的总是一致的视图；
+    append/extend/flush/commit/purge 需要由调用方保证互斥。ID必须递增。
+    后台检查点用 pending / write / commit 分三步写入：write 期间可以继续 append。
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        # 所有线程打开的连接，关闭时逐个关闭
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                magic = f.read(len(_SQLITE_MAGIC))
+            if magic and magic != _SQLITE_MAGIC:
+                self._convert_legacy()
+        
+        conn = self._connect()
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS records (
+                id INTEGER PRIMARY KEY,
+                summary TEXT NOT NULL,
+                timestamp TEXT,
+                key TEXT
+            );
+            CREATE TABLE IF NOT EXISTS conversations (
+                id INTEGER PRIMARY KEY,
+                conversation TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS tombstones (
+                id INTEGER PRIMARY KEY
+            );
+            CREATE TABLE IF NOT EXISTS settings (
+                key TEXT PRIMARY KEY,
+                value INTEGER
+            );
+        ''')
+        # 旧版数据库没有去重键
+        if 'key' not in {row[1] for row in conn.execute('PRAGMA table_info(records)')}:
+            conn.execute('ALTER TABLE records ADD COLUMN key TEXT')
+        conn.execute('CREATE INDEX IF NOT EXISTS records_key ON records (key)')
+        next_id, rows = conn.execute('SELECT COALESCE(MAX(id) + 1, 0), COUNT(*) FROM records').fetchone()
+        # 最大的ID被清除后，仍然从原来的位置继续分配
+        saved = conn.execute("SELECT value FROM settings WHERE key = 'next_id'").fetchone()
+        if saved:
+            next_id = max(next_id, saved[0])
+        self._state = (next_id, rows, {})
+    
+    def _connect(self):
+        """每个线程使用自己的连接，WAL模式下读写互不阻塞"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+    
+    def _convert_legacy(self):
+        """把旧版元数据文件转换为SQLite，原来的位置即为向量ID"""
+        records = _read_legacy_metadata(self.path)
+        print(f"【向量库】转换旧版元数据文件: {self.path}（{len(records)} 条）")
+        
+        tmp_path = f"{self.path}.tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        conn = sqlite3.connect(tmp_path)
+        conn.executescript('''
+            CREATE TABLE records (id INTEGER PRIMARY KEY, summary TEXT NOT NULL, timestamp TEXT, key TEXT);
+            CREATE TABLE conversations (id INTEGER PRIMARY KEY, conversation TEXT NOT NULL);
+        ''')
+        self._insert(conn, list(enumerate(records)))
+        conn.commit()
+        conn.close()
+        
+        # 旧版的偏移量文件已经没有用了
+        if os.path.exists(f"{self.path}.idx"):
+            os.remove(f"{self.path}.idx")
+        os.replace(tmp_path, self.path)
+    
+    @staticmethod
+    def _insert(conn, items):
+        conn.executemany(
+            'INSERT OR REPLACE INTO records (id, summary, timestamp, key) VALUES (?, ?, ?, ?)',
+            [(vector_id, r['summary'], r.get('timestamp'), r.get('key')) for vector_id, r in items]
+        )
+        conn.executemany(
+            'INSERT OR REPLACE INTO conversations (id, conversation) VALUES (?, ?)',
+            [(vector_id, json.dumps(r.get('conversation', []), ensure_ascii=False))
+             for vector_id, r in items]
+        )
+    
+    @property
+    def next_id(self):
+        """下一条记录应使用的ID"""
+        committed_next, _, pending = self._state
+        return next(reversed(pending)) + 1 if pending else committed_next
+    
+    def __len__(self):
+        _, rows, pending = self._state
+        return rows + len(pending)
+    
+    def fetch(self, ids, fields=('summary',)):
+        """
+        按ID批量读取记录
+        
+        Args:
+            ids: 向量ID列表
+            fields: 需要的字段，取值见 METADATA_FIELDS
+        
+        Returns:
+            list: 与 ids 一一对应的字典，只包含请求的字段，不存在的ID各字段为None
+        """
+        unknown = set(fields) - set(METADATA_FIELDS)
+        if unknown:
+            raise ValueError(f"未知的元数据字段: {', '.join(sorted(unknown))}")
+        
+        committed_next, _, pending = self._state
+        rows = {}
+        
+        stored = [int(i) for i in ids if i < committed_next]
+        if stored:
+            columns = [f for f in fields if f != 'conversation']
+            select = ', '.join(['r.id'] + [f'r.{f}' for f in columns])
+            sql = f'SELECT {select} FROM records r'
+            if 'conversation' in fields:
+                sql = sql.replace(' FROM', ', c.conversation FROM') + ' LEFT JOIN conversations c ON c.id = r.id'
+                columns.append('conversation')
+            sql += f" WHERE r.id IN ({', '.join('?' * len(stored))})"
+            
+            for row in self._connect().execute(sql, stored):
+                record = dict(zip(columns, row[1:]))
+                if 'conversation' in record:
+                    record['conversation'] = json.loads(record['conversation'] or '[]')
+                rows[row[0]] = record
+        
+        results = []
+        for vector_id in ids:
+            record = pending.get(vector_id) if vector_id >= committed_next else None
+            if record is not None:
+                results.append({f: record.get(f) for f in fields})
+            else:
+                results.append(rows.get(int(vector_id), {f: None for f in fields}))
+        return results
+    
+    def latest(self, fields=METADATA_FIELDS):
+        """读取ID最大的一条记录，没有记录时返回None"""
+        _, _, pending = self._state
+        if pending:
+            vector_id = next(reversed(pending))
+        else:
+            vector_id = self._connect().execute('SELECT MAX(id) FROM records').fetchone()[0]
+            if vector_id is None:
+                return None
+        return self.fetch([vector_id], fields)[0]
+    
+    def existing(self, ids):
+        """返回 ids 中存在记录的ID集合"""
+        committed_next, _, pending = self._state
+        found = {i for i in ids if i in pending}
+        stored = [i for i in ids if i < committed_next]
+        if stored:
+            sql = f"SELECT id FROM records WHERE id IN ({', '.join('?' * len(stored))})"
+            found.update(row[0] for row in self._connect().execute(sql, stored))
+        return found
+    
+    def existing_keys(self, keys):
+        """返回 keys 中已经有记录使用的去重键集合"""
+        _, _, pending = self._state
+        keys = set(keys)
+        found = {record.get('key') for record in pending.values()} & keys
+        rest = list(keys - found)
+        if rest:
+            sql = f"SELECT key FROM records WHERE key IN ({', '.join('?' * len(rest))})"
+            found.update(row[0] for row in self._connect().execute(sql, rest))
+        return found
+    
+    def append(self, vector_id, record):
+        committed_next, rows, pending = self._state
+        self._state = (committed_next, rows, {**pending, vector_id: record})
+    
+    def extend(self, items):
+        committed_next, rows, pending = self._state
+        self._state = (committed_next, rows, {**pending, **dict(items)})
+    
+    def flush(self):
+        """把内存中的新记录写入数据库"""
+        items = self.pending()
+        self.write(items)
+        self.commit(items)
+    
+    def pending(self):
+        """
+        还没有写入数据库的记录
+        
+        Returns:
+            list: [(向量ID, 记录), ...]，按ID递增
+        """
+        return list(self._state[2].items())
+    
+    def write(self, items):
+        """把 pending() 取出的记录写入数据库（不改变视图，可以和 append 同时进行）"""
+        if not items:
+            return
+        conn = self._connect()
+        with conn:
+            self._insert(conn, items)
+    
+    def commit(self, items):
+        """write 完成后切换视图：这些记录改为从数据库读取，之后追加的记录仍在内存中"""
+        if not items:
+            return
+        committed_next, rows, pending = self._state
+        last_id = items[-1][0]
+        # 提交之后才切换视图，之前的读者仍然从内存中读取这些记录
+        self._state = (last_id + 1, rows + len(items),
+                       {vector_id: record for vector_id, record in pending.items() if vector_id > last_id})
+    
+    def tombstones(self):
+        """读取全部墓碑ID"""
+        return {row[0] for row in self._connect().execute('SELECT id FROM tombstones')}
+    
+    def add_tombstones(self, ids):
+        """记录删除的ID，立即提交"""
+        conn = self._connect()
+        with conn:
+            conn.executemany('INSERT OR IGNORE INTO tombstones (id) VALUES (?)', [(i,) for i in ids])
+    
+    def purge(self, ids):
+        """
+        删除已经从索引中清除的记录和它们的墓碑（这些记录必须已经 flush）
+        
+        Returns:
+            int: 删除的记录数
+        """
+        committed_next, rows, pending = self._state
+        params = [(i,) for i in ids]
+        conn = self._connect()
+        with conn:
+            deleted = conn.executemany('DELETE FROM records WHERE id = ?', params).rowcount
+            conn.executemany('DELETE FROM conversations WHERE id = ?', params)
+            conn.executemany('DELETE FROM tombstones WHERE id = ?', params)
+            conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('next_id', ?)", (committed_next,))
+        self._state = (committed_next, rows - deleted, pending)
+        return deleted
+    
+    def backup(self, dest_path):
+        """用SQLite在线备份接口复制一份一致的数据库文件"""
+        dest = sqlite3.connect(dest_path)
+        try:
+            self._connect().backup(dest)
+        finally:
+            dest.close()
+    
+    def close(self):
+        """关闭所有线程（包括检索和后台检查点线程）打开的连接"""
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+
+# 需要先训练才能添加向量的索引类型
+TRAINED_INDEX_TYPES = ('ivf', 'ivfpq')
+INDEX_TYPES = ('flat', 'hnsw') + TRAINED_INDEX_TYPES
+
+
+def create_index(dimension, index_type=None):
+    """
+    按类型创建一个空的FAISS索引（L2距离）
+    
+    Args:
+        dimension: 向量维度
+        index_type: 'flat' / 'ivf' / 'hnsw' / 'ivfpq'，为None时读取配置
+    
+    Returns:
+        faiss.Index: 新索引，'ivf' 和 'ivfpq' 需要先 train_index 再添加向量
+    """
+    faiss_config = config.FAISS_CONFIG
+    index_type = index_type or faiss_config.get('index_type', 'flat')
+    
+    if index_type == 'flat':
+        index = faiss.IndexFlatL2(dimension)
+    elif index_type == 'hnsw':
+        index = faiss.IndexHNSWFlat(dimension, faiss_config.get('hnsw_m', 32))
+        index.hnsw.efConstruction = faiss_config.get('ef_construction', 200)
+    elif index_type == 'ivf':
+        quantizer = faiss.IndexFlatL2(dimension)
+        index = faiss.IndexIVFFlat(quantizer, dimension, faiss_config.get('nlist', 1024))
+    elif index_type == 'ivfpq':
+        pq_m = faiss_config.get('pq_m', 16)
+        if dimension % pq_m != 0:
+            raise ValueError(f"向量维度 {dimension} 不能被 pq_m={pq_m} 整除")
+        quantizer = faiss.IndexFlatL2(dimension)
+        index = faiss.IndexIVFPQ(quantizer, dimension, faiss_config.get('nlist', 1024),
+                                 pq_m, faiss_config.get('pq_nbits', 8))
+    else:
+        raise ValueError(f"不支持的索引类型: {index_type}，可选: {', '.join(INDEX_TYPES)}")
+    
+    apply_search_params(index)
+    return index
+
+
+def get_index_type(index):
+    """根据索引对象判断索引类型（带ID映射时看内部的索引）"""
+    if isinstance(index, faiss.IndexIDMap):
+        index = faiss.downcast_index(index.index)
+    if isinstance(index, faiss.IndexIVFPQ):
+        return 'ivfpq'
+    if isinstance(index, faiss.IndexIVFFlat):
+        return 'ivf'
+    if isinstance(index, faiss.IndexHNSWFlat):
+        return 'hnsw'
+    return 'flat'
+
+
+def create_empty_index(dimension):
+    """
+    为新向量库创建空索引
+    
+    需要训练的类型在没有数据时无法训练，先退回flat，积累足够数据后再迁移。
+    """
+    index_type = config.FAISS_CONFIG.get('index_type', 'flat')
+    if index_type in TRAINED_INDEX_TYPES:
+        print(f"【向量库】{index_type} 索引需要训练数据，暂时使用 flat，"
+              f"积累至少 {min_training_size(index_type)} 条记忆后运行 python init_db.py --migrate")
+        index_type = 'flat'
+    return create_index(dimension, index_type)
+
+
+def apply_search_params(index):
+    """把配置中的 nprobe / efSearch 应用到索引上"""
+    faiss_config = config.FAISS_CONFIG
+    index_type = get_index_type(index)
+    if index_type in TRAINED_INDEX_TYPES:
+        faiss.extract_index_ivf(index).nprobe = faiss_config.get('nprobe', 16)
+    elif index_type == 'hnsw':
+        if isinstance(index, faiss.IndexIDMap):
+            index = faiss.downcast_index(index.index)
+        index.hnsw.efSearch = faiss_config.get('ef_search', 64)
+
+
+def min_training_size(index_type=None):
+    """训练给定类型的索引至少需要的向量数"""
+    faiss_config = config.FAISS_CONFIG
+    index_type = index_type or faiss_config.get('index_type', 'flat')
+    if index_type == 'ivf':
+        return faiss_config.get('nlist', 1024)
+    if index_type == 'ivfpq':
+        return max(faiss_config.get('nlist', 1024), 2 ** faiss_config.get('pq_nbits', 8))
+    return 0
+
+
+def train_index(index, vectors):
+    """
+    用已有向量的随机样本训练索引
+    
+    Args:
+        index: 待训练的索引
+        vectors: float32 向量矩阵，形状为 (n, dimension)
+    """
+    if index.is_trained:
+        return
+    
+    needed = min_training_size(get_index_type(index))
+    if len(vectors) < needed:
+        raise ValueError(f"训练样本不足：需要至少 {needed} 条向量，当前只有 {len(vectors)} 条")
+    
+    sample_size = config.FAISS_CONFIG.get('train_sample_size', 100000)
+    if len(vectors) > sample_size:
+        rng = np.random.default_rng()
+        vectors = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+    
+    index.train(np.ascontiguousarray(vectors, dtype='float32'))
+
+
+def reconstruct_vectors(index, start=0):
+    """
+    取出索引中从 start 开始的全部向量（ivfpq 为有损近似值）
+    
+    Returns:
+        numpy.ndarray: 形状为 (ntotal - start, dimension) 的float32矩阵
+    """
+    count = index.ntotal - start
+    if count <= 0:
+        return np.zeros((0, index.d), dtype='float32')
+    if isinstance(index, faiss.IndexIDMap):
+        index = faiss.downcast_index(index.index)
+    enable_reconstruct(index)
+    return index.reconstruct_n(start, count)
+
+
+def index_ids(index, start=0):
+    """取出索引中从 start 开始的向量ID，与 reconstruct_vectors 的顺序一致"""
+    if isinstance(index, faiss.IndexIDMap):
+        return faiss.vector_to_array(index.id_map)[start:]
+    return np.arange(start, index.ntotal, dtype='int64')
+
+
+def add_ids(index):
+    """
+    给索引加上ID映射（IndexIDMap2），检索返回稳定的向量ID而不是位置
+    
+    旧版索引中的向量按位置编号（与旧版元数据的位置一致），需要复制一份重新添加。
+    """
+    if isinstance(index, faiss.IndexIDMap):
+        return index
+    if index.ntotal == 0:
+        return faiss.IndexIDMap2(index)
+    
+    vectors = reconstruct_vectors(index)
+    inner = faiss.clone_index(index)
+    inner.reset()
+    wrapped = faiss.IndexIDMap2(inner)
+    wrapped.add_with_ids(vectors, index_ids(index))
+    return wrapped
+
+
+def enable_reconstruct(index):
+    """
+    为IVF索引建立直接映射表，之后可以按位置或ID取回向量（添加新向量时FAISS会自动维护）
+    
+    建立过程会修改索引，只能在索引发布给检索线程之前调用；已经建立过时不做任何事。
+    """
+    if get_index_type(index) in TRAINED_INDEX_TYPES:
+        ivf = faiss.extract_index_ivf(index)
+        if ivf.direct_map.type == faiss.DirectMap.NoMap:
+            ivf.make_direct_map()
+
+
+def mmr_select(query_vector, vectors, k, diversity):
+    """
+    最大边际相关性（MMR）选择：在相关性和与已选结果的差异之间权衡
+    
+    Args:
+        query_vector: 查询向量
+        vectors: 候选向量矩阵（按相关性从高到低排列）
+        k: 最多选择的数量
+        diversity: 0~1，越大越看重多样性，0 等价于按相关性排序
+    
+    Returns:
+        list: 被选中候选的下标，按选择顺序排列
+    """
+    # 用余弦相似度衡量相关性和冗余度
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    query_vector = query_vector / max(np.linalg.norm(query_vector), 1e-12)
+    relevance = vectors @ query_vector
+    similarity = vectors @ vectors.T
+    
+    selected = []
+    redundancy = np.full(len(vectors), -np.inf)
+    remaining = np.ones(len(vectors), dtype=bool)
+    while len(selected) < min(k, len(vectors)):
+        if selected:
+            scores = (1 - diversity) * relevance - diversity * redundancy
+        else:
+            scores = relevance.copy()
+        scores[~remaining] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        remaining[best] = False
+        redundancy = np.maximum(redundancy, similarity[best])
+    return selected
+
+
+# embedding推理后端，都提供与 SentenceTransformer.encode 相同的接口
+EMBEDDING_BACKENDS = ('torch', 'torch-int8', 'onnx')
+
+
+def load_embedding_model(backend=None):
+    """
+    根据配置加载embedding模型
+    
+    Args:
+        backend: 推理后端，为None时读取 EMBEDDING_CONFIG['backend']
+            'torch'      PyTorch原始精度
+            'torch-int8' PyTorch动态int8量化（只量化Linear层，仅CPU）
+            'onnx'       ONNX Runtime，需要 sentence-transformers>=3.2 和 optimum[onnxruntime]；
+                         配置 onnx_file_name 可以加载量化后的ONNX模型
+    
+    Returns:
+        SentenceTransformer: 加载好的模型
+    """
+    embedding_config = config.EMBEDDING_CONFIG
+    backend = backend or embedding_config.get('backend', 'torch')
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"不支持的推理后端: {backend}，可选: {', '.join(EMBEDDING_BACKENDS)}")
+    
+    if embedding_config['model_type'] == 'local':
+        # 使用本地模型
+        model_name = embedding_config['local_model_path']
+        if not os.path.exists(model_name):
+            raise FileNotFoundError(f"本地模型路径不存在: {model_name}")
+        print(f"正在加载本地模型: {model_name}（后端: {backend}）")
+    else:
+        # 使用HuggingFace模型
+        model_name = embedding_config['hf_model_name']
+        print(f"正在加载HuggingFace模型: {model_name}（后端: {backend}）")
+    
+    if backend == 'torch':
+        return SentenceTransformer(model_name, device=embedding_config['device'])
+    
+    if backend == 'torch-int8':
+        import torch
+        model = SentenceTransformer(model_name, device='cpu')
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    
+    model_kwargs = {}
+    if embedding_config.get('onnx_file_name'):
+        model_kwargs['file_name'] = embedding_config['onnx_file_name']
+    try:
+        return SentenceTransformer(model_name, device='cpu', backend='onnx', model_kwargs=model_kwargs)
+    except TypeError as e:
+        raise ImportError("ONNX后端需要 sentence-transformers>=3.2，请升级后重试") from e
+
+
+class EmbeddingBatcher:
+    """
+    微批量编码器
+    
+    各线程的 encode 请求先进入队列，由后台线程合并成一个批次调用模型：
+    凑满 max_batch_size 条文本或等待超过 max_wait_ms 时立即编码，再把结果分给各个调用方。
+    接口与 SentenceTransformer.encode 一致，可以直接替换。
+    """
+    
+    def __init__(self, model, max_batch_size=32, max_wait_ms=5):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='embedding-batcher', daemon=True)
+        self._thread.start()
+    
+    def encode(self, texts, **kwargs):
+        """
+        编码一组文本（阻塞直到所在批次完成）
+        
+        Returns:
+            numpy.ndarray: 形状为 (len(texts), dimension) 的向量
+        """
+        if not self._running:
+            raise RuntimeError("编码器已关闭")
+        
+        request = {'texts': list(texts), 'done': threading.Event(), 'result': None, 'error': None}
+        self._queue.put(request)
+        request['done'].wait()
+        if request['error'] is not None:
+            raise request['error']
+        return request['result']
+    
+    def _collect(self):
+        """取出一个批次的请求：阻塞等待第一条，然后在时间窗口内继续收集"""
+        first = self._queue.get()
+        if first is None:
+            return None
+        
+        batch = [first]
+        size = len(first['texts'])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                request = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                # 关闭信号，放回去让下一轮退出
+                self._queue.put(None)
+                break
+            batch.append(request)
+            size += len(request['texts'])
+        return batch
+    
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            
+            texts = [text for request in batch for text in request['texts']]
+            try:
+                embeddings = self.model.encode(texts, batch_size=len(texts))
+                start = 0
+                for request in batch:
+                    end = start + len(request['texts'])
+                    request['result'] = embeddings[start:end]
+                    start = end
+            except Exception as e:
+                for request in batch:
+                    request['error'] = e
+            finally:
+                for request in batch:
+                    request['done'].set()
+    
+    def close(self):
+        """停止后台线程（已经在队列中的请求仍会被处理）"""
+        if self._running:
+            self._running = False
+            self._queue.put(None)
+            self._thread.join()
+
+# 进程池子进程中的模型，每个进程在初始化时加载一次
+_worker_model = None
+
+
+def _embedding_worker_init(backend, threads, cpu_groups, counter):
+    """
+    进程池子进程初始化：绑定CPU、限制推理线程数并加载模型
+    
+    Args:
+        backend: 推理后端
+        threads: 每个进程的推理线程数，为None时不限制
+        cpu_groups: 每个进程绑定的CPU核列表，为None时不绑定
+        counter: 进程间共享的计数器，用来给子进程编号
+    """
+    global _worker_model
+    with counter.get_lock():
+        worker_index = counter.value
+        counter.value += 1
+    
+    if cpu_groups:
+        cpus = cpu_groups[worker_index % len(cpu_groups)]
+        try:
+            os.sched_setaffinity(0, cpus)
+        except (AttributeError, OSError) as e:
+            print(f"【embedding进程池】进程 {worker_index} 绑定CPU失败: {e}")
+    
+    if threads:
+        # 需要在推理库初始化线程池之前设置
+        os.environ['OMP_NUM_THREADS'] = str(threads)
+        try:
+            import torch
+            torch.set_num_threads(threads)
+        except ImportError:
+            pass
+    
+    _worker_model = load_embedding_model(backend)
+
+
+def _embedding_worker_encode(texts, kwargs):
+    """
+    在子进程中编码，向量写入新建的共享内存块，只把块名和形状传回主进程
+    
+    Returns:
+        tuple: (共享内存块名, 向量形状)，共享内存由主进程读取后释放
+    """
+    embeddings = np.ascontiguousarray(_worker_model.encode(texts, **kwargs), dtype='float32')
+    block = shared_memory.SharedMemory(create=True, size=max(embeddings.nbytes, 1))
+    try:
+        np.ndarray(embeddings.shape, dtype='float32', buffer=block.buf)[...] = embeddings
+        return block.name, embeddings.shape
+    finally:
+        block.close()
+
+
+def _release_shared_block(name):
+    """释放子进程创建的共享内存块（已经释放时什么也不做）"""
+    try:
+        block = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    block.close()
+    block.unlink()
+
+
+class EmbeddingWorkerPool:
+    """
+    多进程编码器
+    
+    模型运行在独立的子进程中（spawn方式启动，每个进程只加载一次模型），
+    分词和前后处理不再占用主进程的GIL，大批量编码也不会拖慢同进程里的SSE流。
+    向量通过共享内存传回，不经过pickle。接口与 SentenceTransformer.encode 一致，可以直接替换。
+    """
+    
+    def __init__(self, processes=2, max_pending=64, timeout=60, threads=1, pin_cpus=False, backend=None):
+        """
+        Args:
+            processes: 子进程数量
+            max_pending: 同时提交到进程池的编码请求上限，超过时调用方等待
+            timeout: 等待空位和等待编码结果的最长秒数
+            threads: 每个子进程的推理线程数，为None时不限制
+            pin_cpus: 是否把每个子进程绑定到不同的CPU核（每个进程 threads 个核）
+            backend: 推理后端，为None时读取 EMBEDDING_CONFIG['backend']
+        """
+        self.processes = processes
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        
+        cpu_groups = None
+        if pin_cpus:
+            cpu_groups = self._cpu_groups(processes, threads or 1)
+        
+        context = multiprocessing.get_context('spawn')
+        self._pool = context.Pool(processes, initializer=_embedding_worker_init,
+                                  initargs=(backend, threads, cpu_groups, context.Value('i', 0)))
+        self._running = True
+        print(f"【embedding进程池】已启动 {processes} 个编码进程"
+              f"（每个进程 {threads or '不限'} 个线程{'，已绑定CPU' if cpu_groups else ''}）")
+    
+    @staticmethod
+    def _cpu_groups(processes, threads):
+        """把当前进程可用的CPU核按顺序分给各个子进程，核不够时返回None"""
+        try:
+            cpus = sorted(os.sched_getaffinity(0))
+        except AttributeError:
+            print("【embedding进程池】当前平台不支持绑定CPU")
+            return None
+        if len(cpus) < processes * threads:
+            print(f"【embedding进程池】可用CPU核（{len(cpus)}）少于 进程数×线程数，不绑定CPU")
+            return None
+        return [cpus[i * threads:(i + 1) * threads] for i in range(processes)]
+    
+    def encode(self, texts, **kwargs):
+        """
+        编码一组文本（阻塞直到完成）
+        
+        文本较多时拆分给多个子进程并行编码。
+        
+        Returns:
+            numpy.ndarray: 形状为 (len(texts), dimension) 的向量
+        """
+        if not self._running:
+            raise RuntimeError("编码器已关闭")
+        
+        texts = list(texts)
+        batch_size = kwargs.get('batch_size', 32)
+        chunk_size = max(batch_size, -(-len(texts) // self.processes))
+        chunks = [texts[start:start + chunk_size] for start in range(0, len(texts), chunk_size)] or [[]]
+        
+        acquired = 0
+        try:
+            for _ in chunks:
+                if not self._slots.acquire(timeout=self.timeout):
+                    raise RuntimeError(f"embedding进程池排队超过 {self.timeout} 秒")
+                acquired += 1
+            results = [self._pool.apply_async(_embedding_worker_encode, (chunk, kwargs)) for chunk in chunks]
+            embeddings = []
+            try:
+                for result in results:
+                    embeddings.append(self._receive(result))
+            except BaseException:
+                # 超时或出错时其余子进程的结果不再读取，它们创建的共享内存块在完成后由后台线程释放
+                threading.Thread(target=self._release_abandoned, args=(results[len(embeddings):],),
+                                 name='embedding-shm-release', daemon=True).start()
+                raise
+            return np.concatenate(embeddings)
+        except multiprocessing.TimeoutError:
+            raise RuntimeError(f"embedding进程池编码超过 {self.timeout} 秒未返回") from None
+        finally:
+            for _ in range(acquired):
+                self._slots.release()
+    
+    def _receive(self, result):
+        """从子进程创建的共享内存块中复制出向量，并释放共享内存"""
+        name, shape = result.get(self.timeout)
+        block = shared_memory.SharedMemory(name=name)
+        try:
+            return np.ndarray(shape, dtype='float32', buffer=block.buf).copy()
+        finally:
+            block.close()
+            block.unlink()
+    
+    @staticmethod
+    def _release_abandoned(results):
+        """等待放弃读取的编码结果完成，释放它们的共享内存块"""
+        for result in results:
+            result.wait()
+            if result.successful():
+                _release_shared_block(result.get()[0])
+    
+    def close(self):
+        """停止子进程（已经提交的请求仍会被处理）"""
+        if self._running:
+            self._running = False
+            self._pool.close()
+            self._pool.join()
+
+
+class ReadWriteLock:
+    """
+    读写锁：读者之间互不阻塞，写者独占
+    
+    有写者在等待时新的读者会排队，避免检索流量持续不断时写者饿死。不可重入。
+    """
+    
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+    
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+    
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+def normalize_query(query):
+    """规范化查询文本作为缓存键：统一全角半角、合并空白、忽略大小写"""
+    return ' '.join(unicodedata.normalize('NFKC', query).split()).lower()
+
+
+class VectorShard:
+    """
+    向量库分片：一组索引文件、元数据库和WAL，带各自的锁
+    
+    不分片时整个向量库只有一个分片。按时间分片时只有最新的分片可写，
+    旧分片封存后只读，可以重建为更紧凑的索引类型并以内存映射方式打开。
+    索引带ID映射（IndexIDMap2），检索直接返回稳定的64位向量ID，与元数据的主键一致；
+    ID由调用方分配，必须递增。删除只写墓碑，检索时过滤，重建索引时才真正清除。
+    
+    并发约定：
+    - search() 之间互不阻塞：检索持有读写锁的读锁，FAISS检索期间释放GIL，可以真正并行。
+    - 写入（append / append_many / extend / delete / migrate_index / save / backup / seal）先用 _write_lock 互相串行，
+      编码、写WAL、写检查点文件、重建索引这些耗时操作都不阻塞检索；
+      只有把新向量和元数据加入内存、替换索引对象这一步持有写锁，期间检索短暂等待。
+    - 一次检索看到的是某次写入完成前或完成后的完整状态，不会看到只加了向量没加元数据的中间状态。
+    - 墓碑集合整体替换，删除不需要写锁。
+    - backup() 在 _write_lock 内做检查点并复制文件，备份中的索引和元数据条数一致。
+    - WAL累计 checkpoint_interval 条后在后台线程做检查点：持有 _write_lock 取快照（上次检查点之后的向量、
+      未写入的元数据、WAL当前长度），释放后再写文件，最后只截断快照之前的WAL，写文件期间追加照常进行。
+      所有检查点由 _checkpoint_lock 串行，获取顺序总是先 _checkpoint_lock 后 _write_lock。
+    """
+    
+    def __init__(self, index_path, metadata_path, wal_path, dimension, key=None,
+                 read_only=False, mmap_index=False):
+        """
+        打开或创建分片
+        
+        Args:
+            index_path: 索引文件路径
+            metadata_path: 元数据库路径
+            wal_path: WAL路径
+            dimension: 向量维度
+            key: 分片键（如 '2024-05'），不分片时为None
+            read_only: 是否以封存（只读）方式打开
+            mmap_index: 是否以内存映射方式打开索引文件
+        """
+        self.key = key
+        self.index_path = index_path
+        self.metadata_path = metadata_path
+        self.wal_path = wal_path
+        self.dimension = dimension
+        # 每累计多少条WAL记录做一次检查点（合并回索引和元数据文件）
+        self.checkpoint_interval = config.FAISS_CONFIG.get('checkpoint_interval', 100)
+        # 以内存映射方式打开索引文件，基础索引只读，新向量写入内存中的增量索引
+        self.mmap_index = mmap_index
+        # 上次封存没有完成（WAL还在）时先按可写方式打开，重放之后再封存
+        unfinished = read_only and os.path.exists(wal_path)
+        self.read_only = read_only and not unfinished
+        # 写者之间互斥
+        self._write_lock = threading.Lock()
+        # 检查点之间互斥（后台检查点写文件时不持有 _write_lock）
+        self._checkpoint_lock = threading.Lock()
+        self._checkpointing = False
+        self._checkpoint_thread = None
+        # 发布新状态时与检索互斥
+        self._rw_lock = ReadWriteLock()
+        # 迁移、压缩、封存时的重建互斥，重建期间其他写入照常进行
+        self._rebuild_lock = threading.Lock()
+        
+        # 加载或创建向量索引
+        self.index, self._delta = self._open_index()
+        # 索引文件中的向量数，之后添加的向量在下次检查点时写入
+        self._file_ntotal = self.index.ntotal if os.path.exists(self.index_path) else 0
+        # 元数据按需读取，只有被检索命中的记录才会反序列化
+        self.metadata = MetadataStore(self.metadata_path)
+        # 已删除、还没有从索引中清除的向量ID
+        self._tombstones = frozenset(self.metadata.tombstones())
+        
+        # 重放上次检查点之后追加的记录
+        self.wal = None
+        self._wal_records = 0
+        if not self.read_only:
+            self.wal = WriteAheadLog(self.wal_path)
+            self._replay_wal()
+        if unfinished:
+            self.seal(mmap_index=mmap_index)
+    
+    def _replay_wal(self):
+        """将WAL中的记录重新应用到内存中的索引和元数据"""
+        records = self.wal.replay()
+        if not records:
+            return
+        
+        # 检查点在两次文件替换之间崩溃时，索引和元数据可能只有一个包含了这些记录
+        indexed = self._next_indexed_id()
+        vectors = [(vector_id, embedding) for vector_id, embedding, _ in records
+                   if vector_id >= indexed]
+        if vectors:
+            self._add_vectors(np.array([embedding for _, embedding in vectors], dtype='float32'),
+                              np.array([vector_id for vector_id, _ in vectors], dtype='int64'))
+        next_id = self.metadata.next_id
+        self.metadata.extend((vector_id, metadata) for vector_id, _, metadata in records
+                             if vector_id >= next_id)
+        self._wal_records = len(records)
+        print(f"【向量库】从WAL恢复了 {len(records)} 条记录")
+    
+    def _next_indexed_id(self):
+        """索引中最大的ID加一（ID按递增顺序添加，最后一个即最大）"""
+        for index in (self._delta, self.index):
+            if index is not None and index.ntotal:
+                return int(index.id_map.at(index.ntotal - 1)) + 1
+        return 0
+    
+    def _open_index(self):
+        """
+        从磁盘加载索引，文件不存在时创建新索引
+        
+        内存映射模式下基础索引只读（向其中添加向量会导致FAISS直接abort），
+        新增向量写入增量索引，检查点时再合并回索引文件。
+        没有ID映射的旧版索引会先按位置编号转换一次。
+        
+        Returns:
+            tuple: (基础索引, 增量索引)，非内存映射模式或已封存时增量索引为None
+        """
+        if not os.path.exists(self.index_path):
+            # 创建新的FAISS索引（使用L2距离）
+            index = add_ids(create_empty_index(self.dimension))
+            if not self.mmap_index:
+                return index, None
+            faiss.write_index(index, self.index_path)
+        
+        delta = None
+        if self.mmap_index:
+            # 较新的FAISS用 IO_FLAG_MMAP_IFC 映射所有类型的向量数据，旧版本只能用 IO_FLAG_MMAP 映射IVF倒排表
+            flags = getattr(faiss, 'IO_FLAG_MMAP_IFC', faiss.IO_FLAG_MMAP)
+            index = faiss.read_index(self.index_path, flags)
+            if not isinstance(index, faiss.IndexIDMap):
+                self._convert_legacy_index()
+                index = faiss.read_index(self.index_path, flags)
+            if not self.read_only:
+                delta = faiss.IndexIDMap2(faiss.IndexFlatL2(self.dimension))
+        else:
+            index = faiss.read_index(self.index_path)
+            if not isinstance(index, faiss.IndexIDMap):
+                index = self._convert_legacy_index()
+        apply_search_params(index)
+        enable_reconstruct(index)
+        return index, delta
+    
+    def _convert_legacy_index(self):
+        """给旧版索引文件加上ID映射并写回，返回转换后的索引"""
+        index = add_ids(faiss.read_index(self.index_path))
+        index_tmp = f"{self.index_path}.tmp"
+        faiss.write_index(index, index_tmp)
+        os.replace(index_tmp, self.index_path)
+        print(f"【向量库】已为索引文件加上ID映射: {self.index_path}（{index.ntotal} 条）")
+        return index
+    
+    def _add_vectors(self, vectors, ids):
+        """把向量添加到可写的索引中（需持有读写锁的写锁，或在初始化阶段调用）"""
+        if self.read_only:
+            raise RuntimeError(f"分片 {self.key} 已封存，不能再写入")
+        if self._delta is not None:
+            self._delta.add_with_ids(vectors, ids)
+        else:
+            self.index.add_with_ids(vectors, ids)
+    
+    def _reconstruct_all(self, start=0):
+        """
+        按添加顺序取出基础索引和增量索引中的全部向量
+        
+        Returns:
+            tuple: (向量矩阵, ID数组)
+        """
+        base_start = min(start, self.index.ntotal)
+        vectors = reconstruct_vectors(self.index, start=base_start)
+        ids = index_ids(self.index, start=base_start)
+        if self._delta is not None and self._delta.ntotal:
+            delta_start = max(start - self.index.ntotal, 0)
+            vectors = np.vstack([vectors, reconstruct_vectors(self._delta, start=delta_start)])
+            ids = np.concatenate([ids, index_ids(self._delta, start=delta_start)])
+        return vectors, ids
+    
+    def _search_vectors(self, query_vectors, k):
+        """
+        在基础索引和增量索引中检索并合并结果
+        
+        Returns:
+            tuple: (distances, ids)，不足k个时以-1填充
+        """
+        distances, ids = self.index.search(query_vectors, k)
+        if self._delta is None or self._delta.ntotal == 0:
+            return distances, ids
+        
+        delta_distances, delta_ids = self._delta.search(query_vectors, k)
+        distances = np.hstack([distances, delta_distances])
+        ids = np.hstack([ids, delta_ids])
+        # 未命中的位置距离设为无穷大，排到最后
+        distances = np.where(ids >= 0, distances, np.inf)
+        order = np.argsort(distances, axis=1)[:, :k]
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(ids, order, axis=1)
+    
+    @property
+    def next_id(self):
+        """本分片中下一条记录的ID（已清除的最大ID也计算在内）"""
+        return max(self.metadata.next_id, self._next_indexed_id())
+    
+    def append(self, vector_id, embedding, record):
+        """
+        添加一条记录：先写WAL再发布到内存，日志足够长时在后台做检查点
+        
+        Args:
+            vector_id: 向量ID，大于本分片已有的所有ID
+            embedding: float32 向量
+            record: 元数据字典
+        """
+        self.append_many(np.array([embedding]), np.array([vector_id], dtype='int64'), [record])
+    
+    def append_many(self, embeddings, ids, records):
+        """
+        添加一批记录：整批只写一次WAL（一次fsync），检查点同样按 checkpoint_interval 在后台进行
+        
+        Args:
+            embeddings: 形状为 (n, dimension) 的float32矩阵
+            ids: 递增的int64向量ID
+            records: 元数据字典列表
+        """
+        with self._write_lock:
+            # 先写日志再改内存，保证已返回的写入在崩溃后可以恢复；fsync期间检索不受影响
+            self.wal.append_many(list(zip(ids.tolist(), embeddings, records)))
+            with self._rw_lock.write():
+                self._add_vectors(embeddings, ids)
+                self.metadata.extend(zip(ids.tolist(), records))
+            self._wal_records += len(records)
+            
+            # 日志足够长时在后台合并回基础文件，本次写入不等待
+            if self._wal_records >= self.checkpoint_interval and not self._checkpointing:
+                self._checkpointing = True
+                self._checkpoint_thread = threading.Thread(target=self._background_checkpoint,
+                                                           name='shard-checkpoint', daemon=True)
+                self._checkpoint_thread.start()
+    
+    def extend(self, embeddings, ids, records):
+        """批量添加记录（不写WAL，由调用方决定何时做检查点）"""
+        with self._write_lock:
+            with self._rw_lock.write():
+                self._add_vectors(embeddings, ids)
+                self.metadata.extend(zip(ids.tolist(), records))
+    
+    def delete(self, ids):
+        """
+        删除记录：持久化墓碑后替换墓碑集合，检索随即不再返回这些记录
+        
+        Args:
+            ids: 向量ID集合，不属于本分片的ID会被忽略
+        
+        Returns:
+            set: 本分片中实际删除的ID
+        """
+        with self._write_lock:
+            found = self.metadata.existing(ids) - self._tombstones
+            if found:
+                self.metadata.add_tombstones(found)
+                self._tombstones = self._tombstones | found
+        return found
+    
+    def tombstone_ratio(self):
+        """已删除未清除的向量占索引的比例"""
+        count = self._count()
+        return len(self._tombstones) / count if count else 0.0
+    
+    def migrate_index(self, index_type):
+        """
+        在线重建索引：迁移到指定类型，同时清除已删除的向量
+        
+        先在不持有任何锁的情况下用现有向量训练并构建新索引，期间仍可正常写入、删除和检索；
+        再补上构建期间新增的向量，原子地替换索引并写入文件，最后删除已清除记录的元数据。
+        
+        Returns:
+            int: 清除的已删除向量数
+        """
+        with self._rebuild_lock:
+            with self._write_lock:
+                source = (self.index, self._delta)
+                tombstones = self._tombstones
+                vectors, ids = self._reconstruct_all()
+            snapshot = len(ids)
+            
+            if tombstones:
+                live = ~np.isin(ids, np.fromiter(tombstones, dtype='int64'))
+                vectors, ids = vectors[live], ids[live]
+            
+            new_index = faiss.IndexIDMap2(create_index(self.dimension, index_type))
+            train_index(new_index, vectors)
+            enable_reconstruct(new_index)
+            
+            # 分块添加，避免一次性占用过多内存
+            chunk_size = config.FAISS_CONFIG.get('add_chunk_size', 65536)
+            for start in range(0, len(vectors), chunk_size):
+                new_index.add_with_ids(vectors[start:start + chunk_size], ids[start:start + chunk_size])
+            
+            with self._checkpoint_lock, self._write_lock:
+                if self.index is not source[0] or self._delta is not source[1]:
+                    raise RuntimeError("重建期间索引被替换，请重试")
+                # 构建期间新增的向量；其间删除的记录仍留在墓碑中，下次重建时清除
+                vectors, ids = self._reconstruct_all(start=snapshot)
+                new_index.add_with_ids(vectors, ids)
+                with self._rw_lock.write():
+                    self.index = new_index
+                    self._delta = None
+                    self._tombstones = self._tombstones - tombstones
+                if self.read_only:
+                    self._write_index(new_index)
+                else:
+                    self._checkpoint()
+                # 索引文件里已经没有这些向量，再删除它们的元数据
+                if tombstones:
+                    self.metadata.purge(tombstones)
+        return len(tombstones)
+    
+    def compact(self):
+        """
+        压缩：按当前类型重建索引，清除已删除的向量
+        
+        需要训练的类型剩余向量不足时改为flat。
+        
+        Returns:
+            int: 清除的向量数
+        """
+        index_type = get_index_type(self.index)
+        if index_type in TRAINED_INDEX_TYPES and self.count() < min_training_size(index_type):
+            index_type = 'flat'
+        return self.migrate_index(index_type)
+    
+    def seal(self, index_type=None, mmap_index=False):
+        """
+        封存分片：可选重建为更紧凑的索引类型，做最后一次检查点并删除WAL，之后只读
+        
+        重建和写文件期间检索照常进行；调用方需保证封存开始后不再写入本分片。
+        
+        Args:
+            index_type: 重建的目标类型，为None或训练数据不足时保持原类型
+            mmap_index: 封存后是否以内存映射方式打开索引文件
+        """
+        if self.read_only:
+            return
+        if (index_type and index_type != get_index_type(self.index)
+                and self.count() >= min_training_size(index_type)):
+            self.migrate_index(index_type)
+        
+        with self._checkpoint_lock, self._write_lock:
+            self._checkpoint()
+            self.wal.close()
+            os.remove(self.wal_path)
+            self.wal = None
+            self.read_only = True
+            self.mmap_index = mmap_index
+            index, delta = self._open_index()
+            with self._rw_lock.write():
+                self.index, self._delta = index, delta
+    
+    def _count(self):
+        if self._delta is not None:
+            return self.index.ntotal + self._delta.ntotal
+        return self.index.ntotal
+    
+    def count(self):
+        """获取本分片中未删除的向量数"""
+        with self._rw_lock.read():
+            return self._count() - len(self._tombstones)
+    
+    def close(self):
+        """等待后台检查点结束，关闭WAL和元数据库连接（WAL中的记录下次打开时重放）"""
+        thread = self._checkpoint_thread
+        if thread is not None:
+            thread.join()
+        with self._checkpoint_lock, self._write_lock:
+            if self.wal is not None:
+                self.wal.close()
+                self.wal = None
+            self.metadata.close()
+    
+    def save(self):
+        """保存索引和元数据到磁盘（检查点），并清空WAL"""
+        with self._checkpoint_lock, self._write_lock:
+            self._checkpoint()
+    
+    def backup(self, index_dest, metadata_dest):
+        """
+        先做检查点，再把索引和元数据复制到指定路径
+        
+        整个过程持有 _write_lock，备份期间没有新的写入，两份文件的条数一致。
+        """
+        with self._checkpoint_lock, self._write_lock:
+            self._checkpoint()
+            shutil.copy2(self.index_path, index_dest)
+            self.metadata.backup(metadata_dest)
+    
+    def _checkpoint(self):
+        """在持有 _checkpoint_lock 和 _write_lock 的情况下执行检查点，写文件期间检索照常进行"""
+        # 封存的分片文件已经完整
+        if self.read_only:
+            return
+        
+        with SAVE_SECONDS.time():
+            # 元数据只追加新记录
+            self.metadata.flush()
+            
+            if self._delta is None:
+                index = self.index
+            elif self._delta.ntotal:
+                # 内存映射的基础索引是只读的，合并时读入一份完整副本
+                index = faiss.read_index(self.index_path)
+                vectors, ids = self._reconstruct_all(start=self.index.ntotal)
+                index.add_with_ids(vectors, ids)
+            else:
+                index = None
+            
+            if index is not None:
+                self._write_index(index)
+            
+            # 基础文件已包含全部记录，日志可以清空
+            self.wal.truncate()
+            self._wal_records = 0
+            self._file_ntotal = self._count()
+    
+    def _background_checkpoint(self):
+        """
+        后台检查点：只在取快照和收尾时短暂持有 _write_lock
+        
+        非内存映射模式下读入索引文件，加上快照中的新向量后写回，内存中的索引不动；
+        内存映射模式下写完后重新映射，快照之后追加的向量移入新的增量索引。
+        """
+        try:
+            with self._checkpoint_lock:
+                with self._write_lock:
+                    # 等锁期间已经由其他检查点（保存、备份、封存）完成
+                    if self.read_only or not self._wal_records:
+                        return
+                    start = self._file_ntotal
+                    vectors, ids = self._reconstruct_all(start=start)
+                    records = self.metadata.pending()
+                    wal_size = self.wal.size()
+                    wal_records = self._wal_records
+                
+                # 写文件期间不持有 _write_lock，追加和检索照常进行
+                with SAVE_SECONDS.time():
+                    self.metadata.write(records)
+                    if len(ids):
+                        if os.path.exists(self.index_path):
+                            index = faiss.read_index(self.index_path)
+                        else:
+                            index = add_ids(create_index(self.dimension, get_index_type(self.index)))
+                        index.add_with_ids(vectors, ids)
+                        self._replace_index_file(index)
+                    
+                    with self._write_lock:
+                        self.metadata.commit(records)
+                        self.wal.truncate(wal_size)
+                        self._wal_records -= wal_records
+                        self._file_ntotal = start + len(ids)
+                        if self.mmap_index and len(ids):
+                            # 快照之后追加的向量还不在文件中，放进新的增量索引
+                            vectors, ids = self._reconstruct_all(start=self._file_ntotal)
+                            index, delta = self._open_index()
+                            if len(ids):
+                                delta.add_with_ids(vectors, ids)
+                            with self._rw_lock.write():
+                                self.index, self._delta = index, delta
+        except Exception as e:
+            # 记录仍在WAL中，下次追加时重试
+            print(f"【向量库】后台检查点失败: {e}")
+        finally:
+            self._checkpointing = False
+    
+    def _write_index(self, index):
+        """把索引写入文件（需持有 _write_lock），内存映射模式下随后重新映射"""
+        self._replace_index_file(index)
+        if self.mmap_index:
+            index, delta = self._open_index()
+            with self._rw_lock.write():
+                self.index, self._delta = index, delta
+    
+    def _replace_index_file(self, index):
+        """先写临时文件再原子替换，避免写到一半时崩溃导致基础文件损坏"""
+        index_tmp = f"{self.index_path}.tmp"
+        faiss.write_index(index, index_tmp)
+        os.replace(index_tmp, self.index_path)
+    
+    def _reconstruct_ids(self, ids):
+        """按ID取回若干向量（需持有读锁）"""
+        delta_start = None
+        if self._delta is not None and self._delta.ntotal:
+            delta_start = self._delta.id_map.at(0)
+        vectors = [self._delta.reconstruct(i) if delta_start is not None and i >= delta_start
+                   else self.index.reconstruct(i) for i in ids]
+        return np.array(vectors, dtype='float32')
+    
+    def search(self, query_embedding, k, max_distance=None, with_vectors=False):
+        """
+        在本分片中检索，跳过已删除的记录
+        
+        Args:
+            query_embedding: 形状为 (1, dimension) 的查询向量
+            k: 最多返回的候选数
+            max_distance: L2距离上限
+            with_vectors: 是否同时取回候选的向量（MMR需要）
+        
+        Returns:
+            tuple: ([(距离, 向量ID), ...] 按距离升序, 候选向量矩阵或None)
+        """
+        with self._rw_lock.read():
+            count = self._count()
+            if count == 0:
+                return [], None
+            tombstones = self._tombstones
+            
+            # 已删除的记录会占用候选名额，不够k个时扩大范围重新检索
+            search_k = min(count, k + min(len(tombstones), k))
+            while True:
+                distances, ids = self._search_vectors(query_embedding, search_k)
+                hits = [(float(distances[0][i]), int(vector_id)) for i, vector_id in enumerate(ids[0])
+                        if vector_id >= 0 and vector_id not in tombstones
+                        and (max_distance is None or distances[0][i] <= max_distance)]
+                exhausted = (search_k >= count or ids[0][-1] < 0
+                             or (max_distance is not None and distances[0][-1] > max_distance))
+                if len(hits) >= k or not tombstones or exhausted:
+                    break
+                search_k = min(count, search_k * 2)
+            hits = hits[:k]
+            
+            vectors = None
+            if with_vectors and hits:
+                vectors = self._reconstruct_ids([vector_id for _, vector_id in hits])
+        return hits, vectors
+
+
+# 按时间分片的周期及对应的分片键格式，键按字典序排列即为时间顺序
+SHARD_PERIODS = {
+    'day': '%Y-%m-%d',
+    'week': '%G-W%V',
+    'month': '%Y-%m',
+}
+SHARD_INDEX_FILE = 'vector_index.faiss'
+SHARD_METADATA_FILE = 'vector_metadata.db'
+SHARD_WAL_FILE = 'vector_index.faiss.wal'
+
+
+def list_shards(shard_dir):
+    """按时间顺序列出分片目录下已有的分片键"""
+    if not os.path.isdir(shard_dir):
+        return []
+    return sorted(name for name in os.listdir(shard_dir)
+                  if os.path.isdir(os.path.join(shard_dir, name)))
+
+
+def shard_paths(shard_dir, key):
+    """
+    分片的文件路径
+    
+    Returns:
+        tuple: (索引文件, 元数据库, WAL)
+    """
+    directory = os.path.join(shard_dir, key)
+    return (os.path.join(directory, SHARD_INDEX_FILE),
+            os.path.join(directory, SHARD_METADATA_FILE),
+            os.path.join(directory, SHARD_WAL_FILE))
+
+
 class VectorStore:
-    def __init__(self, index_path=None, metadata_path=None):
-        # 从配置文件读取路径
-        self.index_path = index_path or config.FAISS_CONFIG['index_path']
-        self.metadata_path = metadata_path or config.FAISS_CONFIG['metadata_path']
+    """
+    FAISS向量库
+    
+    数据存放在一个或多个 VectorShard 中，各分片的并发约定见 VectorShard。
+    配置了 shard_by 时按记录写入时间分片（如每月一个），只有最新的分片可写；
+    进入新周期时自动创建新分片，旧分片在后台封存（重建为紧凑索引、只读、可内存映射）。
+    检索在线程池中并行查询所有分片再合并 top-k，FAISS检索期间释放GIL。
+    
+    分片列表整体替换（写时复制），检索开始时取一次列表，之后新建的分片不影响本次检索。
+    写入先持有 _write_lock 分配向量ID、选择（必要时新建）可写分片，再写入该分片。
+    向量ID在所有分片中全局递增且不重复使用，检索结果的 'id' 可以传给 delete()。
+    删除后已删除向量的比例超过 compact_threshold 的分片会在后台压缩。
+    """
+    
+    def __init__(self, index_path=None, metadata_path=None, model=None):
+        """
+        Args:
+            index_path: 索引文件路径（不分片时），为None时读取配置
+            metadata_path: 元数据库路径（不分片时），为None时读取配置
+            model: 已加载的embedding模型或任何提供 encode(texts) 的对象，为None时按配置加载
+        """
+        faiss_config = config.FAISS_CONFIG
+        # 以内存映射方式打开可写分片的索引文件
+        self.mmap_index = faiss_config.get('mmap_index', False)
+        # 按时间分片：None（不分片）/ 'day' / 'week' / 'month'
+        self.shard_by = faiss_config.get('shard_by')
+        if self.shard_by and self.shard_by not in SHARD_PERIODS:
+            raise ValueError(f"不支持的分片周期: {self.shard_by}，可选: {', '.join(SHARD_PERIODS)}")
+        self.shard_dir = faiss_config.get('shard_dir', 'vector_shards')
+        # 旧分片封存时重建的索引类型和打开方式
+        self.sealed_index_type = faiss_config.get('sealed_index_type') or faiss_config.get('index_type', 'flat')
+        self.mmap_sealed_shards = faiss_config.get('mmap_sealed_shards', True)
+        # 写者之间互斥，并保护向量ID的分配和可写分片的切换
+        self._write_lock = threading.Lock()
+        self._seal_thread = None
+        # 正在后台压缩的分片
+        self._compact_lock = threading.Lock()
+        self._compacting = set()
         
-        # 加载嵌入模型
-        self._load_model()
+        # 查询向量缓存和检索结果缓存；结果缓存以索引代数为键的一部分，写入后自动失效
+        cache_config = getattr(config, 'CACHE_CONFIG', {})
+        self.generation = 0
+        # 写入、删除、迁移可能在不同线程中同时完成，代数递增和清空缓存需要互斥
+        self._generation_lock = threading.Lock()
+        self.embedding_cache = LRUCache(cache_config.get('embedding_cache_size', 1024),
+                                        cache_config.get('embedding_cache_ttl', 3600))
+        self.result_cache = LRUCache(cache_config.get('result_cache_size', 1024),
+                                     cache_config.get('result_cache_ttl', 300))
+        self._search_flights = SingleFlight()
+        
+        # 加载嵌入模型；自己加载的模型（进程池）关闭时一并停止
+        self._owns_model = model is None
+        if model is None:
+            self._load_model()
+        else:
+            self.model = model
         
         # 获取向量维度
         if config.EMBEDDING_CONFIG['vector_dimension']:
@@ -23,32 +1620,154 @@ class VectorStore:
             test_embedding = self.model.encode(['test'])
             self.dimension = test_embedding.shape[1]
         
-        # 加载或创建向量索引
-        if os.path.exists(self.index_path):
-            self.index = faiss.read_index(self.index_path)
-            with open(self.metadata_path, 'rb') as f:
-                self.metadata = pickle.load(f)
+        # 并发的编码请求合并成批次
+        embedding_config = config.EMBEDDING_CONFIG
+        if isinstance(self.model, EmbeddingWorkerPool):
+            # 进程池本身就能并行处理多个请求，不再合并成单线程的批次
+            self.encoder = self.model
+        elif embedding_config.get('micro_batching', True):
+            self.encoder = EmbeddingBatcher(self.model,
+                                            embedding_config.get('batch_size', 32),
+                                            embedding_config.get('batch_wait_ms', 5))
         else:
-            # 创建新的FAISS索引（使用L2距离）
-            self.index = faiss.IndexFlatL2(self.dimension)
-            self.metadata = []
+            self.encoder = self.model
+        
+        # 打开分片
+        if self.shard_by:
+            self.shards = self._open_shards()
+            self._search_pool = ThreadPoolExecutor(max_workers=faiss_config.get('search_threads', 4),
+                                                   thread_name_prefix='shard-search')
+        else:
+            index_path = index_path or faiss_config['index_path']
+            wal_path = faiss_config.get('wal_path') or f"{index_path}.wal"
+            self.shards = [VectorShard(index_path, metadata_path or faiss_config['metadata_path'],
+                                       wal_path, self.dimension, mmap_index=self.mmap_index)]
+            self._search_pool = None
+            
+            configured_type = faiss_config.get('index_type', 'flat')
+            if get_index_type(self.index) != configured_type:
+                print(f"【向量库】当前索引类型为 {get_index_type(self.index)}，配置为 {configured_type}，"
+                      f"可运行 python init_db.py --migrate 迁移")
+        
+        # 下一条记录的ID；旧分片的ID都小于新分片
+        self._next_id = max(shard.next_id for shard in self.shards)
+        # 上次压缩没有完成时继续
+        self._maybe_compact()
+    
+    # 可写分片的属性，不分片时即整个向量库
+    @property
+    def index_path(self):
+        return self.shards[-1].index_path
+    
+    @property
+    def metadata_path(self):
+        return self.shards[-1].metadata_path
+    
+    @property
+    def wal_path(self):
+        return self.shards[-1].wal_path
+    
+    @property
+    def index(self):
+        return self.shards[-1].index
+    
+    @property
+    def metadata(self):
+        return self.shards[-1].metadata
+    
+    @property
+    def wal(self):
+        return self.shards[-1].wal
+    
+    def _open_shards(self):
+        """打开分片目录下的全部分片，最新的可写，其余封存"""
+        keys = list_shards(self.shard_dir)
+        if not keys:
+            keys = [self._shard_key(datetime.now())]
+            self._adopt_unsharded_files(keys[0])
+        
+        shards = [self._open_shard(key, read_only=True) for key in keys[:-1]]
+        shards.append(self._open_shard(keys[-1]))
+        print(f"【向量库】按 {self.shard_by} 分片，共 {len(shards)} 个分片，可写分片: {keys[-1]}")
+        return shards
+    
+    def _open_shard(self, key, read_only=False):
+        index_path, metadata_path, wal_path = shard_paths(self.shard_dir, key)
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        mmap_index = self.mmap_sealed_shards if read_only else self.mmap_index
+        return VectorShard(index_path, metadata_path, wal_path, self.dimension, key=key,
+                           read_only=read_only, mmap_index=mmap_index)
+    
+    def _adopt_unsharded_files(self, key):
+        """首次启用分片时，把原来未分片的索引、元数据和WAL移入第一个分片"""
+        faiss_config = config.FAISS_CONFIG
+        index_path = faiss_config['index_path']
+        metadata_path = faiss_config['metadata_path']
+        wal_path = faiss_config.get('wal_path') or f"{index_path}.wal"
+        if not os.path.exists(index_path) and not os.path.exists(metadata_path):
+            return
+        
+        shard_index, shard_metadata, shard_wal = shard_paths(self.shard_dir, key)
+        os.makedirs(os.path.dirname(shard_index), exist_ok=True)
+        moves = [(index_path, shard_index), (wal_path, shard_wal)]
+        moves += [(metadata_path + suffix, shard_metadata + suffix) for suffix in ('', '-wal', '-shm')]
+        for source, dest in moves:
+            if os.path.exists(source):
+                os.replace(source, dest)
+        print(f"【向量库】已把未分片的数据移入分片 {key}")
+    
+    def _shard_key(self, when):
+        return when.strftime(SHARD_PERIODS[self.shard_by])
+    
+    def _writable_shard(self, now):
+        """返回当前可写的分片，进入新周期时先切换到新分片（需持有 _write_lock）"""
+        shard = self.shards[-1]
+        if self.shard_by:
+            key = self._shard_key(now)
+            # 时钟回拨时继续写最新的分片
+            if key > shard.key:
+                shard = self._rollover(key)
+        return shard
+    
+    def _rollover(self, key):
+        """创建新的可写分片，并在后台封存原来的分片（需持有 _write_lock）"""
+        previous = self.shards[-1]
+        # 批量导入的记录不写WAL，先做检查点，后台封存失败也不会丢失
+        previous.save()
+        shard = self._open_shard(key)
+        # 立即落盘，备份和 init_db.py --info 都能看到新分片
+        shard.save()
+        self.shards = self.shards + [shard]
+        print(f"【向量库】切换到新分片 {key}，开始封存分片 {previous.key}")
+        
+        self._seal_thread = threading.Thread(target=self._seal_shard, args=(previous,), daemon=True)
+        self._seal_thread.start()
+        return shard
+    
+    def _seal_shard(self, shard):
+        """在后台线程中封存旧分片，期间检索照常进行"""
+        start = time.time()
+        try:
+            shard.seal(self.sealed_index_type, self.mmap_sealed_shards)
+        except Exception as e:
+            # WAL还在，下次启动时会重新封存
+            print(f"【向量库】封存分片 {shard.key} 失败: {e}")
+            return
+        print(f"【向量库】分片 {shard.key} 已封存: {get_index_type(shard.index)}，"
+              f"{shard.count()} 条向量，耗时 {time.time() - start:.1f} 秒")
     
     def _load_model(self):
-        """根据配置加载embedding模型"""
+        """根据配置加载embedding模型，配置了 worker_processes 时在独立的进程池中加载"""
         embedding_config = config.EMBEDDING_CONFIG
-        
-        if embedding_config['model_type'] == 'local':
-            # 使用本地模型
-            model_path = embedding_config['local_model_path']
-            if not os.path.exists(model_path):
-                raise FileNotFoundError(f"本地模型路径不存在: {model_path}")
-            print(f"正在加载本地模型: {model_path}")
-            self.model = SentenceTransformer(model_path, device=embedding_config['device'])
+        processes = embedding_config.get('worker_processes', 0)
+        if processes:
+            self.model = EmbeddingWorkerPool(processes,
+                                             max_pending=embedding_config.get('worker_max_pending', 64),
+                                             timeout=embedding_config.get('worker_timeout', 60),
+                                             threads=embedding_config.get('worker_threads', 1),
+                                             pin_cpus=embedding_config.get('worker_pin_cpus', False))
         else:
-            # 使用HuggingFace模型
-            model_name = embedding_config['hf_model_name']
-            print(f"正在加载HuggingFace模型: {model_name}")
-            self.model = SentenceTransformer(model_name, device=embedding_config['device'])
+            self.model = load_embedding_model()
     
     def add_conversation(self, summary, conversation_history):
         """
@@ -57,63 +1776,383 @@ class VectorStore:
         Args:
             summary: 对话总结文本
             conversation_history: 原始对话历史
+        
+        Returns:
+            int: 新记录的向量ID
+        """
+        with ADD_SECONDS.time():
+            # 生成向量
+            with ENCODE_SECONDS.time():
+                embedding = self.encoder.encode([summary])[0]
+            embedding = embedding.astype('float32')
+            
+            now = datetime.now()
+            record = {
+                'summary': summary,
+                'conversation': conversation_history,
+                'timestamp': now.isoformat()
+            }
+            
+            with self._write_lock:
+                vector_id = self._next_id
+                self._writable_shard(now).append(vector_id, embedding, record)
+                self._next_id += 1
+                self._bump_generation()
+            return vector_id
+    
+    def add_conversations(self, items):
+        """
+        写入一批对话总结（归档队列使用）
+        
+        一次编码，整批只写一次WAL（一次fsync），检查点仍按 checkpoint_interval 在后台进行。
+        带 'key' 的记录按键去重：键已经写入过的记录直接跳过，调用方重试同一批时不会重复添加。
+        
+        Args:
+            items: 字典列表，包含 'summary'，可选 'conversation' 和 'key'
+        
+        Returns:
+            int: 实际添加的条数
+        """
+        if not items:
+            return 0
+        with ADD_SECONDS.time():
+            with ENCODE_SECONDS.time():
+                embeddings = self.encoder.encode([item['summary'] for item in items])
+            embeddings = np.asarray(embeddings, dtype='float32')
+            now = datetime.now()
+            records = [{
+                'summary': item['summary'],
+                'conversation': item.get('conversation', []),
+                'timestamp': now.isoformat(),
+                'key': item.get('key')
+            } for item in items]
+            
+            with self._write_lock:
+                keys = [record['key'] for record in records if record['key'] is not None]
+                if keys:
+                    existing = set()
+                    for shard in self.shards:
+                        existing |= shard.metadata.existing_keys(keys)
+                    if existing:
+                        keep = [i for i, record in enumerate(records) if record['key'] not in existing]
+                        embeddings = embeddings[keep]
+                        records = [records[i] for i in keep]
+                        if not records:
+                            return 0
+                
+                ids = np.arange(self._next_id, self._next_id + len(records), dtype='int64')
+                self._writable_shard(now).append_many(embeddings, ids, records)
+                self._next_id += len(records)
+                self._bump_generation()
+            return len(records)
+    
+    def add_conversations_batch(self, items, chunk_size=1024, persist=True, progress=None):
+        """
+        批量添加对话总结
+        
+        按块编码并添加到索引，不写WAL，persist=True 时结束后只做一次检查点。
+        中途失败时内存中已添加的记录会在下次检查点时一起保存，调用方可据此续传。
+        分片时按写入时间（而不是记录自带的 timestamp）进入当前可写分片。
+        
+        Args:
+            items: 可迭代的字典，包含 'summary'，可选 'conversation' 和 'timestamp'
+            chunk_size: 每次编码和添加的条数
+            persist: 结束后是否立即做检查点
+            progress: 回调函数 progress(已添加条数)，每块完成后调用
+        
+        Returns:
+            int: 添加的条数
         """
-        # 生成向量
-        embedding = self.model.encode([summary])[0]
-        embedding = embedding.astype('float32')
+        added = 0
+        chunk = []
         
-        # 添加到FAISS索引
-        self.index.add(np.array([embedding]))
+        def flush_chunk():
+            with ENCODE_SECONDS.time():
+                embeddings = self.encoder.encode([item['summary'] for item in chunk])
+            embeddings = np.asarray(embeddings, dtype='float32')
+            now = datetime.now()
+            records = [{
+                'summary': item['summary'],
+                'conversation': item.get('conversation', []),
+                'timestamp': item.get('timestamp') or now.isoformat()
+            } for item in chunk]
+            
+            with self._write_lock:
+                ids = np.arange(self._next_id, self._next_id + len(records), dtype='int64')
+                self._writable_shard(now).extend(embeddings, ids, records)
+                self._next_id += len(records)
+                self._bump_generation()
         
-        # 保存元数据
-        self.metadata.append({
-            'summary': summary,
-            'conversation': conversation_history,
-            'timestamp': datetime.now().isoformat()
-        })
+        for item in items:
+            chunk.append(item)
+            if len(chunk) >= chunk_size:
+                flush_chunk()
+                added += len(chunk)
+                chunk = []
+                if progress:
+                    progress(added)
+        if chunk:
+            flush_chunk()
+            added += len(chunk)
+            if progress:
+                progress(added)
         
-        # 保存索引和元数据
-        self.save()
+        if persist and added:
+            self.save()
+        return added
+    
+    def delete(self, ids):
+        """
+        删除记录
+        
+        只写入墓碑，不阻塞检索，之后的检索不再返回这些记录；
+        分片中已删除向量的比例超过 compact_threshold 时在后台重建该分片的索引，真正清除它们。
+        
+        Args:
+            ids: 向量ID列表（检索结果中的 'id'）
+        
+        Returns:
+            int: 删除的条数，不存在或已经删除的ID不计入
+        """
+        ids = {int(vector_id) for vector_id in ids}
+        deleted = 0
+        for shard in self.shards:
+            deleted += len(shard.delete(ids))
+        if deleted:
+            self._bump_generation()
+            self._maybe_compact()
+        return deleted
+    
+    def _maybe_compact(self):
+        """为已删除比例超过阈值的分片启动后台压缩，每个分片同时只有一个"""
+        threshold = config.FAISS_CONFIG.get('compact_threshold', 0.2)
+        with self._compact_lock:
+            for shard in self.shards:
+                if shard in self._compacting or shard.tombstone_ratio() < threshold:
+                    continue
+                self._compacting.add(shard)
+                threading.Thread(target=self._compact_shard, args=(shard,), daemon=True).start()
+    
+    def _compact_shard(self, shard):
+        """在后台线程中压缩分片，期间检索、写入和删除照常进行"""
+        name = f"分片 {shard.key} " if shard.key else ""
+        start = time.time()
+        try:
+            removed = shard.compact()
+            print(f"【向量库】{name}压缩完成，清除了 {removed} 条已删除的向量，耗时 {time.time() - start:.1f} 秒")
+        except Exception as e:
+            # 墓碑还在，下次删除或启动时会重试
+            print(f"【向量库】{name}压缩失败: {e}")
+        finally:
+            with self._compact_lock:
+                self._compacting.discard(shard)
+    
+    def migrate_index(self, index_type=None):
+        """
+        在线把索引迁移到新的类型，分片时逐个迁移全部分片
+        
+        构建新索引期间仍可正常写入和检索，已删除的向量同时被清除，见 VectorShard.migrate_index。
+        
+        Args:
+            index_type: 目标索引类型，为None时读取配置
+        
+        Returns:
+            str: 迁移后的索引类型
+        """
+        index_type = index_type or config.FAISS_CONFIG.get('index_type', 'flat')
+        
+        for shard in self.shards:
+            shard.migrate_index(index_type)
+            if shard.key:
+                print(f"【向量库】分片 {shard.key} 已迁移为 {index_type}")
+        self._bump_generation()
+        
+        print(f"【向量库】索引已迁移为 {index_type}，共 {self.get_count()} 条向量")
+        return index_type
+    
+    def _bump_generation(self):
+        """索引内容变化并发布之后调用，使旧的检索结果缓存失效（任何线程都可以调用）"""
+        with self._generation_lock:
+            self.generation += 1
+            self.result_cache.clear()
+    
+    def encode_query(self, query):
+        """
+        生成查询向量，相同（规范化后）的查询直接使用缓存
+        
+        Returns:
+            numpy.ndarray: 形状为 (1, dimension) 的float32向量
+        """
+        key = normalize_query(query)
+        embedding = self.embedding_cache.get(key)
+        if embedding is None:
+            with ENCODE_SECONDS.time():
+                embedding = self.encoder.encode([query])[0]
+            embedding = embedding.astype('float32').reshape(1, -1)
+            self.embedding_cache.put(key, embedding)
+        return embedding
+    
+    def get_cache_stats(self):
+        """获取查询向量缓存和检索结果缓存的统计信息"""
+        return {
+            'generation': self.generation,
+            'embedding_cache': self.embedding_cache.get_stats(),
+            'result_cache': self.result_cache.get_stats(),
+            'coalesced_searches': self._search_flights.coalesced
+        }
     
     def get_count(self):
         """获取当前向量总数"""
-        return self.index.ntotal
+        return sum(shard.count() for shard in self.shards)
+    
+    def get_shard_info(self):
+        """
+        获取各分片的状态
+        
+        Returns:
+            list: 每个分片的键、索引类型、向量数、已删除未清除的向量数、是否封存和是否内存映射
+        """
+        return [{
+            'key': shard.key,
+            'index_type': get_index_type(shard.index),
+            'count': shard.count(),
+            'deleted': len(shard._tombstones),
+            'sealed': shard.read_only,
+            'mmap': shard.mmap_index
+        } for shard in self.shards]
     
     def save(self):
-        """保存索引和元数据到磁盘"""
-        faiss.write_index(self.index, self.index_path)
-        with open(self.metadata_path, 'wb') as f:
-            pickle.dump(self.metadata, f)
+        """保存可写分片的索引和元数据到磁盘（检查点），并清空WAL"""
+        with self._write_lock:
+            self.shards[-1].save()
+    
+    def close(self):
+        """停止后台封存和检查点，关闭WAL和元数据库连接，之后不能再使用本对象"""
+        seal_thread = self._seal_thread
+        if seal_thread is not None:
+            seal_thread.join()
+        if self._search_pool is not None:
+            self._search_pool.shutdown()
+        if isinstance(self.encoder, EmbeddingBatcher):
+            self.encoder.close()
+        if self._owns_model and isinstance(self.model, EmbeddingWorkerPool):
+            self.model.close()
+        for shard in self.shards:
+            shard.close()
+    
+    def backup(self, index_dest, metadata_dest):
+        """
+        先做检查点，再把索引和元数据复制到指定路径
+        
+        整个过程持有 _write_lock，备份期间没有新的写入，两份文件的条数一致。
+        分片时每个分片备份一组文件，文件名在扩展名前加上分片键。
+        
+        Returns:
+            list: 写入的 (索引文件, 元数据文件) 路径
+        """
+        written = []
+        with self._write_lock:
+            for shard in self.shards:
+                if shard.key:
+                    index_base, index_ext = os.path.splitext(index_dest)
+                    metadata_base, metadata_ext = os.path.splitext(metadata_dest)
+                    paths = (f"{index_base}_{shard.key}{index_ext}", f"{metadata_base}_{shard.key}{metadata_ext}")
+                else:
+                    paths = (index_dest, metadata_dest)
+                shard.backup(*paths)
+                written.append(paths)
+        return written
     
-    def search(self, query, k=5):
+    def search(self, query, k=5, fields=('summary', 'conversation'),
+               max_distance=None, diversity=None, max_chars=None, candidates=4):
         """
         搜索相似对话
         
         Args:
             query: 查询文本
             k: 返回最相似的k个结果
+            fields: 需要返回的元数据字段，只会读取这些字段
+            max_distance: L2距离上限，超过的结果直接丢弃
+            diversity: 0~1，设置后先取 k*candidates 个候选，再用MMR选出互不重复的k个
+            max_chars: 结果 summary 的总字数上限，放不下的结果会被跳过
+            candidates: 使用MMR时候选数量是k的多少倍
         
         Returns:
-            list: 相似对话列表
+            list: 相似对话列表，每条包含请求的字段、'id' 和 'distance'
         """
-        if self.index.ntotal == 0:
+        with SEARCH_SECONDS.time():
+            return self._search(query, k, fields, max_distance, diversity, max_chars, candidates)
+    
+    def _search(self, query, k, fields, max_distance, diversity, max_chars, candidates):
+        """search 的实现（不含计时）"""
+        shards = self.shards
+        if all(shard._count() == 0 for shard in shards):
             return []
         
-        # 生成查询向量
-        query_embedding = self.model.encode([query])[0]
-        query_embedding = query_embedding.astype('float32').reshape(1, -1)
+        # 先读代数再检索，检索期间发生写入时结果只会缓存在旧代数下
+        cache_key = (normalize_query(query), k, tuple(fields), max_distance, diversity,
+                     max_chars, candidates, self.generation)
+        cached = self.result_cache.get(cache_key)
+        if cached is not None:
+            return [dict(record) for record in cached]
+        
+        # 相同的查询正在检索（例如输入时的预取）时等待那一次的结果，不重复编码和检索
+        results = self._search_flights.do(cache_key, lambda: self._search_uncached(
+            shards, query, k, fields, max_distance, diversity, max_chars, candidates, cache_key))
+        return [dict(record) for record in results]
+    
+    def _search_uncached(self, shards, query, k, fields, max_distance, diversity, max_chars, candidates, cache_key):
+        """执行一次检索并写入结果缓存，参数见 search"""
+        # 生成查询向量（不持锁）
+        query_embedding = self.encode_query(query)
+        
+        # 每个分片各取 search_k 个候选，多个分片时并行检索
+        search_k = k * candidates if diversity is not None else k
+        with_vectors = diversity is not None
+        if len(shards) == 1:
+            shard_results = [shards[0].search(query_embedding, search_k, max_distance, with_vectors)]
+        else:
+            shard_results = list(self._search_pool.map(
+                lambda shard: shard.search(query_embedding, search_k, max_distance, with_vectors), shards))
         
-        # 搜索
-        distances, indices = self.index.search(query_embedding, k)
+        # 合并为全局的 top search_k
+        hits = []
+        for shard, (shard_hits, vectors) in zip(shards, shard_results):
+            for i, (distance, vector_id) in enumerate(shard_hits):
+                hits.append((distance, shard, vector_id, vectors[i] if vectors is not None else None))
+        hits.sort(key=lambda hit: hit[0])
+        hits = hits[:search_k]
+        
+        # 在候选中选出彼此差异较大的结果，去掉几乎重复的记忆
+        if diversity is not None and len(hits) > 1:
+            vectors = np.array([hit[3] for hit in hits])
+            hits = [hits[i] for i in mmr_select(query_embedding[0], vectors, k, diversity)]
+        
+        # 只读取命中的行；计算字数预算时需要 summary。
+        # 元数据读取的是一致的视图，检索期间被压缩清除的记录各字段为None，不需要持锁
+        fetch_fields = tuple(fields)
+        if max_chars is not None and 'summary' not in fetch_fields:
+            fetch_fields += ('summary',)
+        ids = {}
+        for _, shard, vector_id, _ in hits:
+            ids.setdefault(shard, []).append(vector_id)
+        fetched = {shard: dict(zip(shard_ids, shard.metadata.fetch(shard_ids, fetch_fields)))
+                   for shard, shard_ids in ids.items()}
         
         results = []
-        for i, idx in enumerate(indices[0]):
-            if idx < len(self.metadata):
-                results.append({
-                    'summary': self.metadata[idx]['summary'],
-                    'conversation': self.metadata[idx]['conversation'],
-                    'distance': float(distances[0][i])
-                })
+        used_chars = 0
+        for distance, shard, vector_id, _ in hits:
+            record = fetched[shard][vector_id]
+            if max_chars is not None:
+                length = len(record['summary'] or '')
+                if used_chars + length > max_chars:
+                    continue
+                used_chars += length
+                if 'summary' not in fields:
+                    del record['summary']
+            record['id'] = vector_id
+            record['distance'] = distance
+            results.append(record)
         
+        self.result_cache.put(cache_key, results)
         return results
-